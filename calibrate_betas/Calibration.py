@@ -9,7 +9,6 @@ import math
 import pandas as pd
 import numpy as np
 import os
-import subprocess
 import joblib
 from collections import defaultdict
 import functools
@@ -20,6 +19,13 @@ from time import time
 import argparse
 import sys
 import json
+import threading
+import scipy.stats
+from ensemble_store import EnsembleStore, read_run, calibration_metrics
+import bayes_opt
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / "cpp-simulator"))
+import executors
 
 DEBUG=False
 
@@ -42,6 +48,10 @@ smaller_networks_scale = 9.0
 params = {}
 betas = {}
 logfile = None
+executor = None
+crn_seeds = None
+crn_previous = None
+crn_variances = defaultdict(lambda: [0.0, 0.0])
 
 def processParams(params_json):
     global params
@@ -62,31 +72,30 @@ def processParams(params_json):
         betas['RANDOM_COMMUNITY'] = betas['NBR_CELLS']
 
 
+def processCityMetadata(input_folder):
+    # cityMetadata.json is written by CityGen next to the city files. Its
+    # bounding box and neighbourhood cell size describe the city actually being
+    # simulated, so they take precedence over the values in the parameters json.
+    global params
+    metadata_file = Path(input_folder, "cityMetadata.json")
+    if not metadata_file.is_file():
+        return
+    with open(metadata_file) as f:
+        metadata = json.load(f)
+    for k in ['CITY_SW_LAT', 'CITY_SW_LON', 'CITY_NE_LAT', 'CITY_NE_LON', 'NBR_CELL_SIZE']:
+        params[k] = metadata[k]
+
+
+def run_dirs(outputdir, nruns):
+    return [Path(outputdir, f"run_{run}") for run in range(nruns)]
+
 def get_mean_fatalities(outputdir, nruns):
-    data_dir = Path(outputdir)
-    glob_str = f"run_[0-{nruns-1}]/num_fatalities.csv"
-    files_list = data_dir.glob(glob_str)
-    df = (pd.concat([pd.read_csv(f) for f in files_list], ignore_index = True)
-          .groupby('Time').mean())
-    return df
+    store = EnsembleStore.from_run_dirs(run_dirs(outputdir, nruns), ["num_fatalities"])
+    return store.mean_frame()
 
 def get_mean_lambdas(outputdir, nruns):
-    data_dir = Path(outputdir)
-    lambdas = {'H': ["lambda_H"], 
-               'W': ["lambda_W", "lambda_PROJECT"], 
-               'C': ["lambda_C", "lambda_NBR_CELL", "lambda_RANDOM_COMMUNITY"]
-              }
-    values = {}
-    for lam in lambdas.keys():
-        lam_sum = 0
-        for lam_inner in lambdas[lam]:
-            glob_str = f"run_[0-{nruns-1}]/cumulative_mean_fraction_{lam_inner}.csv"
-            files_list = data_dir.glob(glob_str)
-            df = (pd.concat([pd.read_csv(f) for f in files_list], ignore_index = True)
-              .groupby('Time').mean())
-            lam_sum += df[f"cumulative_mean_fraction_{lam_inner}"].iloc[-1]
-        values[lam] = lam_sum
-    return values
+    store = EnsembleStore.from_run_dirs(run_dirs(outputdir, nruns))
+    return store.final_lambdas()
 
 def print_and_log(outstring, filename=logfile):
     print(outstring)
@@ -106,8 +115,71 @@ def print_betas():
 # In[ ]:
 
 
-def run_sim(run, params, betas):
-    output_folder = Path(output_base, f"run_{run}")
+def load_crn_seeds(nruns, base_seed=None):
+    # Common random numbers: one (PROVIDE_INITIAL_SEED, PROVIDE_INITIAL_SEED_GRAPH)
+    # pair per replicate slot, used at every iteration. They are kept in
+    # crn_seeds.json so that a rerun with the same -o uses the same ones.
+    seeds_file = Path(output_base, "crn_seeds.json")
+    seeds = []
+    if seeds_file.is_file():
+        with open(seeds_file) as f:
+            seeds = json.load(f)
+    if len(seeds) < nruns:
+        rng = np.random.default_rng(base_seed)
+        seeds += rng.integers(1, 2**31 - 1, size=(nruns - len(seeds), 2)).tolist()
+        with open(seeds_file, "w") as f:
+            json.dump(seeds, f)
+    return seeds[:nruns]
+
+def slot_params(params, run):
+    if crn_seeds is None:
+        return params
+    seed, seed_graph = crn_seeds[run]
+    return dict(params, PROVIDE_INITIAL_SEED = seed, PROVIDE_INITIAL_SEED_GRAPH = seed_graph)
+
+def replicate_objectives(store):
+    # [run, 4]: final lambda H, W, C and fatality slope of each run on its own
+    return np.column_stack((store.run_final_lambdas(), store.run_fatality_slopes()))
+
+def track_crn(store):
+    # The calibration moves on the difference between the ensemble means of
+    # successive beta vectors. With common random numbers its variance is
+    # var(a_i - b_i)/n, against (var(a_i) + var(b_i))/n with fresh seeds,
+    # both estimated here from the paired replicate slots.
+    global crn_previous
+    if crn_seeds is None:
+        return
+    previous, crn_previous = crn_previous, store
+    if previous is None:
+        return
+    # Runs are stored in the order they finished: pair them by slot
+    slots = [run for run in previous.runs if run in store.runs]
+    a = replicate_objectives(previous)[[previous.runs.index(run) for run in slots]]
+    b = replicate_objectives(store)[[store.runs.index(run) for run in slots]]
+    for k, name in enumerate(["lambda_H", "lambda_W", "lambda_C", "slope"]):
+        ok = ~np.isnan(a[:, k]) & ~np.isnan(b[:, k])
+        if ok.sum() < 2:
+            continue
+        paired = np.var(a[:, k][ok] - b[:, k][ok], ddof=1)
+        independent = np.var(a[:, k][ok], ddof=1) + np.var(b[:, k][ok], ddof=1)
+        if independent > 0:
+            crn_variances[name][0] += paired
+            crn_variances[name][1] += independent
+            print_and_log(f"CRN {name:<9}: variance reduction {100 * (1 - paired / independent):6.1f}%", logfile)
+
+def report_crn():
+    if crn_seeds is None or not crn_variances:
+        return
+    print_and_log("", logfile)
+    print_and_log("CRN variance reduction over all iterations:", logfile)
+    for name, (paired, independent) in crn_variances.items():
+        runs = f"{independent / paired:.1f}x" if paired > 0 else "inf"
+        print_and_log(f"  {name:<9}: {100 * (1 - paired / independent):6.1f}% "
+                      f"(fresh seeds would need {runs} the runs)", logfile)
+
+
+def sim_task(run, params, betas, output_dir=None):
+    output_folder = Path(output_dir or output_base, f"run_{run}")
     output_folder.mkdir(parents = True, exist_ok = True)
     cmd = [f"{cpp_exec}"]
     for param in params.keys():
@@ -122,11 +194,27 @@ def run_sim(run, params, betas):
     cmd += [f"--output_directory", f"{output_folder}"]
     print(" ".join(cmd))
     logging.info(" ".join(cmd))
-    if DEBUG: 
-        subprocess.call(cmd)
-    else:
-        ## Suppress other output
-        subprocess.call(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)        
+    ## Suppress other output unless debugging.
+    ## With DRIVE_SIM_CACHE set, only the series used here are cached.
+    return executors.Task(cmd, output_folder, replicate = run,
+                          keep = [f"{m}.csv" for m in calibration_metrics] + ["global_params.txt", "run.npz", "manifest.json"],
+                          quiet = not DEBUG)
+
+def run_sims(tasks, ncores, ingest):
+    # Runs the tasks on the executor (--executor; a local pool of ncores by
+    # default). As each run finishes, ingest(i, times, values) is called with
+    # read_run() of tasks[i], one call at a time; runs that still failed
+    # after the executor's retries are left out.
+    lock = threading.Lock()
+    def finished(i, returncode):
+        if returncode != 0:
+            with lock:
+                print_and_log(f"{tasks[i].output_dir} failed (return code {returncode}); left out of the ensemble", logfile)
+            return
+        result = read_run(tasks[i].output_dir)
+        with lock:
+            ingest(i, *result)
+    (executor or executors.LocalExecutor(ncores)).run(tasks, finished)
 
 
 # In[ ]:
@@ -150,13 +238,8 @@ def getTargetSlope():
 
 
 def get_slope(outputdir, nruns, low_thresh = 10, up_thresh = 200):
-    df = get_mean_fatalities(outputdir, nruns)
-    df = df[(df['num_fatalities'] > low_thresh)]
-    if df.shape[0] < 5:
-        raise TypeError("Too few fatalities")
-    else:
-        df = df[df['num_fatalities'] < up_thresh]
-        return np.polyfit(df.index, np.log(df['num_fatalities']), deg = 1)[0]
+    store = EnsembleStore.from_run_dirs(run_dirs(outputdir, nruns), ["num_fatalities"])
+    return store.fatality_slope(low_thresh, up_thresh)
 
 
 # In[ ]:
@@ -188,11 +271,16 @@ def update_betas(diffs, count=0):
         betas['W'] = max(betas['W'] + step_beta_W , 0) * beta_scale_factor
         betas['C'] = max(betas['C'] + step_beta_C , 0) * beta_scale_factor
     
-    betas['S'] = betas['W'] * 2
-    betas['CLASS'] = betas['S'] * smaller_networks_scale
-    betas['PROJECT'] = betas['W'] * smaller_networks_scale
-    betas['RANDOM_COMMUNITY']  =  betas['C'] * smaller_networks_scale
-    betas['NBR_CELLS'] = betas['C'] * smaller_networks_scale
+    derive_betas(betas)
+
+def derive_betas(b):
+    # Betas that are tied to BETA_H, BETA_W and BETA_C
+    b['S'] = b['W'] * 2
+    b['CLASS'] = b['S'] * smaller_networks_scale
+    b['PROJECT'] = b['W'] * smaller_networks_scale
+    b['RANDOM_COMMUNITY']  =  b['C'] * smaller_networks_scale
+    b['NBR_CELLS'] = b['C'] * smaller_networks_scale
+    return b
 
 def satisfied(diffs, slope_tolerance = 0.001, lam_tolerance = 0.01):
     if diffs==-1:
@@ -207,26 +295,97 @@ def satisfied(diffs, slope_tolerance = 0.001, lam_tolerance = 0.01):
 # In[ ]:
 
 
-def run_parallel(nruns, ncores, params, betas):
-    processed_list = joblib.Parallel(n_jobs=ncores)(
-        joblib.delayed(run_sim)(run, params, betas) for run in range(nruns)
-    )     
+def run_parallel(nruns, ncores, params, betas, store=None):
+    # Runs the replicates 0 .. nruns-1 that are not in store yet and adds
+    # them to it
+    store = store if store is not None else EnsembleStore()
+    runs = [run for run in range(nruns) if f"run_{run}" not in store.runs]
+    run_sims([sim_task(run, slot_params(params, run), betas) for run in runs], ncores,
+             lambda i, times, values: store.add_run(f"run_{runs[i]}", times, values))
+    store.save(Path(output_base, "ensemble.npz"))
+    return store
+
+def confidence_half_widths(store, confidence = 0.95, n_boot = 200):
+    # Half widths of confidence intervals on (lambda_H, lambda_W, lambda_C,
+    # slope): t intervals on the mean of the runs' final lambdas, and a
+    # bootstrap over runs for the slope of the mean fatalities.
+    n = len(store)
+    if n < 2:
+        return np.full(4, np.inf)
+    lambdas = store.run_final_lambdas()
+    t = scipy.stats.t.ppf(0.5 + confidence / 2, n - 1)
+    half_widths = list(t * lambdas.std(axis=0, ddof=1) / np.sqrt(n))
+    slopes = store.bootstrap_fatality_slopes(n_boot, np.random.default_rng(n))
+    if np.isnan(slopes).mean() > 1 - confidence:
+        half_widths.append(np.inf)
+    else:
+        # NaN resamples are ones with too few fatalities, i.e. a low slope
+        low, high = np.quantile(np.nan_to_num(slopes, nan=-np.inf), [0.5 - confidence / 2, 0.5 + confidence / 2])
+        half_widths.append((high - low) / 2)
+    return np.array(half_widths)
+
+def run_adaptive(min_runs, max_runs, ncores, params, betas, confidence = 0.95,
+                 slope_tolerance = 0.001, lam_tolerance = 0.01):
+    # Starts with min_runs replicates and doubles them (up to max_runs) while
+    # the confidence interval of an objective straddles its tolerance and no
+    # objective is clearly outside it. Far from the target a couple of runs
+    # are enough to pick the update; only the last iterations need the full
+    # ensemble to decide whether the tolerances are met.
+    # nruns counts replicate slots, not finished runs: slots that failed are
+    # retried by run_parallel, and may well fail again (with --crn their
+    # seeds are fixed).
+    tolerances = np.array([lam_tolerance] * 3 + [slope_tolerance])
+    nruns = min(min_runs, max_runs)
+    store = run_parallel(nruns, ncores, params, betas)
+    assert len(store) > 0, f"All {nruns} runs failed"
+    while True:
+        diffs = ensemble_diffs(store)
+        if diffs == -1:
+            print_and_log(f"Replicates: {len(store)} (too few fatalities)", logfile)
+            break
+        half_widths = confidence_half_widths(store, confidence)
+        distance = np.abs(diffs)
+        outside = distance - half_widths > tolerances
+        inside = distance + half_widths < tolerances
+        print_and_log(f"Replicates: {len(store)}, {100 * confidence:.0f}% CI half widths: "
+                      + " ".join(f"{h:.5f}" for h in half_widths), logfile)
+        if outside.any() or inside.all() or nruns >= max_runs:
+            break
+        finished = len(store)
+        nruns = min(2 * nruns, max_runs)
+        store = run_parallel(nruns, ncores, params, betas, store)
+        if len(store) == finished:
+            print_and_log(f"Replicates: no run of slots up to {nruns} finished, going on with {finished}", logfile)
+            break
+    return store
     
-@measure
-def calibrate(nruns, ncores, params, betas, resolution=4):
-    run_parallel(nruns, ncores, params, betas)    
+def ensemble_diffs(store):
     try:
-        slope = get_slope(output_base, nruns)
+        slope = store.fatality_slope()
     except TypeError:
         return -1
 
-    lambdas = get_mean_lambdas(output_base, nruns)
+    lambdas = store.final_lambdas()
     [lambda_H, lambda_W, lambda_C] = [lambdas[key] for key in ['H', 'W', 'C']]
     lambda_H_diff = float(lambda_H) - (1.0/3)
     lambda_W_diff = float(lambda_W) - (1.0/3)
     lambda_C_diff = float(lambda_C) - (1.0/3)
         
     slope_diff = target_slope - slope
+    return (lambda_H_diff, lambda_W_diff, lambda_C_diff, slope_diff)
+
+@measure
+def calibrate(nruns, ncores, params, betas, resolution=4, min_runs=None, confidence=0.95):
+    # With min_runs, nruns is the largest ensemble (see run_adaptive)
+    if min_runs:
+        store = run_adaptive(min_runs, nruns, ncores, params, betas, confidence)
+    else:
+        store = run_parallel(nruns, ncores, params, betas)
+    track_crn(store)
+    diffs = ensemble_diffs(store)
+    if diffs == -1:
+        return diffs
+    (lambda_H_diff, lambda_W_diff, lambda_C_diff, slope_diff) = diffs
 
     print_betas()
     print_and_log(f"lambda_H_diff: {lambda_H_diff:.5f}", logfile)
@@ -235,7 +394,68 @@ def calibrate(nruns, ncores, params, betas, resolution=4):
     print_and_log(f"slope_diff   : {slope_diff:.5f}", logfile)
     print_and_log("", logfile)
     logging.info(f"Slope: slope")
-    return (lambda_H_diff, lambda_W_diff, lambda_C_diff, slope_diff)
+    return diffs
+
+
+# In[ ]:
+
+
+def run_batch(nruns, ncores, params, beta_list, iteration):
+    # nruns runs of every beta vector in beta_list, all in one pool
+    folders = [Path(output_base, f"bayes_{iteration}_{k}") for k in range(len(beta_list))]
+    stores = [EnsembleStore() for _ in beta_list]
+    jobs = [(k, run) for k in range(len(beta_list)) for run in range(nruns)]
+    run_sims([sim_task(run, slot_params(params, run), beta_list[k], folders[k]) for k, run in jobs], ncores,
+             lambda i, times, values: stores[jobs[i][0]].add_run(f"run_{jobs[i][1]}", times, values))
+    for folder, store in zip(folders, stores):
+        store.save(Path(folder, "ensemble.npz"))
+        track_crn(store)
+    return stores
+
+@measure
+def calibrate_bayes(nruns, ncores, params, batch_size, max_evaluations, beta_range,
+                    slope_tolerance = 0.001, lam_tolerance = 0.01):
+    # Gaussian-process optimisation over (BETA_H, BETA_W, BETA_C); see
+    # bayes_opt.py. Every evaluation is appended to bayes_history.jsonl, and
+    # a rerun with the same -o resumes from it.
+    global betas
+    history = bayes_opt.History(Path(output_base, "bayes_history.jsonl"))
+    start = {k: betas[k] for k in bayes_opt.beta_keys}
+    space = bayes_opt.BetaSpace(start, beta_range)
+    tolerances = np.array([lam_tolerance] * 3 + [slope_tolerance])
+    rng = np.random.default_rng(len(history))
+
+    def done(record):
+        return (record["diffs"] is not None and
+                satisfied(tuple(abs(d) for d in record["diffs"]), slope_tolerance, lam_tolerance))
+
+    found = next((r for r in history.records if done(r)), None)
+    while found is None and len(history) < max_evaluations:
+        iteration = history.iterations() + 1
+        if len(history) == 0:
+            proposals = bayes_opt.initial_design(space, start, batch_size, rng)
+        else:
+            proposals = bayes_opt.propose_batch(history, space, batch_size, tolerances, rng)
+        beta_list = [derive_betas(dict(p, TRAVEL = betas['TRAVEL'])) for p in proposals]
+        stores = run_batch(nruns, ncores, params, beta_list, iteration)
+        print_and_log("", logfile)
+        print_and_log(f"Iteration: {iteration}", logfile)
+        for p, store in zip(proposals, stores):
+            diffs = ensemble_diffs(store)
+            record = {"iteration": iteration, "betas": p, "nruns": nruns,
+                      "diffs": None if diffs == -1 else [float(d) for d in diffs]}
+            history.append(record)
+            described = "too few fatalities" if diffs == -1 else " ".join(f"{d:.5f}" for d in diffs)
+            print_and_log(f"BETA_H {p['H']:.5f} BETA_W {p['W']:.5f} BETA_C {p['C']:.5f}: {described}", logfile)
+            if found is None and done(record):
+                found = record
+
+    best = found or history.best(tolerances)
+    if best is not None:
+        betas.update(best["betas"])
+        derive_betas(betas)
+        print_betas()
+    return found is not None
 
 
 # In[ ]:
@@ -247,6 +467,7 @@ def main():
     global smaller_networks_scale
     global logfile
     global cpp_exec, output_base, input_folder
+    global crn_seeds, executor
 
     
     resolution = 4
@@ -255,6 +476,14 @@ def main():
     default_input_folder = "../staticInst/data/mumbai_1million/"
     default_output_folder = "calibration_output/"
     default_nruns = 6
+    # Calibration only uses mean fatalities below 200 (the slope window of
+    # EnsembleStore.fatality_slope) and the final cumulative lambdas, so runs
+    # can stop past that point. A stopped run is padded with its last values,
+    # so no run may stop while the ensemble mean can still be in the window:
+    # with every run going past -r * 200 fatalities, the mean is past 200 as
+    # soon as one run stops.
+    slope_up_thresh = 200
+    default_stop_lambda_tolerance = 0.001
 
     class MyParser(argparse.ArgumentParser):
         def error(self, message):
@@ -288,6 +517,57 @@ def main():
         '-p', help='Starting parameters json',
         required=True
     )
+    my_parser.add_argument(
+        '--optimiser', choices=['heuristic', 'bayes'],
+        help="beta update: the step/scale heuristic, or Gaussian-process Bayesian optimisation",
+        default = 'heuristic')
+    my_parser.add_argument(
+        '--batch', type=int,
+        help="bayes: beta vectors simulated per iteration (default: cpus / runs)",
+        default = None)
+    my_parser.add_argument(
+        '--max_evaluations', type=int,
+        help="bayes: give up after this many beta vectors",
+        default = 60)
+    my_parser.add_argument(
+        '--beta_range', type=float,
+        help="bayes: search betas between start/beta_range and start*beta_range",
+        default = 10.0)
+    executors.add_executor_arguments(my_parser)
+    my_parser.add_argument(
+        '--min_runs', type=int,
+        help="heuristic: start each step with this many runs and double them, up to -r, "
+             "while a confidence interval straddles its tolerance (default: always -r runs)",
+        default = None)
+    my_parser.add_argument(
+        '--confidence', type=float,
+        help="min_runs: confidence level of the intervals",
+        default = 0.95)
+    my_parser.add_argument(
+        '--crn', action='store_true',
+        help="common random numbers: replicate slot k uses the same seeds at every iteration")
+    my_parser.add_argument(
+        '--crn_seed', type=int,
+        help="crn: seed for drawing the per-slot seeds (default: random); reused from crn_seeds.json in -o",
+        default = None)
+    my_parser.add_argument(
+        '--stop_fatalities', type=int,
+        help="stop each run once it has more fatalities than this, at least -r * 200; "
+             "0 runs all NUM_DAYS (default: -r * 200)",
+        default = None)
+    my_parser.add_argument(
+        '--stop_lambda_tolerance', type=float,
+        help="and once its cumulative lambda fractions change by less than this in a day",
+        default = default_stop_lambda_tolerance)
+    my_parser.add_argument(
+        '--outputs',
+        help="time series each run writes (drive_simulator --outputs): a preset "
+             "(calibration, dashboard, full) or comma-separated names; must include what the calibration reads",
+        default = 'calibration')
+    my_parser.add_argument(
+        '--output_format', choices=['csv', 'npz', 'both'],
+        help="drive_simulator --output_format: one csv file per series, or all of them in run.npz",
+        default = 'csv')
 
     args = my_parser.parse_args() or my_parser.print_help()
     cpp_exec = f"./{args.e}" or exit("Error: Couldn't process argument to -e.\n", my_parser.print_help())
@@ -298,19 +578,41 @@ def main():
     ncores = int(args.c) or exit("Error: couldn't process argument to -c.\n", my_parser.print_help())
 
     smaller_networks_scale = float(args.s)
+    executor = executors.executor_from_args(args, ncores)
 
     Path(output_base).mkdir(parents=True, exist_ok = True)
     logfile = Path(output_base, "calibration.log")
 
     processParams(params_json)
+    processCityMetadata(input_folder)
+    stop_fatalities = args.stop_fatalities if args.stop_fatalities is not None else nruns * slope_up_thresh
+    if 0 < stop_fatalities < nruns * slope_up_thresh:
+        my_parser.error(f"--stop_fatalities must be 0 or at least -r * {slope_up_thresh} = {nruns * slope_up_thresh}")
+    if stop_fatalities > 0:
+        params['STOP_FATALITIES'] = stop_fatalities
+        params['STOP_LAMBDA_TOLERANCE'] = args.stop_lambda_tolerance
+    params['outputs'] = args.outputs
+    params['output_format'] = args.output_format
+    if args.crn:
+        crn_seeds = load_crn_seeds(nruns, args.crn_seed)
+
+    if args.optimiser == 'bayes':
+        batch_size = args.batch or max(1, ncores // nruns)
+        if calibrate_bayes(nruns, ncores, params, batch_size, args.max_evaluations, args.beta_range):
+            print("Satisfied!")
+        else:
+            print(f"Not satisfied after {args.max_evaluations} evaluations, see {Path(output_base, 'bayes_history.jsonl')}")
+        report_crn()
+        return
     
     count = 1
     while True:
         print_and_log("", logfile)
         print_and_log(f"Count: {count}", logfile)
-        diffs = calibrate(nruns, ncores, params, betas)
+        diffs = calibrate(nruns, ncores, params, betas, min_runs=args.min_runs, confidence=args.confidence)
         if satisfied(diffs):
             print("Satisfied!")
+            report_crn()
             break
         else:
             update_betas(diffs, count)
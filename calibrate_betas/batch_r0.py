@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# R0 / growth-rate estimates for every run of an ensemble at once.
+#
+# calculate_r0.py fits the model of affected (infected + recovered)
+#     A(i) = c (r exp((r - mu) i) - mu) / (r - mu),    mu = 0.1 / resolution
+# to one averaged affected_mean.csv, in log10, with R0 = r / mu. Here the
+# same model is fitted to the num_affected.csv of each run found under the
+# given directories (any intervention), over the window starting when the
+# run first reaches `threshold` affected and lasting `days` days.
+#
+# All the fits are done together: a batched Levenberg-Marquardt over
+# (r, log10 c) with the residuals and their analytic Jacobian computed as
+# [fit, time] arrays, so hundreds of runs, each with hundreds of bootstrap
+# refits, take seconds. Confidence intervals come from a moving-block
+# bootstrap of each run's residuals (blocks of `block_days` days, as the
+# residuals of a cumulative series are correlated).
+#
+#   python batch_r0.py calibration_output/ sweeps/ -o r0.csv
+
+import argparse
+import glob
+import os
+import re
+
+import joblib
+import numpy as np
+import pandas as pd
+
+ln10 = np.log(10)
+
+
+def find_runs(paths):
+    # Output directories (holding num_affected.csv) under paths
+    runs = set()
+    for path in paths:
+        for f in glob.glob(os.path.join(path, "**", "num_affected.csv"), recursive=True):
+            runs.add(os.path.dirname(os.path.abspath(f)))
+    return sorted(runs)
+
+
+def read_intervention(run_dir):
+    params_file = os.path.join(run_dir, "global_params.txt")
+    if os.path.isfile(params_file):
+        with open(params_file, "r") as f:
+            for line in f:
+                m = re.match(r"INTERVENTION:\s*([^;]*);", line)
+                if m:
+                    return m.group(1).strip()
+    return ""
+
+
+def read_affected(run_dir):
+    data = pd.read_csv(os.path.join(run_dir, "num_affected.csv"))
+    return data.iloc[:, 1].to_numpy(dtype=float), read_intervention(run_dir)
+
+
+def fit_windows(series, threshold, days, resolution):
+    # Stack the fitting windows into a [run, time] array (NaN past the end of
+    # a short window). Runs that never reach threshold give an empty window.
+    length = int(days * resolution)
+    windows = np.full((len(series), length), np.nan)
+    for k, y in enumerate(series):
+        above = np.flatnonzero(y >= threshold)
+        if above.size:
+            w = y[above[0]:above[0] + length]
+            windows[k, :w.size] = w
+    return windows
+
+
+def growth_model(r, log10_c, steps, mu):
+    # log10 A and its derivatives with respect to r and log10 c, for
+    # r, log10_c of shape [fit] and steps of shape [time]
+    g = (r - mu)[:, None]
+    rr = r[:, None]
+    E = np.exp(g * steps[None, :])
+    num = rr * E - mu
+    log10_A = log10_c[:, None] + (np.log(np.abs(num)) - np.log(np.abs(g))) / ln10
+    d_r = (E * (1 + rr * steps[None, :]) / num - 1 / g) / ln10
+    return log10_A, d_r
+
+
+def fit_batch(log10_y, mu, init=None, iterations=100, r_min=1e-6):
+    # Least squares fit of log10 A to each row of log10_y (NaN = no data),
+    # starting from init = (r, log10 c) if given. Returns r, log10 c and the
+    # residuals, all NaN for rows with fewer than three points.
+    n_fits, n_steps = log10_y.shape
+    steps = np.arange(n_steps, dtype=float)
+    mask = ~np.isnan(log10_y)
+    y = np.where(mask, log10_y, 0)
+    n = mask.sum(axis=1)
+    ok = n >= 3
+
+    if init is None:
+        # Start from a straight line through log10 y: its slope gives r - mu,
+        # and c follows in closed form for that r.
+        t_mean = (mask * steps).sum(axis=1) / np.maximum(n, 1)
+        y_mean = y.sum(axis=1) / np.maximum(n, 1)
+        dt = np.where(mask, steps - t_mean[:, None], 0)
+        slope = (dt * (y - y_mean[:, None])).sum(axis=1) / np.maximum((dt ** 2).sum(axis=1), 1e-12)
+        r = np.maximum(slope * ln10 + mu, r_min)
+        r = np.where(np.abs(r - mu) < 1e-9, mu + 1e-6, r)
+        shape, _ = growth_model(r, np.zeros(n_fits), steps, mu)
+        log10_c = np.where(mask, y - shape, 0).sum(axis=1) / np.maximum(n, 1)
+    else:
+        r, log10_c = (np.array(v, dtype=float) for v in init)
+
+    def cost(r, log10_c, rows):
+        model, d_r = growth_model(r, log10_c, steps, mu)
+        res = np.where(mask[rows], model - y[rows], 0)
+        return res, np.where(mask[rows], d_r, 0), (res ** 2).sum(axis=1)
+
+    damping = np.full(n_fits, 1e-3)
+    res, d_r, current = cost(r, log10_c, slice(None))
+    active = np.flatnonzero(ok)
+    for _ in range(iterations):
+        if active.size == 0:
+            break
+        # 2x2 normal equations per fit; d(log10 A)/d(log10 c) = 1
+        ra, da = res[active], d_r[active]
+        a = (da ** 2).sum(axis=1) * (1 + damping[active]) + 1e-12
+        b = da.sum(axis=1)
+        d = n[active] * (1 + damping[active]) + 1e-12
+        gr = (da * ra).sum(axis=1)
+        gc = ra.sum(axis=1)
+        det = a * d - b * b
+        r_new = np.maximum(r[active] - (d * gr - b * gc) / det, r_min)
+        r_new = np.where(np.abs(r_new - mu) < 1e-9, mu + 1e-6, r_new)
+        c_new = log10_c[active] - (a * gc - b * gr) / det
+        res_new, d_r_new, trial = cost(r_new, c_new, active)
+        better = np.isfinite(trial) & (trial <= current[active])
+        improvement = np.where(better, current[active] - trial, 0)
+        rows = active[better]
+        r[rows], log10_c[rows] = r_new[better], c_new[better]
+        res[rows], d_r[rows], current[rows] = res_new[better], d_r_new[better], trial[better]
+        damping[active] = np.where(better, damping[active] / 3, damping[active] * 4)
+        converged = (better & (improvement <= 1e-12 * (1 + current[active]))) | (damping[active] > 1e10)
+        active = active[~converged]
+    nan = np.where(ok, 1.0, np.nan)
+    return r * nan, log10_c * nan, np.where(mask & ok[:, None], res, np.nan)
+
+
+def bootstrap_r(log10_y, r, log10_c, residuals, mu, n_boot, block, rng):
+    # Moving-block bootstrap of each run's residuals around its fit; returns
+    # the refitted r, [run, n_boot]
+    n_runs, n_steps = log10_y.shape
+    steps = np.arange(n_steps, dtype=float)
+    fitted, _ = growth_model(np.nan_to_num(r, nan=1.0), np.nan_to_num(log10_c), steps, mu)
+    lengths = (~np.isnan(log10_y)).sum(axis=1)
+    n_blocks = -(-n_steps // block)
+    # Block starts drawn within each run's own window
+    starts = (rng.random((n_runs, n_boot, n_blocks)) *
+              np.maximum(lengths - block + 1, 1)[:, None, None]).astype(int)
+    idx = (starts[..., None] + np.arange(block)).reshape(n_runs, n_boot, -1)[:, :, :n_steps]
+    idx = np.minimum(idx, np.maximum(lengths - 1, 0)[:, None, None])
+    resampled = np.take_along_axis(np.nan_to_num(residuals)[:, None, :].repeat(n_boot, axis=1), idx, axis=2)
+    y_boot = fitted[:, None, :] + resampled
+    y_boot = np.where(np.isnan(log10_y)[:, None, :], np.nan, y_boot)
+    init = (np.repeat(np.nan_to_num(r, nan=1.0), n_boot), np.repeat(np.nan_to_num(log10_c), n_boot))
+    r_boot, _, _ = fit_batch(y_boot.reshape(n_runs * n_boot, n_steps), mu, init)
+    return r_boot.reshape(n_runs, n_boot)
+
+
+def estimate_r0(run_dirs, threshold=10, days=30, resolution=4, n_boot=200, confidence=0.95,
+                block_days=2, n_jobs=-1, seed=0):
+    # Table with one row per run: R0 = r / mu and the daily growth rate
+    # (r - mu) * resolution, with bootstrap confidence intervals
+    mu = 0.1 / resolution
+    loaded = joblib.Parallel(n_jobs=n_jobs)(joblib.delayed(read_affected)(d) for d in run_dirs)
+    windows = fit_windows([y for y, _ in loaded], threshold, days, resolution)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log10_y = np.where(windows > 0, np.log10(windows), np.nan)
+    r, log10_c, residuals = fit_batch(log10_y, mu)
+
+    table = pd.DataFrame({
+        "run": run_dirs,
+        "intervention": [intervention for _, intervention in loaded],
+        "points": (~np.isnan(log10_y)).sum(axis=1),
+        "R0": r / mu,
+        "growth_rate": (r - mu) * resolution,
+        "rmse_log10": np.sqrt(np.nanmean(residuals ** 2, axis=1)) if len(run_dirs) else [],
+    })
+    if n_boot > 0 and len(run_dirs):
+        r_boot = bootstrap_r(log10_y, r, log10_c, residuals, mu, n_boot,
+                             max(1, int(block_days * resolution)), np.random.default_rng(seed))
+        alpha = (1 - confidence) / 2
+        with np.errstate(invalid="ignore"):
+            low, high = np.nanquantile(r_boot, [alpha, 1 - alpha], axis=1)
+        table["R0_low"], table["R0_high"] = low / mu, high / mu
+        table["growth_rate_low"], table["growth_rate_high"] = (low - mu) * resolution, (high - mu) * resolution
+    return table
+
+
+def summarise(table):
+    # R0 distribution over the runs of each intervention
+    return table.groupby("intervention")["R0"].describe(percentiles=[0.025, 0.5, 0.975])
+
+
+def main():
+    my_parser = argparse.ArgumentParser(description='R0 / growth rate of every run under the given directories',
+                                        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    my_parser.add_argument('dirs', nargs='+', help='simulator output directories, searched recursively')
+    my_parser.add_argument('-o', help='write the per-run table to this csv', default=None)
+    my_parser.add_argument('--threshold', type=float, help='fit from the first time num_affected reaches this', default=10)
+    my_parser.add_argument('--days', type=float, help='length of the fitting window', default=30)
+    my_parser.add_argument('--resolution', type=int, help='time steps per day', default=4)
+    my_parser.add_argument('--bootstrap', type=int, help='bootstrap refits per run (0: no intervals)', default=200)
+    my_parser.add_argument('--confidence', type=float, default=0.95)
+    my_parser.add_argument('--block_days', type=float, help='bootstrap block length', default=2)
+    my_parser.add_argument('-c', type=int, help='processes for reading the runs', default=-1)
+    args = my_parser.parse_args()
+
+    run_dirs = find_runs(args.dirs)
+    assert run_dirs, f"no num_affected.csv under {args.dirs}"
+    table = estimate_r0(run_dirs, args.threshold, args.days, args.resolution, args.bootstrap,
+                        args.confidence, args.block_days, args.c)
+    if args.o:
+        table.to_csv(args.o, index=False)
+        print(f"Wrote {len(table)} runs to {args.o}")
+    print(summarise(table).to_string())
+
+
+if __name__ == "__main__":
+    main()
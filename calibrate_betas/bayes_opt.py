@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Gaussian-process (Bayesian optimisation) proposals for Calibration.py
+# --optimiser bayes.
+#
+# Every evaluated beta vector (BETA_H, BETA_W, BETA_C) and its ensemble
+# result (lambda_H_diff, lambda_W_diff, lambda_C_diff, slope_diff) is kept in
+# a JSON-lines history file, so a calibration can be stopped and resumed.
+# One GP per objective is fitted over log-betas scaled to [0, 1]^3. A batch
+# of new beta vectors is proposed by Thompson sampling: for each slot of the
+# batch, a joint posterior sample of the four objectives is drawn over a set
+# of candidates and the candidate minimising
+#     sum_k (diff_k / tolerance_k)^2
+# is taken. Different samples pick different points, which gives a batch that
+# can be simulated in parallel.
+
+import json
+import os
+
+import numpy as np
+from scipy.linalg import cho_factor, cho_solve, solve_triangular
+from scipy.optimize import minimize
+
+beta_keys = ['H', 'W', 'C']
+diff_keys = ["lambda_H_diff", "lambda_W_diff", "lambda_C_diff", "slope_diff"]
+
+
+def matern52(A, B, lengthscales, signal_var):
+    d = np.sqrt((((A[:, None, :] - B[None, :, :]) / lengthscales) ** 2).sum(axis=-1))
+    s5d = np.sqrt(5) * d
+    return signal_var * (1 + s5d + 5 * d ** 2 / 3) * np.exp(-s5d)
+
+
+class GaussianProcess:
+    # Zero-mean GP on standardised targets with an ARD Matern 5/2 kernel and
+    # a learned noise variance (the ensemble means are noisy).
+
+    def __init__(self, restarts=3, seed=0):
+        self.restarts = restarts
+        self.rng = np.random.default_rng(seed)
+
+    def _unpack(self, theta):
+        dim = theta.size - 2
+        return np.exp(theta[:dim]), np.exp(theta[dim]), np.exp(theta[dim + 1])
+
+    def _nll(self, theta):
+        lengthscales, signal_var, noise_var = self._unpack(theta)
+        K = matern52(self.X, self.X, lengthscales, signal_var) + (noise_var + 1e-8) * np.eye(len(self.X))
+        try:
+            L = np.linalg.cholesky(K)
+        except np.linalg.LinAlgError:
+            return 1e10
+        alpha = cho_solve((L, True), self.y)
+        return 0.5 * self.y @ alpha + np.log(np.diag(L)).sum()
+
+    def fit(self, X, y):
+        self.X = np.asarray(X, dtype=float)
+        y = np.asarray(y, dtype=float)
+        self.y_mean = y.mean()
+        self.y_std = y.std() if y.std() > 0 else 1.0
+        self.y = (y - self.y_mean) / self.y_std
+        dim = self.X.shape[1]
+        bounds = [(np.log(0.02), np.log(5))] * dim + [(np.log(0.05), np.log(20)), (np.log(1e-6), np.log(1))]
+        starts = [np.r_[np.full(dim, np.log(0.3)), 0.0, np.log(0.01)]]
+        starts += [np.array([self.rng.uniform(lo, hi) for lo, hi in bounds]) for _ in range(self.restarts)]
+        best = min((minimize(self._nll, s, method="L-BFGS-B", bounds=bounds) for s in starts),
+                   key=lambda r: r.fun)
+        self.lengthscales, self.signal_var, self.noise_var = self._unpack(best.x)
+        K = matern52(self.X, self.X, self.lengthscales, self.signal_var) + (self.noise_var + 1e-8) * np.eye(len(self.X))
+        self.chol = cho_factor(K, lower=True)
+        self.alpha = cho_solve(self.chol, self.y)
+        return self
+
+    def predict(self, Xs, full_cov=False):
+        # Posterior of the latent (noise-free) function, in the units of y
+        Ks = matern52(np.asarray(Xs, dtype=float), self.X, self.lengthscales, self.signal_var)
+        mean = Ks @ self.alpha
+        v = solve_triangular(self.chol[0], Ks.T, lower=True)
+        if full_cov:
+            cov = matern52(Xs, Xs, self.lengthscales, self.signal_var) - v.T @ v
+            return self.y_mean + self.y_std * mean, self.y_std ** 2 * cov
+        var = np.maximum(self.signal_var - (v ** 2).sum(axis=0), 0)
+        return self.y_mean + self.y_std * mean, self.y_std ** 2 * var
+
+    def sample(self, Xs, n, rng):
+        mean, cov = self.predict(Xs, full_cov=True)
+        L = np.linalg.cholesky(cov + 1e-8 * np.mean(np.diag(cov)) * np.eye(len(Xs)) + 1e-12 * np.eye(len(Xs)))
+        return mean[None, :] + rng.standard_normal((n, len(Xs))) @ L.T
+
+
+class History:
+    # JSON-lines file, one evaluated beta vector per line:
+    #   {"iteration": 3, "betas": {"H": .., "W": .., "C": ..}, "nruns": 6,
+    #    "diffs": [lambda_H_diff, lambda_W_diff, lambda_C_diff, slope_diff]}
+    # diffs is null when the ensemble had too few fatalities for a slope.
+
+    def __init__(self, path):
+        self.path = path
+        self.records = []
+        if os.path.isfile(path):
+            with open(path, "r") as f:
+                self.records = [json.loads(line) for line in f if line.strip()]
+
+    def __len__(self):
+        return len(self.records)
+
+    def iterations(self):
+        return max((r["iteration"] for r in self.records), default=0)
+
+    def append(self, record):
+        self.records.append(record)
+        with open(self.path, "a+") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def best(self, tolerances):
+        done = [r for r in self.records if r["diffs"] is not None]
+        if not done:
+            return None
+        return min(done, key=lambda r: scaled_loss(np.array(r["diffs"]), tolerances))
+
+
+def scaled_loss(diffs, tolerances):
+    return np.sum((np.asarray(diffs) / tolerances) ** 2, axis=-1)
+
+
+class BetaSpace:
+    # Box in log-beta space around the starting betas, mapped to [0, 1]^3
+
+    def __init__(self, start_betas, beta_range=10.0):
+        centre = np.log([start_betas[k] for k in beta_keys])
+        self.low = centre - np.log(beta_range)
+        self.high = centre + np.log(beta_range)
+
+    def to_unit(self, betas):
+        x = np.log([betas[k] for k in beta_keys])
+        return (x - self.low) / (self.high - self.low)
+
+    def to_betas(self, u):
+        x = self.low + np.clip(u, 0, 1) * (self.high - self.low)
+        return dict(zip(beta_keys, np.exp(x).tolist()))
+
+
+def initial_design(space, start_betas, n, rng):
+    # The starting point plus a Latin hypercube over the box
+    points = [space.to_unit(start_betas)]
+    if n > 1:
+        m = n - 1
+        lhs = (np.argsort(rng.random((m, 3)), axis=0) + rng.random((m, 3))) / m
+        points += list(lhs)
+    return [space.to_betas(u) for u in points[:n]]
+
+
+def training_data(history, space):
+    # X (unit cube) and Y [n, 4] with NaN where the objective is unknown.
+    # Runs with too few fatalities get the largest slope_diff seen so far, and
+    # at least 1, steering proposals away from betas that are too small.
+    X = np.array([space.to_unit(r["betas"]) for r in history.records])
+    Y = np.full((len(X), len(diff_keys)), np.nan)
+    for i, r in enumerate(history.records):
+        if r["diffs"] is not None:
+            Y[i] = r["diffs"]
+    failed = np.isnan(Y[:, 3])
+    if failed.any():
+        Y[failed, 3] = max(np.nanmax(Y[:, 3]) if (~failed).any() else 1.0, 1.0)
+    return X, Y
+
+
+def propose_batch(history, space, batch_size, tolerances, rng, n_candidates=1000):
+    best = history.best(tolerances)
+    if best is None:
+        # Nothing has produced enough fatalities yet: double the last batch,
+        # as update_betas does.
+        last = [r for r in history.records if r["iteration"] == history.iterations()]
+        return [{k: 2 * r["betas"][k] for k in beta_keys} for r in last][:batch_size]
+
+    X, Y = training_data(history, space)
+    gps = []
+    for k in range(len(diff_keys)):
+        known = ~np.isnan(Y[:, k])
+        gps.append(GaussianProcess(seed=int(rng.integers(1 << 31))).fit(X[known], Y[known, k]) if known.sum() >= 2 else None)
+
+    # Half the candidates anywhere in the box, half around the best point
+    centre = space.to_unit(best["betas"])
+    candidates = np.vstack((rng.random((n_candidates // 2, 3)),
+                            np.clip(centre + 0.05 * rng.standard_normal((n_candidates - n_candidates // 2, 3)), 0, 1)))
+
+    loss = np.zeros((batch_size, n_candidates))
+    for k, gp in enumerate(gps):
+        if gp is not None:
+            loss += (gp.sample(candidates, batch_size, rng) / tolerances[k]) ** 2
+    chosen = []
+    for s in range(batch_size):
+        order = np.argsort(loss[s])
+        j = next(j for j in order if j not in chosen)
+        chosen.append(j)
+    return [space.to_betas(candidates[j]) for j in chosen]
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Ensemble of simulator runs for the calibration loop.
+#
+# Each finished run is ingested once: the series the calibration needs
+# (num_fatalities and the cumulative mean lambda fractions) are read from its
+# output directory and appended to a run x time x metric array. Running sums
+# are updated at the same time, so means over the ensemble cost O(time x
+# metric) no matter how many runs there are, and adding a run costs O(its
+# own data). Quantiles are computed from the array and cached until the next
+# run arrives.
+#
+# Runs stopped early by drive_simulator --STOP_FATALITIES are shorter than
+# the others. All the stored series are cumulative (fatalities, cumulative
+# mean lambda fractions), so a short run is extended with its last values to
+# the length of the longest run. Means over the padded part mix runs at
+# different end times: fatality_slope() is only unbiased if no run stops
+# while the mean is still in its window (Calibration.py makes every run go
+# past -r times the window's upper threshold).
+#
+# save()/load() keep the ensemble in a single .npz file:
+#   values   float64 [run, time, metric]  (NaN where a run has no value)
+#   times    float64 [time]
+#   metrics  str     [metric]
+#   runs     str     [run]                run labels (e.g. output dir names)
+
+import os
+
+import numpy as np
+import pandas as pd
+
+lambda_metrics = {
+    'H': ["cumulative_mean_fraction_lambda_H"],
+    'W': ["cumulative_mean_fraction_lambda_W", "cumulative_mean_fraction_lambda_PROJECT"],
+    'C': ["cumulative_mean_fraction_lambda_C", "cumulative_mean_fraction_lambda_NBR_CELL",
+          "cumulative_mean_fraction_lambda_RANDOM_COMMUNITY"],
+    }
+
+calibration_metrics = ["num_fatalities"] + [m for k in ['H', 'W', 'C'] for m in lambda_metrics[k]]
+
+
+def read_run(run_dir, metrics=calibration_metrics):
+    # Returns (times, values[time, metric]) for one simulator output directory.
+    # Every <metric>.csv has the columns Time,<metric>; runs written with
+    # drive_simulator --output_format npz have them all in run.npz instead
+    # (see cpp-simulator/run_output.py).
+    npz_file = os.path.join(run_dir, "run.npz")
+    if os.path.isfile(npz_file):
+        with np.load(npz_file) as run:
+            times = run[f"time/{metrics[0]}"]
+            for metric in metrics[1:]:
+                assert np.array_equal(times, run[f"time/{metric}"]), f"{npz_file}: {metric} has different time steps"
+            return times, np.column_stack([run[metric][:, 0].astype(float) for metric in metrics])
+    times = None
+    columns = []
+    for metric in metrics:
+        data = np.loadtxt(os.path.join(run_dir, f"{metric}.csv"), delimiter=",", skiprows=1, ndmin=2)
+        if times is None:
+            times = data[:, 0]
+        else:
+            assert np.array_equal(times, data[:, 0]), f"{run_dir}: {metric}.csv has different time steps"
+        columns.append(data[:, 1])
+    return times, np.column_stack(columns)
+
+
+class EnsembleStore:
+
+    def __init__(self, metrics=calibration_metrics):
+        self.metrics = list(metrics)
+        self.metric_index = {m: i for i, m in enumerate(self.metrics)}
+        self.times = None
+        self.runs = []
+        self.values = np.empty((0, 0, len(self.metrics)))
+        self.count = None
+        self.sum = None
+        self.sumsq = None
+        self.quantile_cache = {}
+
+    def __len__(self):
+        return len(self.runs)
+
+    def data(self):
+        # run x time x metric view of the ingested runs
+        return self.values[:len(self.runs)]
+
+    def _grow(self):
+        capacity = max(2 * self.values.shape[0], 8)
+        values = np.full((capacity, self.times.size, len(self.metrics)), np.nan)
+        values[:len(self.runs)] = self.data()
+        self.values = values
+
+    def _extend(self, times):
+        # Lengthen the time axis to times, padding the runs so far with their
+        # last values.
+        old = self.times.size
+        n = len(self.runs)
+        values = np.full((max(self.values.shape[0], n), times.size, len(self.metrics)), np.nan)
+        values[:n, :old] = self.data()
+        if n > 0 and old > 0:
+            values[:n, old:] = values[:n, old - 1:old]
+        self.values = values
+        self.times = times
+        padded = values[:n, old:]
+        present = ~np.isnan(padded)
+        self.count = np.concatenate((self.count, present.sum(axis=0)))
+        self.sum = np.concatenate((self.sum, np.where(present, padded, 0).sum(axis=0)))
+        self.sumsq = np.concatenate((self.sumsq, np.where(present, padded ** 2, 0).sum(axis=0)))
+
+    def add_run(self, run, times, values):
+        times = np.asarray(times, dtype=float)
+        values = np.asarray(values, dtype=float)
+        assert values.shape == (len(times), len(self.metrics)), f"run {run}: expected {len(self.metrics)} metrics"
+        if self.times is None:
+            self.times = np.empty(0)
+            self.count = np.zeros((0, len(self.metrics)), dtype=np.int64)
+            self.sum = np.zeros((0, len(self.metrics)))
+            self.sumsq = np.zeros((0, len(self.metrics)))
+            self.values = np.empty((0, 0, len(self.metrics)))
+        common = min(times.size, self.times.size)
+        assert np.array_equal(self.times[:common], times[:common]), f"run {run} has different time steps from the ensemble"
+        if times.size > self.times.size:
+            self._extend(times)
+        if times.size < self.times.size and times.size > 0:
+            values = np.concatenate((values, np.repeat(values[-1:], self.times.size - times.size, axis=0)))
+        if len(self.runs) == self.values.shape[0]:
+            self._grow()
+        self.values[len(self.runs)] = values
+        self.runs.append(str(run))
+        present = ~np.isnan(values)
+        self.count += present
+        self.sum += np.where(present, values, 0)
+        self.sumsq += np.where(present, values ** 2, 0)
+        self.quantile_cache = {}
+
+    def ingest(self, run_dir, run=None):
+        times, values = read_run(run_dir, self.metrics)
+        self.add_run(run if run is not None else os.path.basename(os.path.normpath(run_dir)), times, values)
+
+    @classmethod
+    def from_run_dirs(cls, run_dirs, metrics=calibration_metrics):
+        store = cls(metrics)
+        for run_dir in run_dirs:
+            store.ingest(run_dir)
+        return store
+
+    def _column(self, array, metric):
+        return array if metric is None else array[:, self.metric_index[metric]]
+
+    def mean(self, metric=None):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self._column(self.sum / self.count, metric)
+
+    def std(self, metric=None):
+        # Sample standard deviation over runs
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = self.sum / self.count
+            var = (self.sumsq - self.count * mean ** 2) / (self.count - 1)
+        return self._column(np.sqrt(np.maximum(var, 0)), metric)
+
+    def quantiles(self, qs, metric=None):
+        # Array [q, time, metric] (or [q, time] for one metric)
+        qs = tuple(np.atleast_1d(qs).tolist())
+        if qs not in self.quantile_cache:
+            self.quantile_cache[qs] = np.nanquantile(self.data(), qs, axis=0)
+        result = self.quantile_cache[qs]
+        return result if metric is None else result[:, :, self.metric_index[metric]]
+
+    def mean_frame(self, metrics=None):
+        # Mean over runs as a DataFrame indexed by Time, like
+        # pd.concat(per-run csvs).groupby('Time').mean()
+        metrics = self.metrics if metrics is None else metrics
+        return pd.DataFrame({m: self.mean(m) for m in metrics},
+                            index=pd.Index(self.times, name="Time"))
+
+    def final_lambdas(self):
+        # Mean cumulative lambda fraction at the last time step, summed into
+        # the H/W/C groups the calibration targets. Runs stopped early
+        # contribute the values they stopped with, i.e. this mixes final
+        # lambdas taken at different end times.
+        return {k: float(sum(self.mean(m)[-1] for m in lambda_metrics[k])) for k in lambda_metrics}
+
+    def fatality_slope(self, low_thresh=10, up_thresh=200, min_points=5):
+        # Slope of log(mean fatalities) over the window where the mean is
+        # between the thresholds. Raises TypeError with too few points above
+        # low_thresh, as Calibration.get_slope always did.
+        fatalities = self.mean("num_fatalities")
+        above = fatalities > low_thresh
+        if np.count_nonzero(above) < min_points:
+            raise TypeError("Too few fatalities")
+        window = above & (fatalities < up_thresh)
+        return np.polyfit(self.times[window], np.log(fatalities[window]), deg=1)[0]
+
+    def run_final_lambdas(self):
+        # Array [run, 3]: each run's own final_lambdas() for H, W, C
+        final = self.data()[:, -1, :]
+        return np.column_stack([sum(final[:, self.metric_index[m]] for m in lambda_metrics[k])
+                                for k in ['H', 'W', 'C']])
+
+    def run_fatality_slopes(self, low_thresh=10, up_thresh=200, min_points=5):
+        # fatality_slope() of each run on its own, NaN where it has too few
+        # fatalities
+        slopes = np.full(len(self.runs), np.nan)
+        for i, fatalities in enumerate(self.data()[:, :, self.metric_index["num_fatalities"]]):
+            above = fatalities > low_thresh
+            window = above & (fatalities < up_thresh)
+            if np.count_nonzero(above) >= min_points and np.count_nonzero(window) >= 2:
+                slopes[i] = np.polyfit(self.times[window], np.log(fatalities[window]), deg=1)[0]
+        return slopes
+
+    def bootstrap_fatality_slopes(self, n_boot, rng, low_thresh=10, up_thresh=200, min_points=5):
+        # fatality_slope() of n_boot resamples (with replacement) of the runs,
+        # NaN for resamples with too few fatalities
+        fatalities = self.data()[:, :, self.metric_index["num_fatalities"]]
+        means = fatalities[rng.integers(0, len(self.runs), size=(n_boot, len(self.runs)))].mean(axis=1)
+        slopes = np.full(n_boot, np.nan)
+        for i, mean in enumerate(means):
+            above = mean > low_thresh
+            window = above & (mean < up_thresh)
+            if np.count_nonzero(above) >= min_points and np.count_nonzero(window) >= 2:
+                slopes[i] = np.polyfit(self.times[window], np.log(mean[window]), deg=1)[0]
+        return slopes
+
+    def save(self, path):
+        tmp = f"{path}.tmp.npz"
+        np.savez(tmp, values=self.data(), times=self.times if self.times is not None else np.empty(0),
+                 metrics=np.array(self.metrics), runs=np.array(self.runs, dtype=str))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            store = cls(f["metrics"].tolist())
+            for run, values in zip(f["runs"].tolist(), f["values"]):
+                store.add_run(run, f["times"], values)
+        return store
@@ -9,13 +9,17 @@
 #from calculate_means_CPP import calculate_means
 #from calculate_r0 import calculate_r0
 import argparse
+import json
 from calibrate import calibrate
-from joblib import Parallel, delayed
 import os
 import numpy as np 
 import pandas as pd
+import sys
 import time
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cpp-simulator"))
+import executors
+
 NUM_DAYS=120
 INIT_FRAC_INFECTED=0.0001
 MEAN_INCUBATION_PERIOD=4.6
@@ -31,6 +35,9 @@ my_parser.add_argument('-c', help='target city name (in lowercase)', default="de
 my_parser.add_argument('-e', help='abs. directory path where the cpp simulator is available', default= "/mnt/lustre/rbc/rbcnidh/mysims/markov_simuls/cpp-simulator/")
 my_parser.add_argument('-i', help='input directory path, where city files are located', default="/mnt/lustre/rbc/rbcsri/cityfiles/delhi-1M/")
 my_parser.add_argument('-o', help='output base directory path', default="./2020-08-10_smaller_networks_Delhi/")
+my_parser.add_argument('-n', help='number of simulations per step', type=int, default=10)
+my_parser.add_argument('--outputs', help='time series each run writes (drive_simulator --outputs)', default="calibration")
+executors.add_executor_arguments(my_parser)
 
 args = my_parser.parse_args()
 city = (args.c).lower()
@@ -75,6 +82,19 @@ elif city=="delhi":
     LON_E=77.40
     LON_W=76.84
 
+# Bounding box and neighbourhood cell size written by CityGen, if present,
+# replace the per-city values above.
+NBR_CELL_SIZE=None
+city_metadata_file = os.path.join(input_directory, "cityMetadata.json")
+if os.path.isfile(city_metadata_file):
+    with open(city_metadata_file) as f:
+        city_metadata = json.load(f)
+    LAT_S=city_metadata["CITY_SW_LAT"]
+    LAT_N=city_metadata["CITY_NE_LAT"]
+    LON_W=city_metadata["CITY_SW_LON"]
+    LON_E=city_metadata["CITY_NE_LON"]
+    NBR_CELL_SIZE=city_metadata["NBR_CELL_SIZE"]
+
 BETA_SCALE= 9.0
 BETA_RANDOM_COMMUNITY = BETA_NBR_CELLS
 BETA_W = BETA_PROJECT/BETA_SCALE 
@@ -145,7 +165,7 @@ def calculate_means_lambda_CPP(output_directory_base, num_sims,results_dir):
         df_mean = master_df.groupby(['timestep']).mean()
         df_mean.to_csv(results_dir+val+'_mean.csv')
 
-def run_sim(num_sims_count, params):
+def sim_task(num_sims_count, params):
     print("Internal loop. Loop count = ", num_sims_count)
     output_directory=params['outputDirectoryBase']+"/""intervention_"+ str(params['intervention'])+"_"+str(num_sims_count)
 
@@ -186,20 +206,23 @@ def run_sim(num_sims_count, params):
     command+=" --DAYS_BEFORE_LOCKDOWN " + str(params['daysBeforeLockdown'])
     command+=" --ENABLE_NBR_CELLS "
     command+=f"--CITY_SW_LAT {LAT_S} --CITY_NE_LAT {LAT_N} --CITY_SW_LON {LON_W} --CITY_NE_LON {LON_E} "
+    if NBR_CELL_SIZE is not None:
+        command+=f"--NBR_CELL_SIZE {NBR_CELL_SIZE} "
     command+=" --IGNORE_ATTENDANCE_FILE"
+    command+=" --outputs " + args.outputs
     #command+=" --USE_AGE_DEPENDENT_MIXING"
     print(command)
 
-    os.system(command)
-
-    return (True)
+    # Same command without the leading "time"
+    return executors.Task(command.split()[1:], output_directory, replicate=num_sims_count)
 
 ###########################
 continue_run = True
 resolution = 4
-num_sims = 10 #cpu_count()/2
+num_sims = args.n #cpu_count()/2
 count = 0
 num_cores = num_sims #cpu_count()
+executor = executors.executor_from_args(args, num_cores)
 
 print ('Cpu count: ', num_cores)
 
@@ -220,7 +243,8 @@ while (continue_run):
     print ('Parameters: ', params)    
     
     start_time = time.time()
-    processed_list = Parallel(n_jobs=num_cores)(delayed(run_sim)(simNum, params) for simNum in range(num_sims))     
+    returncodes = executor.run([sim_task(simNum, params) for simNum in range(num_sims)])
+    assert all(r == 0 for r in returncodes), f"simulations failed after retries: return codes {returncodes}"
     print ('Execution time: ',time.time()-start_time, ' seconds') 
 
     ##############################################################
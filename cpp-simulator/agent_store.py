@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Reads and writes the agent state checkpoints (agentStore.pbstore, the
+# cohorts.AgentStore message of agents_store.proto) that drive_simulator
+# writes with STORE_STATE_TIME_STEP and loads with LOAD_STATE_TIME_STEP
+# (builds with -DENABLE_PROTO), as NumPy columns, one entry per agent in
+# the order of individuals.json.
+#
+# Every field of the message is a varint (the nested TestStatus too), so a
+# store is a stream of varints, and storeAgentsInfo writes the same 34 of
+# them for each agent: (tag, length) of the agent, (tag, value) for
+# fields 1-6, (tag, length) of test_status and its 7 fields, and fields
+# 8-9. The file is decoded (and encoded) for all agents at once with NumPy,
+# in chunks, rather than message by message; the tags are checked against
+# that layout.
+#
+# Note that the simulator keeps time_of_infection as a double but stores
+# it as an int32 (time steps), so it comes back truncated.
+#
+#   python agent_store.py summary output/agentStore.pbstore --input_directory city/
+#   python agent_store.py export output/agentStore.pbstore -o agents.npz
+#   python agent_store.py seed output/agentStore.pbstore seeded.pbstore -n 100 --time_step 40
+#
+#   store = AgentStore.read("output/agentStore.pbstore")
+#   store.counts(by=read_wards("city/"))       # infection states by ward
+#   infected = store["infection_status"] > 0
+#   store.seed(np.flatnonzero(~infected)[:10], time_step=40)
+#   store.write("seeded.pbstore")
+
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+progression = ["susceptible", "exposed", "infective", "symptomatic", "recovered", "hospitalised", "critical", "dead"]
+disease_label = ["asymptomatic", "primary_contact", "mild_symptomatic_tested", "moderate_symptomatic_tested",
+                 "severe_symptomatic_tested", "icu", "recovered", "dead"]
+test_result = ["not_yet_tested", "positive", "negative"]
+test_trigger = ["not_yet_requested", "symptomatic", "hospitalised", "contact_traced", "re_test"]
+
+# Columns in file order: (name, dtype, field number), for AgentElement and
+# then TestStatus (field 7 of AgentElement)
+agent_fields = [("infection_status", np.int32, 1),
+                ("entered_symptomatic_state", bool, 2),
+                ("entered_hospitalised_state", bool, 3),
+                ("state_before_recovery", np.int32, 4),
+                ("infective", bool, 5),
+                ("disease_label", np.int32, 6)]
+test_fields = [("tested_epoch", np.int32, 1),
+               ("tested_positive", bool, 2),
+               ("contact_traced_epoch", np.int32, 3),
+               ("test_requested", bool, 4),
+               ("test_state", np.int32, 5),
+               ("triggered_contact_trace", bool, 6),
+               ("node_test_trigger", np.int32, 7)]
+late_fields = [("time_of_infection", np.int32, 8),
+               ("time_became_infective", np.int32, 9)]
+labels = {"infection_status": progression, "state_before_recovery": progression,
+          "disease_label": disease_label, "test_state": test_result, "node_test_trigger": test_trigger}
+
+varint, length_delimited = 0, 2
+
+
+def _layout():
+    # Expected tag at every even token of an agent, and the token holding
+    # each column
+    tags, columns = [1 << 3 | length_delimited], {}
+    for name, _, number in agent_fields:
+        columns[name] = 2 * len(tags) + 1
+        tags.append(number << 3 | varint)
+    tags.append(7 << 3 | length_delimited)
+    for name, _, number in test_fields:
+        columns[name] = 2 * len(tags) + 1
+        tags.append(number << 3 | varint)
+    for name, _, number in late_fields:
+        columns[name] = 2 * len(tags) + 1
+        tags.append(number << 3 | varint)
+    return np.array(tags, dtype=np.int32), columns
+
+
+tags, column_tokens = _layout()
+tokens_per_agent = 2 * len(tags)
+test_tokens = slice(2 * (len(agent_fields) + 2), 2 * (len(agent_fields) + 2 + len(test_fields)))
+dtypes = {name: dtype for name, dtype, _ in agent_fields + test_fields + late_fields}
+
+
+def decode_varints(buf):
+    # All the varints in buf (uint8, ending on a complete varint), as the
+    # int32 fields they hold: the low 32 bits, in the first five bytes (a
+    # negative int32 is sign extended to a 10 byte varint). Most varints are
+    # one byte, so later bytes are only visited for the varints that have
+    # them.
+    ends = np.flatnonzero(buf < 0x80)
+    starts = np.empty_like(ends)
+    starts[:1] = 0
+    starts[1:] = ends[:-1] + 1
+    values = (buf[starts] & 0x7f).astype(np.uint32)
+    longer = np.flatnonzero(ends > starts)
+    for k in range(1, 5):
+        if not longer.size:
+            break
+        at = starts[longer] + k
+        values[longer] |= (buf[at] & 0x7f).astype(np.uint32) << np.uint32(7 * k)
+        longer = longer[ends[longer] > at]
+    assert (ends[longer] - starts[longer]).max(initial=0) < 10, "agent store: varint longer than 10 bytes"
+    return values.view(np.int32)
+
+
+def varint_sizes(values):
+    # Bytes of each int32 value (int64 array) as a varint
+    _, bits = np.frexp(values.astype(np.float64))
+    return np.where(values < 0, 10, np.maximum(1, (bits + 6) // 7))
+
+
+def encode_varints(values, sizes):
+    # values: int64 array of int32 fields (sign extended as on the wire),
+    # sizes: their varint_sizes. The first byte of every varint is written
+    # at once, the later ones only for the varints that have them.
+    values, sizes = values.ravel(), sizes.ravel()
+    ends = np.cumsum(sizes)
+    out = np.empty(int(ends[-1]) if ends.size else 0, dtype=np.uint8)
+    out[ends - sizes] = (values & 0x7f).astype(np.uint8) | ((sizes > 1).astype(np.uint8) << 7)
+    longer = np.flatnonzero(sizes > 1)
+    wire, sizes, at = values[longer].view(np.uint64), sizes[longer], ends[longer] - sizes[longer]
+    for k in range(1, 10):
+        more = sizes > k + 1
+        out[at + k] = ((wire >> np.uint64(7 * k)) & np.uint64(0x7f)).astype(np.uint8) | (more.astype(np.uint8) << 7)
+        wire, sizes, at = wire[more], sizes[more], at[more]
+    return out
+
+
+class AgentStore:
+
+    def __init__(self, columns):
+        self.columns = {name: np.asarray(columns[name], dtype=dtypes[name]) for name in dtypes}
+        sizes = {len(v) for v in self.columns.values()}
+        assert len(sizes) == 1, "agent store: columns of different lengths"
+
+    def __len__(self):
+        return len(self.columns["infection_status"])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __setitem__(self, name, values):
+        self.columns[name][:] = values
+
+    @classmethod
+    def read(cls, path, chunk_bytes=1 << 24):
+        # Streams the file chunk by chunk; only the columns are kept
+        parts = {name: [] for name in dtypes}
+        carry = np.zeros(0, dtype=np.int32)
+        with open(path, "rb") as f:
+            tail = b""
+            while True:
+                block = f.read(chunk_bytes)
+                data = np.frombuffer(tail + block, dtype=np.uint8)
+                if data.size == 0:
+                    break
+                # Cut after the last complete varint; the rest goes with the
+                # next block
+                complete = np.flatnonzero(data < 0x80)
+                cut = complete[-1] + 1 if complete.size else 0
+                if not block:
+                    assert cut == data.size, f"{path}: truncated varint at the end"
+                tail = data[cut:].tobytes()
+                tokens = np.concatenate((carry, decode_varints(data[:cut])))
+                n = len(tokens) // tokens_per_agent
+                carry = tokens[n * tokens_per_agent:]
+                agents = tokens[:n * tokens_per_agent].reshape(n, tokens_per_agent)
+                bad = np.flatnonzero((agents[:, 0::2] != tags).any(axis=1))
+                assert bad.size == 0, (f"{path}: agent {sum(len(p) for p in parts['infective']) + bad[0]} "
+                                       "does not have the layout written by storeAgentsInfo")
+                for name, token in column_tokens.items():
+                    column = agents[:, token]
+                    parts[name].append(column != 0 if dtypes[name] is bool else column)
+                if not block:
+                    break
+        assert carry.size == 0, f"{path}: incomplete last agent"
+        return cls({name: np.concatenate(p) if p else np.zeros(0, dtypes[name]) for name, p in parts.items()})
+
+    def write(self, path, chunk_agents=1 << 18):
+        # Same bytes as storeAgentsInfo for the same state
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            for start in range(0, len(self), chunk_agents):
+                rows = slice(start, start + chunk_agents)
+                n = len(self.columns["infective"][rows])
+                agents = np.empty((n, tokens_per_agent), dtype=np.int64)
+                agents[:, 0::2] = tags
+                for name, token in column_tokens.items():
+                    agents[:, token] = self.columns[name][rows]
+                # Lengths of test_status and of the agent
+                sizes = varint_sizes(agents)
+                agents[:, test_tokens.start - 1] = sizes[:, test_tokens].sum(axis=1)
+                sizes[:, test_tokens.start - 1] = varint_sizes(agents[:, test_tokens.start - 1])
+                agents[:, 1] = sizes[:, 2:].sum(axis=1)
+                sizes[:, 1] = varint_sizes(agents[:, 1])
+                f.write(encode_varints(agents, sizes).tobytes())
+        os.replace(tmp, path)
+
+    def to_dataframe(self, named=True):
+        # One row per agent; enum columns as categoricals of their names
+        data = pd.DataFrame(self.columns)
+        if named:
+            for name, names in labels.items():
+                data[name] = pd.Categorical.from_codes(self.columns[name], names)
+        return data
+
+    def to_npz(self, path):
+        np.savez_compressed(path, **self.columns)
+
+    def counts(self, column="infection_status", by=None):
+        # Number of agents in each state of column, overall (a Series) or per
+        # group (by: a label per agent, e.g. read_wards(); a DataFrame)
+        codes = self.columns[column].astype(np.int64)
+        names = labels.get(column)
+        states = np.arange(len(names)) if names else np.unique(codes)
+        state_index = np.searchsorted(states, codes)
+        groups, group_index = np.unique(np.zeros(len(codes), dtype=int) if by is None else np.asarray(by),
+                                        return_inverse=True)
+        table = np.bincount(group_index * len(states) + state_index, minlength=len(groups) * len(states))
+        table = pd.DataFrame(table.reshape(len(groups), len(states)), index=groups,
+                             columns=names if names else states)
+        return table.iloc[0].rename(column) if by is None else table
+
+    def seed(self, agents, time_step):
+        # Infect the given agents at time_step as the simulator's initial
+        # seeding does: exposed, with time_of_infection set
+        agents = np.asarray(agents)
+        self.columns["infection_status"][agents] = progression.index("exposed")
+        self.columns["time_of_infection"][agents] = time_step
+        self.columns["infective"][agents] = False
+
+
+def read_wards(input_directory):
+    # Home ward (wardIndex) of every agent, in the order of the store
+    with open(os.path.join(input_directory, "individuals.json"), "r") as f:
+        return np.array([person["wardIndex"] for person in json.load(f)])
+
+
+def main():
+    my_parser = argparse.ArgumentParser(description='Inspect or edit an agentStore.pbstore checkpoint')
+    sub = my_parser.add_subparsers(dest='command', required=True)
+    summary = sub.add_parser('summary', help='agents in each state, optionally by ward')
+    summary.add_argument('store')
+    summary.add_argument('--column', default='infection_status', choices=list(dtypes))
+    summary.add_argument('--input_directory', help='city folder, to count by ward', default=None)
+    export = sub.add_parser('export', help='columns to .npz, .csv or .parquet')
+    export.add_argument('store')
+    export.add_argument('-o', required=True)
+    seed = sub.add_parser('seed', help='expose randomly chosen susceptible agents')
+    seed.add_argument('store')
+    seed.add_argument('output')
+    seed.add_argument('-n', type=int, required=True, help='number of agents to expose')
+    seed.add_argument('--time_step', type=int, required=True, help='time of infection (the LOAD_STATE_TIME_STEP)')
+    seed.add_argument('--ward', type=int, default=None, help='only agents of this ward (needs --input_directory)')
+    seed.add_argument('--input_directory', default=None)
+    seed.add_argument('--rng_seed', type=int, default=0)
+    args = my_parser.parse_args()
+
+    store = AgentStore.read(args.store)
+    if args.command == 'summary':
+        by = read_wards(args.input_directory) if args.input_directory else None
+        print(f"{len(store)} agents")
+        print(store.counts(args.column, by).to_string())
+    elif args.command == 'export':
+        if args.o.endswith('.npz'):
+            store.to_npz(args.o)
+        elif args.o.endswith('.parquet'):
+            store.to_dataframe().to_parquet(args.o)
+        else:
+            store.to_dataframe().to_csv(args.o, index_label='agent')
+        print(f"Wrote {len(store)} agents to {args.o}")
+    elif args.command == 'seed':
+        candidates = store["infection_status"] == progression.index("susceptible")
+        if args.ward is not None:
+            assert args.input_directory, "--ward needs --input_directory"
+            candidates &= read_wards(args.input_directory) == args.ward
+        candidates = np.flatnonzero(candidates)
+        assert len(candidates) >= args.n, f"only {len(candidates)} susceptible agents to seed"
+        chosen = np.random.default_rng(args.rng_seed).choice(candidates, args.n, replace=False)
+        store.seed(chosen, args.time_step)
+        store.write(args.output)
+        print(f"Exposed {args.n} agents at time step {args.time_step}; wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
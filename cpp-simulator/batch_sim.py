@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Persistent drive_simulator processes for the launchers (used by
+# run_cache.cached_run, so every launcher and executor gets them).
+#
+# drive_simulator --batch - reads one run configuration per line on stdin,
+# {"args": [...], "stdout": FILE, "stderr": FILE}, runs them one after the
+# other in the same process and answers each with a line
+#   batch: {"run": N, "status": S, "output_directory": ..., "seconds": ...}
+# The process start-up is paid once. With DRIVE_SIM_BATCH_CACHE_MB=N in the
+# environment, each process also keeps up to N MB of parsed input files from
+# one run to the next (drive_simulator --batch_cache_mb); this is off by
+# default, as a parsed city takes several times its size in memory in every
+# process.
+#
+# run(cmd, **kwargs) is a drop-in for subprocess.run(cmd, **kwargs): it
+# hands the run to an idle simulator process for (binary, cwd), starting
+# one if there is none, so a pool of n threads keeps n processes busy.
+# stdout/stderr may be None, DEVNULL or an open file; timeout kills the
+# process and raises subprocess.TimeoutExpired. Anything else (pipes, env,
+# a binary built without --batch), or DRIVE_SIM_BATCH=0 in the
+# environment, falls back to subprocess.run. A process that dies (assert,
+# crash) fails its run and is replaced on the next one.
+
+import atexit
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+
+batch_env = "DRIVE_SIM_BATCH"
+cache_mb_env = "DRIVE_SIM_BATCH_CACHE_MB"
+marker = "batch: "
+supported_kwargs = {"stdout", "stderr", "timeout", "cwd"}
+
+_lock = threading.Lock()
+_idle = {}     # (binary, cwd) -> [BatchProcess]
+_started = []  # every BatchProcess, closed at exit
+_supports = {} # binary -> bool
+
+
+def batch_enabled():
+    return os.environ.get(batch_env, "1") not in ("0", "no", "false", "")
+
+
+def supports_batch(binary):
+    # Builds before batch mode do not list the option
+    with _lock:
+        if binary not in _supports:
+            try:
+                out = subprocess.run([binary, "--help"], stdout=subprocess.PIPE,
+                                     stderr=subprocess.DEVNULL, text=True, timeout=30).stdout
+                _supports[binary] = "--batch" in out
+            except (OSError, subprocess.SubprocessError):
+                _supports[binary] = False
+        return _supports[binary]
+
+
+def output_target(stream):
+    # File name for a run's stdout/stderr, "" to leave it alone, or None if
+    # it cannot be handed to the simulator
+    if stream is None:
+        return ""
+    if stream == subprocess.DEVNULL:
+        return os.devnull
+    name = getattr(stream, "name", None)
+    if isinstance(name, str) and os.path.exists(name):
+        stream.flush()
+        return os.path.abspath(name)
+    return None
+
+
+class BatchProcess:
+
+    def __init__(self, binary, cwd):
+        self.binary = binary
+        cmd = [binary, "--batch", "-"]
+        cache_mb = int(os.environ.get(cache_mb_env, "0") or 0)
+        if cache_mb > 0:
+            cmd += ["--batch_cache_mb", str(cache_mb)]
+        self.proc = subprocess.Popen(cmd, cwd=cwd, stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, text=True, bufsize=1)
+        self.lines = queue.Queue()
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
+
+    def _read(self):
+        for line in self.proc.stdout:
+            self.lines.put(line)
+        self.lines.put(None)
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def run(self, args, stdout="", stderr="", timeout=None):
+        # Returns the run's status, or the process's return code if it died
+        request = {"args": args}
+        if stdout:
+            request["stdout"] = stdout
+        if stderr:
+            request["stderr"] = stderr
+        try:
+            self.proc.stdin.write(json.dumps(request) + "\n")
+            self.proc.stdin.flush()
+        except (BrokenPipeError, OSError):
+            return self.proc.wait() or 1
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            try:
+                if remaining is not None and remaining <= 0:
+                    raise queue.Empty
+                line = self.lines.get(timeout=remaining)
+            except queue.Empty:
+                self.close(kill=True)
+                raise subprocess.TimeoutExpired([self.binary] + args, timeout)
+            if line is None:
+                return self.proc.wait() or 1
+            # Output of a run whose stdout was not redirected, which need
+            # not end with a newline before the status line
+            at = line.find(marker + "{")
+            sys.stdout.write(line if at < 0 else line[:at])
+            sys.stdout.flush()
+            if at >= 0:
+                return json.loads(line[at + len(marker):])["status"]
+
+    def close(self, kill=False):
+        if self.proc.poll() is None:
+            if kill:
+                self.proc.kill()
+            else:
+                self.proc.stdin.close()
+            try:
+                self.proc.wait(timeout=None if kill else 10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+
+
+def acquire(binary, cwd):
+    with _lock:
+        pool = _idle.setdefault((binary, cwd), [])
+        while pool:
+            process = pool.pop()
+            if process.alive():
+                return process
+    process = BatchProcess(binary, cwd)
+    with _lock:
+        _started.append(process)
+    return process
+
+
+def release(process, cwd):
+    if process.alive():
+        with _lock:
+            _idle.setdefault((process.binary, cwd), []).append(process)
+
+
+@atexit.register
+def close_all():
+    with _lock:
+        processes = list(_started)
+        _started.clear()
+        _idle.clear()
+    for process in processes:
+        process.close()
+
+
+def run(cmd, **kwargs):
+    cmd = [str(c) for c in cmd]
+    cwd = os.path.abspath(kwargs.get("cwd") or os.getcwd())
+    binary = os.path.join(cwd, cmd[0]) if os.sep in cmd[0] else cmd[0]
+    stdout = output_target(kwargs.get("stdout"))
+    stderr = output_target(kwargs.get("stderr"))
+    if (not batch_enabled() or set(kwargs) - supported_kwargs or stdout is None or stderr is None
+            or not supports_batch(binary)):
+        return subprocess.run(cmd, **kwargs)
+    process = acquire(binary, cwd)
+    status = process.run(cmd[1:], stdout, stderr, kwargs.get("timeout"))
+    release(process, cwd)
+    return subprocess.CompletedProcess(cmd, status)
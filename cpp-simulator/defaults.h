@@ -78,6 +78,11 @@ struct defaults{
   std::string LOAD_STATE_TIME_STEP = "0";
   std::string ONE_OFF_TRAVELERS_RATIO = "0";
   std::string agent_load_file = "agentStore.pbstore";
+  std::string STOP_FATALITIES = "0";
+  std::string STOP_LAMBDA_TOLERANCE = "0";
+  std::string output_format = "csv";
+  std::string outputs = "full";
+  std::string batch_cache_mb = "0";
 } DEFAULTS;
 
 #endif
@@ -8,7 +8,351 @@
 #include <iostream>
 #include <fstream>
 #include <string>
+#include <vector>
+#include <chrono>
+#include <stdexcept>
+#include <cstdio>
+#include <new>
+#include <memory>
+#include <fcntl.h>
+#include <unistd.h>
 #include <cxxopts.hpp>
+#include <rapidjson/document.h>
+#include <rapidjson/writer.h>
+#include <rapidjson/stringbuffer.h>
+
+//Sets GLOBAL from the parsed options
+void save_options(cxxopts::ParseResult& optvals){
+  GLOBAL.SEED_HD_AREA_POPULATION = optvals["SEED_HD_AREA_POPULATION"].count();
+  GLOBAL.SEED_ONLY_NON_COMMUTER = optvals["SEED_ONLY_NON_COMMUTER"].count();
+  GLOBAL.SEED_FIXED_NUMBER = optvals["SEED_FIXED_NUMBER"].count();
+  GLOBAL.NUM_DAYS = optvals["NUM_DAYS"].as<count_type>();
+  GLOBAL.INIT_FRAC_INFECTED = optvals["INIT_FRAC_INFECTED"].as<double>();
+  GLOBAL.INIT_FIXED_NUMBER_INFECTED = optvals["INIT_FIXED_NUMBER_INFECTED"].as<count_type>();
+  GLOBAL.MEAN_INCUBATION_PERIOD = optvals["MEAN_INCUBATION_PERIOD"].as<double>();
+  GLOBAL.MEAN_ASYMPTOMATIC_PERIOD = optvals["MEAN_ASYMPTOMATIC_PERIOD"].as<double>();
+  GLOBAL.MEAN_SYMPTOMATIC_PERIOD = optvals["MEAN_SYMPTOMATIC_PERIOD"].as<double>();
+  GLOBAL.SYMPTOMATIC_FRACTION = optvals["SYMPTOMATIC_FRACTION"].as<double>();
+  GLOBAL.MEAN_HOSPITAL_REGULAR_PERIOD = optvals["MEAN_HOSPITAL_REGULAR_PERIOD"].as<double>();
+  GLOBAL.MEAN_HOSPITAL_CRITICAL_PERIOD = optvals["MEAN_HOSPITAL_CRITICAL_PERIOD"].as<double>();
+  GLOBAL.COMPLIANCE_PROBABILITY = optvals["COMPLIANCE_PROBABILITY"].as<double>();
+  if(optvals["HD_COMPLIANCE_PROBABILITY"].count()){
+	  GLOBAL.HD_COMPLIANCE_PROBABILITY = optvals["HD_COMPLIANCE_PROBABILITY"].as<double>();
+  } else {
+	//If HD_COMPLIANCE_PROBABILITY is not provided then set it equal to whatever
+	//value was provided for COMPLIANCE_PROBABILITY
+	GLOBAL.HD_COMPLIANCE_PROBABILITY = GLOBAL.COMPLIANCE_PROBABILITY;
+  }
+  GLOBAL.F_KERNEL_A = optvals["F_KERNEL_A"].as<double>();
+  GLOBAL.F_KERNEL_B = optvals["F_KERNEL_B"].as<double>();
+
+  GLOBAL.BETA_H = optvals["BETA_H"].as<double>();
+  GLOBAL.BETA_W = optvals["BETA_W"].as<double>();
+  GLOBAL.BETA_C = optvals["BETA_C"].as<double>();
+  GLOBAL.BETA_S = optvals["BETA_S"].as<double>();
+  GLOBAL.BETA_TRAVEL = optvals["BETA_TRAVEL"].as<double>();
+  GLOBAL.BETA_CLASS = optvals["BETA_CLASS"].as<double>();
+  GLOBAL.BETA_PROJECT = optvals["BETA_PROJECT"].as<double>();
+  GLOBAL.BETA_RANDOM_COMMUNITY = optvals["BETA_RANDOM_COMMUNITY"].as<double>();
+  GLOBAL.BETA_NBR_CELLS = optvals["BETA_NBR_CELLS"].as<double>();
+
+  GLOBAL.HD_AREA_FACTOR = optvals["HD_AREA_FACTOR"].as<double>();
+  GLOBAL.HD_AREA_EXPONENT = optvals["HD_AREA_EXPONENT"].as<double>();
+
+  GLOBAL.INTERVENTION
+	= static_cast<Intervention>(optvals["INTERVENTION"].as<count_type>());
+  GLOBAL.intervention_filename = optvals["intervention_filename"].as<std::string>();
+
+  GLOBAL.CALIBRATION_DELAY = optvals["CALIBRATION_DELAY"].as<double>();
+  GLOBAL.DAYS_BEFORE_LOCKDOWN = optvals["DAYS_BEFORE_LOCKDOWN"].as<double>();
+  GLOBAL.NUM_DAYS_BEFORE_INTERVENTIONS = GLOBAL.CALIBRATION_DELAY + GLOBAL.DAYS_BEFORE_LOCKDOWN;
+
+  GLOBAL.FIRST_PERIOD = optvals["FIRST_PERIOD"].as<double>();
+  GLOBAL.SECOND_PERIOD = optvals["SECOND_PERIOD"].as<double>();
+  GLOBAL.THIRD_PERIOD = optvals["THIRD_PERIOD"].as<double>();
+  GLOBAL.OE_SECOND_PERIOD = optvals["OE_SECOND_PERIOD"].as<double>();
+
+  GLOBAL.CYCLIC_POLICY_TYPE
+	= static_cast<Cycle_Type>(optvals["CYCLIC_POLICY_TYPE"].as<count_type>());
+  GLOBAL.CYCLIC_POLICY_START_DAY = GLOBAL.NUM_DAYS_BEFORE_INTERVENTIONS +
+	GLOBAL.FIRST_PERIOD + GLOBAL.SECOND_PERIOD;
+
+  std::string output_dir(optvals["output_directory"].as<std::string>());
+  GLOBAL.output_path = output_dir;
+
+  GLOBAL.input_base = optvals["input_directory"].as<std::string>();
+  if(optvals["attendance_filename"].count()){
+    GLOBAL.attendance_filename = optvals["attendance_filename"].as<std::string>();
+    GLOBAL.IGNORE_ATTENDANCE_FILE = false;
+  }
+  //GLOBAL.IGNORE_ATTENDANCE_FILE = optvals["IGNORE_ATTENDANCE_FILE"].count();
+
+  GLOBAL.USE_AGE_DEPENDENT_MIXING = optvals["USE_AGE_DEPENDENT_MIXING"].count();
+  GLOBAL.SIGNIFICANT_EIGEN_VALUES = optvals["SIGNIFICANT_EIGEN_VALUES"].as<double>();
+  GLOBAL.NUM_AGE_GROUPS = optvals["NUM_AGE_GROUPS"].as<count_type>();
+
+  if(optvals["PROVIDE_INITIAL_SEED"].count()){
+	//Initial seed was provided
+	SEED_RNG_PROVIDED_SEED(optvals["PROVIDE_INITIAL_SEED"].as<count_type>());
+  } else {
+	SEED_RNG(); //No Initial seed was provided
+  }
+  if(optvals["PROVIDE_INITIAL_SEED_GRAPH"].count()){
+	//Initial seed was provided
+	SEED_RNG_GRAPH_PROVIDED_SEED(optvals["PROVIDE_INITIAL_SEED_GRAPH"].as<count_type>());
+  } else {
+	SEED_RNG_GRAPH(); //No Initial seed was provided
+  }
+
+  GLOBAL.LOCKED_COMMUNITY_LEAKAGE = optvals["LOCKED_COMMUNITY_LEAKAGE"].as<double>();
+  GLOBAL.COMMUNITY_LOCK_THRESHOLD = optvals["COMMUNITY_LOCK_THRESHOLD"].as<double>();
+  GLOBAL.LOCKED_NEIGHBORHOOD_LEAKAGE = optvals["LOCKED_NEIGHBORHOOD_LEAKAGE"].as<double>();
+  GLOBAL.NEIGHBORHOOD_LOCK_THRESHOLD = optvals["NEIGHBORHOOD_LOCK_THRESHOLD"].as<double>();
+
+  //Compute parametrs based on options
+  GLOBAL.NUM_TIMESTEPS = GLOBAL.NUM_DAYS*GLOBAL.SIM_STEPS_PER_DAY;
+  GLOBAL.INCUBATION_PERIOD_SCALE = GLOBAL.MEAN_INCUBATION_PERIOD*GLOBAL.SIM_STEPS_PER_DAY / GLOBAL.INCUBATION_PERIOD_SHAPE;
+
+  GLOBAL.ASYMPTOMATIC_PERIOD = GLOBAL.MEAN_ASYMPTOMATIC_PERIOD*GLOBAL.SIM_STEPS_PER_DAY;
+  GLOBAL.SYMPTOMATIC_PERIOD = GLOBAL.MEAN_SYMPTOMATIC_PERIOD*GLOBAL.SIM_STEPS_PER_DAY;
+  GLOBAL.HOSPITAL_REGULAR_PERIOD = GLOBAL.MEAN_HOSPITAL_REGULAR_PERIOD*GLOBAL.SIM_STEPS_PER_DAY;
+  GLOBAL.HOSPITAL_CRITICAL_PERIOD = GLOBAL.MEAN_HOSPITAL_CRITICAL_PERIOD*GLOBAL.SIM_STEPS_PER_DAY;
+
+  GLOBAL.MASK_ACTIVE = optvals["MASK_ACTIVE"].count();
+  if(GLOBAL.MASK_ACTIVE){
+    GLOBAL.MASK_FACTOR = optvals["MASK_FACTOR"].as<double>();
+  }
+
+  GLOBAL.MASK_START_DATE = GLOBAL.CALIBRATION_DELAY + optvals["MASK_START_DELAY"].as<double>(); //masks starts from April 9
+
+  //initialise city bounding box co-ordinates with Bangalore values. Will read from file later.
+  GLOBAL.city_SW.lat = optvals["CITY_SW_LAT"].as<double>();
+  GLOBAL.city_SW.lon = optvals["CITY_SW_LON"].as<double>();
+  GLOBAL.city_NE.lat = optvals["CITY_NE_LAT"].as<double>();
+  GLOBAL.city_NE.lon = optvals["CITY_NE_LON"].as<double>();
+  GLOBAL.NBR_CELL_SIZE = optvals["NBR_CELL_SIZE"].as<double>();
+  GLOBAL.ENABLE_CONTAINMENT = optvals["ENABLE_CONTAINMENT"].count();
+  GLOBAL.ENABLE_NBR_CELLS = optvals["ENABLE_NBR_CELLS"].count();
+  if(GLOBAL.ENABLE_NBR_CELLS){
+	GLOBAL.ENABLE_NEIGHBORHOOD_SOFT_CONTAINMENT = optvals["ENABLE_NEIGHBORHOOD_SOFT_CONTAINMENT"].count();
+  } else {
+	GLOBAL.ENABLE_NEIGHBORHOOD_SOFT_CONTAINMENT = false;
+  }
+  GLOBAL.WARD_CONTAINMENT_THRESHOLD = optvals["WARD_CONTAINMENT_THRESHOLD"].as<count_type>();
+
+  GLOBAL.ENABLE_TESTING = optvals["ENABLE_TESTING"].count();
+  GLOBAL.ENABLE_NBR_CELLS = GLOBAL.ENABLE_NBR_CELLS || GLOBAL.ENABLE_CONTAINMENT;
+
+  GLOBAL.TESTING_PROTOCOL
+	= static_cast<Testing_Protocol>(optvals["TESTING_PROTOCOL"].as<count_type>());
+  GLOBAL.testing_protocol_filename = optvals["testing_protocol_filename"].as<std::string>();
+
+  GLOBAL.agent_load_file = optvals["agent_load_file"].as<std::string>();
+
+  if(GLOBAL.input_base != ""
+	 && GLOBAL.input_base[GLOBAL.input_base.size() - 1] != '/'){
+	GLOBAL.input_base += '/';
+	//Make sure the path of the input_base
+	//directory is terminated by a "/"
+  }
+
+  //settings for cohorts
+ GLOBAL.ENABLE_COHORTS = optvals["ENABLE_COHORTS"].count();
+ GLOBAL.ISOLATE_COHORTS = optvals["ISOLATE_COHORTS"].count();
+ GLOBAL.BETA_COHORT = optvals["BETA_COHORT"].as<double>();
+ GLOBAL.crowding_factor = optvals["CROWDING_FACTOR_COHORTS"].as<double>();
+ GLOBAL.taking_train_fraction = optvals["FRACTION_IN_TRAINS_COHORTS"].as<double>();
+ GLOBAL.COHORT_SIZE = optvals["COHORT_SIZE"].as<double>();
+ GLOBAL.COHORT_SEVERITY_FRACTION = optvals["COHORT_SEVERITY_FRACTION"].as<double>();
+ GLOBAL.COHORT_STRATEGY = static_cast<cohort_strategy>(optvals["COHORT_STRATEGY"].as<count_type>());
+ GLOBAL.ONE_OFF_TRAVELERS_RATIO = optvals["ONE_OFF_TRAVELERS_RATIO"].as<double>();
+ 
+//  std::cout<<"GLOBAL.ENABLE_COHORTS" << GLOBAL.ENABLE_COHORTS << std::endl;
+
+// store or load state.
+ GLOBAL.STORE_STATE_TIME_STEP = optvals["STORE_STATE_TIME_STEP"].as<count_type>();
+ GLOBAL.LOAD_STATE_TIME_STEP = optvals["LOAD_STATE_TIME_STEP"].as<count_type>();
+
+  GLOBAL.STOP_FATALITIES = optvals["STOP_FATALITIES"].as<count_type>();
+  GLOBAL.STOP_LAMBDA_TOLERANCE = optvals["STOP_LAMBDA_TOLERANCE"].as<double>();
+
+  auto output_format = optvals["output_format"].as<std::string>();
+  if(output_format != "csv" && output_format != "npz" && output_format != "both"){
+	throw std::invalid_argument("output_format must be csv, npz or both, not " + output_format);
+  }
+  GLOBAL.OUTPUT_CSV = (output_format != "npz");
+  GLOBAL.OUTPUT_NPZ = (output_format != "csv");
+  set_output_selection(optvals["outputs"].as<std::string>());
+}
+
+void run(const std::string& output_dir){
+  //Initialize the attendance probability
+  initialize_office_attendance();
+
+  //Initialize output folders
+  std::unique_ptr<gnuplot> plots;
+  if(GLOBAL.OUTPUT_CSV && GLOBAL.OUTPUT_PLOTS){
+	plots.reset(new gnuplot(output_dir));
+  }
+
+  //Run simulations
+  auto plot_data = run_simulation();
+
+  //Start output
+  output_global_params(output_dir);
+
+  if(GLOBAL.OUTPUT_CSV){
+	output_csv_files(output_dir, plots.get(), plot_data);
+  }
+  if(GLOBAL.OUTPUT_NPZ){
+	output_npz_file(output_dir, plot_data);
+  }
+  output_manifest(output_dir, plot_data);
+}
+
+//Command line arguments for one line of a batch file
+std::vector<std::string> batch_line_args(const rapidjson::Document& line){
+  std::vector<std::string> args;
+  if(line.HasMember("args")){
+	for(const auto& arg: line["args"].GetArray()){
+	  args.push_back(arg.GetString());
+	}
+	return args;
+  }
+  for(const auto& member: line.GetObject()){
+	std::string key = member.name.GetString();
+	const auto& value = member.value;
+	if(key == "stdout" || key == "stderr" || (value.IsBool() && !value.GetBool())){
+	  continue;
+	}
+	args.push_back("--" + key);
+	if(value.IsString()){
+	  args.push_back(value.GetString());
+	} else if(!value.IsBool()){
+	  rapidjson::StringBuffer buffer;
+	  rapidjson::Writer<rapidjson::StringBuffer> writer(buffer);
+	  value.Accept(writer);
+	  args.push_back(buffer.GetString());
+	}
+  }
+  return args;
+}
+
+//Sends file descriptor fd (1: stdout, 2: stderr) to filename
+void redirect_output(int fd, const std::string& filename){
+  int file = open(filename.c_str(), O_WRONLY | O_CREAT | O_TRUNC, 0644);
+  if(file < 0){
+	throw std::runtime_error("cannot open " + filename);
+  }
+  dup2(file, fd);
+  close(file);
+}
+
+//global_params has const members, so it is rebuilt rather than assigned
+void reset_globals(const global_params& defaults){
+  GLOBAL.~global_params();
+  new (&GLOBAL) global_params(defaults);
+  ATTENDANCE = office_attendance();
+}
+
+void flush_output(){
+  std::cout.flush();
+  std::cerr.flush();
+  fflush(stdout);
+  fflush(stderr);
+}
+
+//Runs the configurations of batch_file (see the "batch" option) one after
+//the other. GLOBAL and ATTENDANCE are reset before each run; with
+//batch_cache_mb, parsed input files are kept between runs
+//(GLOBAL.BATCH_CACHE_BYTES). Returns 1 if any run failed.
+int run_batch(cxxopts::Options& options, const std::string& program, const std::string& batch_file){
+  const global_params defaults = GLOBAL;
+  std::ifstream file;
+  if(batch_file != "-"){
+	file.open(batch_file);
+	if(!file.good()){
+	  std::cerr << "batch: cannot open " << batch_file << std::endl;
+	  return 1;
+	}
+  }
+  std::istream& in = (batch_file == "-") ? std::cin : file;
+
+  //Status lines go to the original stdout, wherever the runs write
+  int saved_stdout = dup(1);
+  int saved_stderr = dup(2);
+  FILE* status_out = fdopen(dup(1), "w");
+
+  std::string line;
+  count_type index = 0;
+  bool failed = false;
+  while(std::getline(in, line)){
+	if(line.find_first_not_of(" \t\r") == std::string::npos){
+	  continue;
+	}
+	auto start_time = std::chrono::steady_clock::now();
+	int status = 0;
+	std::string error;
+	rapidjson::Document config;
+	config.Parse(line.c_str());
+	flush_output();
+	try{
+	  if(config.HasParseError() || !config.IsObject()){
+		throw std::runtime_error("batch line is not a JSON object");
+	  }
+	  if(config.HasMember("stdout")){
+		redirect_output(1, config["stdout"].GetString());
+	  }
+	  if(config.HasMember("stderr")){
+		redirect_output(2, config["stderr"].GetString());
+	  }
+	  auto args = batch_line_args(config);
+	  std::vector<char*> run_argv{const_cast<char*>(program.c_str())};
+	  for(auto& arg: args){
+		run_argv.push_back(&arg[0]);
+	  }
+	  int run_argc = run_argv.size();
+	  char** run_argv_ptr = run_argv.data();
+	  auto optvals = options.parse(run_argc, run_argv_ptr);
+
+	  reset_globals(defaults);
+	  GLOBAL.BATCH_MODE = true;
+	  save_options(optvals);
+	  run(GLOBAL.output_path);
+	} catch(const std::exception& e){
+	  status = 1;
+	  error = e.what();
+	  std::cerr << "batch: run " << index << " failed: " << error << std::endl;
+	}
+	flush_output();
+	dup2(saved_stdout, 1);
+	dup2(saved_stderr, 2);
+	failed = failed || status;
+
+	double seconds = std::chrono::duration<double>(std::chrono::steady_clock::now() - start_time).count();
+	rapidjson::StringBuffer buffer;
+	rapidjson::Writer<rapidjson::StringBuffer> writer(buffer);
+	writer.StartObject();
+	writer.Key("run");
+	writer.Uint(index);
+	writer.Key("status");
+	writer.Int(status);
+	writer.Key("output_directory");
+	writer.String(status ? "" : GLOBAL.output_path.c_str());
+	writer.Key("seconds");
+	writer.Double(seconds);
+	if(status){
+	  writer.Key("error");
+	  writer.String(error.c_str());
+	}
+	writer.EndObject();
+	fprintf(status_out, "batch: %s\n", buffer.GetString());
+	fflush(status_out);
+	++index;
+  }
+  fclose(status_out);
+  return failed ? 1 : 0;
+}
 
 
 int main(int argc, char** argv){
@@ -213,6 +557,39 @@ int main(int argc, char** argv){
     cxxopts::value<std::string>()->default_value(DEFAULTS.agent_load_file))
   ;
 
+  options.add_options("Early termination")
+    ("STOP_FATALITIES", "stop once the number of fatalities exceeds this (0: run all NUM_DAYS)",
+     cxxopts::value<count_type>()->default_value(DEFAULTS.STOP_FATALITIES))
+    ("STOP_LAMBDA_TOLERANCE", "with STOP_FATALITIES, also wait until no cumulative mean lambda fraction changes by more than this in a day (0: don't wait)",
+     cxxopts::value<double>()->default_value(DEFAULTS.STOP_LAMBDA_TOLERANCE))
+    ;
+
+  options.add_options("Output")
+    ("output_format", "csv: one csv file per time series, with gnuplot_script.gnuplot and plots.html; "
+     "npz: all the time series in one file, run.npz (see run_output.py); both",
+     cxxopts::value<std::string>()->default_value(DEFAULTS.output_format))
+    ("outputs", "comma-separated time series to write: names (e.g. num_affected), prefixes "
+     "ending in * (e.g. cumulative_mean_fraction_lambda_*), \"plots\" for "
+     "gnuplot_script.gnuplot and plots.html, or the presets full (everything), "
+     "calibration (num_fatalities and the cumulative mean lambda fractions) and "
+     "dashboard (num_*, disease_label_stats, quarantined_stats, ward_infected and plots). "
+     "manifest.json lists the files written.",
+     cxxopts::value<std::string>()->default_value(DEFAULTS.outputs))
+    ;
+
+  options.add_options("Batch")
+    ("batch", "run a stream of configurations in this process. "
+     "FILE (- for stdin) has one JSON object per line: the options of a run, either as "
+     "{\"OPTION\": value, ...} (true for flags) or as {\"args\": [\"--OPTION\", \"value\", ...]}, "
+     "and optionally \"stdout\" and \"stderr\" files for the output of the run. A line "
+     "\"batch: {...}\" with the status of each run is written to stdout.",
+     cxxopts::value<std::string>())
+    ("batch_cache_mb", "with batch, keep the parsed input files from one run to the next, up to "
+     "this many MB of input files, least recently used dropped first (0: parse them for every run). "
+     "A parsed file takes several times its size in memory.",
+     cxxopts::value<count_type>()->default_value(DEFAULTS.batch_cache_mb))
+    ;
+
   auto optvals = options.parse(argc, argv);
 
   if(optvals.count("help")){
@@ -226,174 +603,21 @@ int main(int argc, char** argv){
 			       "Intervention - neighbourhood containment",
 			       "Age-dependent mixing",
 			       "Other",
-             "Testing and contact tracing"
+             "Testing and contact tracing",
+             "Early termination",
+             "Output",
+             "Batch"
       }) << std::endl;
     return 0;
   }
 
-  //Save options
-  GLOBAL.SEED_HD_AREA_POPULATION = optvals["SEED_HD_AREA_POPULATION"].count();
-  GLOBAL.SEED_ONLY_NON_COMMUTER = optvals["SEED_ONLY_NON_COMMUTER"].count();
-  GLOBAL.SEED_FIXED_NUMBER = optvals["SEED_FIXED_NUMBER"].count();
-  GLOBAL.NUM_DAYS = optvals["NUM_DAYS"].as<count_type>();
-  GLOBAL.INIT_FRAC_INFECTED = optvals["INIT_FRAC_INFECTED"].as<double>();
-  GLOBAL.INIT_FIXED_NUMBER_INFECTED = optvals["INIT_FIXED_NUMBER_INFECTED"].as<count_type>();
-  GLOBAL.MEAN_INCUBATION_PERIOD = optvals["MEAN_INCUBATION_PERIOD"].as<double>();
-  GLOBAL.MEAN_ASYMPTOMATIC_PERIOD = optvals["MEAN_ASYMPTOMATIC_PERIOD"].as<double>();
-  GLOBAL.MEAN_SYMPTOMATIC_PERIOD = optvals["MEAN_SYMPTOMATIC_PERIOD"].as<double>();
-  GLOBAL.SYMPTOMATIC_FRACTION = optvals["SYMPTOMATIC_FRACTION"].as<double>();
-  GLOBAL.MEAN_HOSPITAL_REGULAR_PERIOD = optvals["MEAN_HOSPITAL_REGULAR_PERIOD"].as<double>();
-  GLOBAL.MEAN_HOSPITAL_CRITICAL_PERIOD = optvals["MEAN_HOSPITAL_CRITICAL_PERIOD"].as<double>();
-  GLOBAL.COMPLIANCE_PROBABILITY = optvals["COMPLIANCE_PROBABILITY"].as<double>();
-  if(optvals["HD_COMPLIANCE_PROBABILITY"].count()){
-	  GLOBAL.HD_COMPLIANCE_PROBABILITY = optvals["HD_COMPLIANCE_PROBABILITY"].as<double>();
-  } else {
-	//If HD_COMPLIANCE_PROBABILITY is not provided then set it equal to whatever
-	//value was provided for COMPLIANCE_PROBABILITY
-	GLOBAL.HD_COMPLIANCE_PROBABILITY = GLOBAL.COMPLIANCE_PROBABILITY;
-  }
-  GLOBAL.F_KERNEL_A = optvals["F_KERNEL_A"].as<double>();
-  GLOBAL.F_KERNEL_B = optvals["F_KERNEL_B"].as<double>();
-
-  GLOBAL.BETA_H = optvals["BETA_H"].as<double>();
-  GLOBAL.BETA_W = optvals["BETA_W"].as<double>();
-  GLOBAL.BETA_C = optvals["BETA_C"].as<double>();
-  GLOBAL.BETA_S = optvals["BETA_S"].as<double>();
-  GLOBAL.BETA_TRAVEL = optvals["BETA_TRAVEL"].as<double>();
-  GLOBAL.BETA_CLASS = optvals["BETA_CLASS"].as<double>();
-  GLOBAL.BETA_PROJECT = optvals["BETA_PROJECT"].as<double>();
-  GLOBAL.BETA_RANDOM_COMMUNITY = optvals["BETA_RANDOM_COMMUNITY"].as<double>();
-  GLOBAL.BETA_NBR_CELLS = optvals["BETA_NBR_CELLS"].as<double>();
-
-  GLOBAL.HD_AREA_FACTOR = optvals["HD_AREA_FACTOR"].as<double>();
-  GLOBAL.HD_AREA_EXPONENT = optvals["HD_AREA_EXPONENT"].as<double>();
-
-  GLOBAL.INTERVENTION
-	= static_cast<Intervention>(optvals["INTERVENTION"].as<count_type>());
-  GLOBAL.intervention_filename = optvals["intervention_filename"].as<std::string>();
-
-  GLOBAL.CALIBRATION_DELAY = optvals["CALIBRATION_DELAY"].as<double>();
-  GLOBAL.DAYS_BEFORE_LOCKDOWN = optvals["DAYS_BEFORE_LOCKDOWN"].as<double>();
-  GLOBAL.NUM_DAYS_BEFORE_INTERVENTIONS = GLOBAL.CALIBRATION_DELAY + GLOBAL.DAYS_BEFORE_LOCKDOWN;
-
-  GLOBAL.FIRST_PERIOD = optvals["FIRST_PERIOD"].as<double>();
-  GLOBAL.SECOND_PERIOD = optvals["SECOND_PERIOD"].as<double>();
-  GLOBAL.THIRD_PERIOD = optvals["THIRD_PERIOD"].as<double>();
-  GLOBAL.OE_SECOND_PERIOD = optvals["OE_SECOND_PERIOD"].as<double>();
-
-  GLOBAL.CYCLIC_POLICY_TYPE
-	= static_cast<Cycle_Type>(optvals["CYCLIC_POLICY_TYPE"].as<count_type>());
-  GLOBAL.CYCLIC_POLICY_START_DAY = GLOBAL.NUM_DAYS_BEFORE_INTERVENTIONS +
-	GLOBAL.FIRST_PERIOD + GLOBAL.SECOND_PERIOD;
-
-  std::string output_dir(optvals["output_directory"].as<std::string>());
-  GLOBAL.output_path = output_dir;
-
-  GLOBAL.input_base = optvals["input_directory"].as<std::string>();
-  if(optvals["attendance_filename"].count()){
-    GLOBAL.attendance_filename = optvals["attendance_filename"].as<std::string>();
-    GLOBAL.IGNORE_ATTENDANCE_FILE = false;
+  if(optvals.count("batch")){
+    GLOBAL.BATCH_CACHE_BYTES = optvals["batch_cache_mb"].as<count_type>() << 20;
+    return run_batch(options, argv[0], optvals["batch"].as<std::string>());
   }
-  //GLOBAL.IGNORE_ATTENDANCE_FILE = optvals["IGNORE_ATTENDANCE_FILE"].count();
 
-  GLOBAL.USE_AGE_DEPENDENT_MIXING = optvals["USE_AGE_DEPENDENT_MIXING"].count();
-  GLOBAL.SIGNIFICANT_EIGEN_VALUES = optvals["SIGNIFICANT_EIGEN_VALUES"].as<double>();
-  GLOBAL.NUM_AGE_GROUPS = optvals["NUM_AGE_GROUPS"].as<count_type>();
-
-  if(optvals["PROVIDE_INITIAL_SEED"].count()){
-	//Initial seed was provided
-	SEED_RNG_PROVIDED_SEED(optvals["PROVIDE_INITIAL_SEED"].as<count_type>());
-  } else {
-	SEED_RNG(); //No Initial seed was provided
-  }
-  if(optvals["PROVIDE_INITIAL_SEED_GRAPH"].count()){
-	//Initial seed was provided
-	SEED_RNG_GRAPH_PROVIDED_SEED(optvals["PROVIDE_INITIAL_SEED_GRAPH"].as<count_type>());
-  } else {
-	SEED_RNG_GRAPH(); //No Initial seed was provided
-  }
-
-  GLOBAL.LOCKED_COMMUNITY_LEAKAGE = optvals["LOCKED_COMMUNITY_LEAKAGE"].as<double>();
-  GLOBAL.COMMUNITY_LOCK_THRESHOLD = optvals["COMMUNITY_LOCK_THRESHOLD"].as<double>();
-  GLOBAL.LOCKED_NEIGHBORHOOD_LEAKAGE = optvals["LOCKED_NEIGHBORHOOD_LEAKAGE"].as<double>();
-  GLOBAL.NEIGHBORHOOD_LOCK_THRESHOLD = optvals["NEIGHBORHOOD_LOCK_THRESHOLD"].as<double>();
-
-  //Compute parametrs based on options
-  GLOBAL.NUM_TIMESTEPS = GLOBAL.NUM_DAYS*GLOBAL.SIM_STEPS_PER_DAY;
-  GLOBAL.INCUBATION_PERIOD_SCALE = GLOBAL.MEAN_INCUBATION_PERIOD*GLOBAL.SIM_STEPS_PER_DAY / GLOBAL.INCUBATION_PERIOD_SHAPE;
-
-  GLOBAL.ASYMPTOMATIC_PERIOD = GLOBAL.MEAN_ASYMPTOMATIC_PERIOD*GLOBAL.SIM_STEPS_PER_DAY;
-  GLOBAL.SYMPTOMATIC_PERIOD = GLOBAL.MEAN_SYMPTOMATIC_PERIOD*GLOBAL.SIM_STEPS_PER_DAY;
-  GLOBAL.HOSPITAL_REGULAR_PERIOD = GLOBAL.MEAN_HOSPITAL_REGULAR_PERIOD*GLOBAL.SIM_STEPS_PER_DAY;
-  GLOBAL.HOSPITAL_CRITICAL_PERIOD = GLOBAL.MEAN_HOSPITAL_CRITICAL_PERIOD*GLOBAL.SIM_STEPS_PER_DAY;
-
-  GLOBAL.MASK_ACTIVE = optvals["MASK_ACTIVE"].count();
-  if(GLOBAL.MASK_ACTIVE){
-    GLOBAL.MASK_FACTOR = optvals["MASK_FACTOR"].as<double>();
-  }
-
-  GLOBAL.MASK_START_DATE = GLOBAL.CALIBRATION_DELAY + optvals["MASK_START_DELAY"].as<double>(); //masks starts from April 9
-
-  //initialise city bounding box co-ordinates with Bangalore values. Will read from file later.
-  GLOBAL.city_SW.lat = optvals["CITY_SW_LAT"].as<double>();
-  GLOBAL.city_SW.lon = optvals["CITY_SW_LON"].as<double>();
-  GLOBAL.city_NE.lat = optvals["CITY_NE_LAT"].as<double>();
-  GLOBAL.city_NE.lon = optvals["CITY_NE_LON"].as<double>();
-  GLOBAL.NBR_CELL_SIZE = optvals["NBR_CELL_SIZE"].as<double>();
-  GLOBAL.ENABLE_CONTAINMENT = optvals["ENABLE_CONTAINMENT"].count();
-  GLOBAL.ENABLE_NBR_CELLS = optvals["ENABLE_NBR_CELLS"].count();
-  if(GLOBAL.ENABLE_NBR_CELLS){
-	GLOBAL.ENABLE_NEIGHBORHOOD_SOFT_CONTAINMENT = optvals["ENABLE_NEIGHBORHOOD_SOFT_CONTAINMENT"].count();
-  } else {
-	GLOBAL.ENABLE_NEIGHBORHOOD_SOFT_CONTAINMENT = false;
-  }
-  GLOBAL.WARD_CONTAINMENT_THRESHOLD = optvals["WARD_CONTAINMENT_THRESHOLD"].as<count_type>();
-
-  GLOBAL.ENABLE_TESTING = optvals["ENABLE_TESTING"].count();
-  GLOBAL.ENABLE_NBR_CELLS = GLOBAL.ENABLE_NBR_CELLS || GLOBAL.ENABLE_CONTAINMENT;
-
-  GLOBAL.TESTING_PROTOCOL
-	= static_cast<Testing_Protocol>(optvals["TESTING_PROTOCOL"].as<count_type>());
-  GLOBAL.testing_protocol_filename = optvals["testing_protocol_filename"].as<std::string>();
-
-  GLOBAL.agent_load_file = optvals["agent_load_file"].as<std::string>();
-
-  if(GLOBAL.input_base != ""
-	 && GLOBAL.input_base[GLOBAL.input_base.size() - 1] != '/'){
-	GLOBAL.input_base += '/';
-	//Make sure the path of the input_base
-	//directory is terminated by a "/"
-  }
-
-  //settings for cohorts
- GLOBAL.ENABLE_COHORTS = optvals["ENABLE_COHORTS"].count();
- GLOBAL.ISOLATE_COHORTS = optvals["ISOLATE_COHORTS"].count();
- GLOBAL.BETA_COHORT = optvals["BETA_COHORT"].as<double>();
- GLOBAL.crowding_factor = optvals["CROWDING_FACTOR_COHORTS"].as<double>();
- GLOBAL.taking_train_fraction = optvals["FRACTION_IN_TRAINS_COHORTS"].as<double>();
- GLOBAL.COHORT_SIZE = optvals["COHORT_SIZE"].as<double>();
- GLOBAL.COHORT_SEVERITY_FRACTION = optvals["COHORT_SEVERITY_FRACTION"].as<double>();
- GLOBAL.COHORT_STRATEGY = static_cast<cohort_strategy>(optvals["COHORT_STRATEGY"].as<count_type>());
- GLOBAL.ONE_OFF_TRAVELERS_RATIO = optvals["ONE_OFF_TRAVELERS_RATIO"].as<double>();
- 
-//  std::cout<<"GLOBAL.ENABLE_COHORTS" << GLOBAL.ENABLE_COHORTS << std::endl;
-
-// store or load state.
- GLOBAL.STORE_STATE_TIME_STEP = optvals["STORE_STATE_TIME_STEP"].as<count_type>();
- GLOBAL.LOAD_STATE_TIME_STEP = optvals["LOAD_STATE_TIME_STEP"].as<count_type>();
-
-  //Initialize the attendance probability
-  initialize_office_attendance();
-
-  //Initialize output folders
-  gnuplot gnuplot(output_dir);
-
-  //Run simulations
-  auto plot_data = run_simulation();
-
-  //Start output
-  output_global_params(output_dir);
-
-  output_csv_files(output_dir, gnuplot, plot_data);
+  save_options(optvals);
+  run(GLOBAL.output_path);
   return 0;
 }
+
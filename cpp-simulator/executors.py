@@ -0,0 +1,380 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Executors for ensembles of drive_simulator runs, used by the calibration
+# and sweep drivers (calibrate_betas/Calibration.py,
+# calibrate_betas/tune_model_CPP.py).
+#
+# A driver builds one Task per run and calls executor.run(tasks), which
+# blocks until every task has finished (retrying failed ones up to
+# `retries` times) and returns their return codes in task order. The
+# driver then reads the outputs of the successful runs, or handles each run
+# as it finishes in executor.run(tasks, callback). A task given a timeout is
+# killed after that many seconds and not retried. Every run goes
+# through run_cache.cached_run, so DRIVE_SIM_CACHE works with any backend.
+#
+# Backends:
+#   local   a pool of `ncores` local processes
+#   ssh     workers started over ssh on a host list, e.g. node1:16,node2:16
+#   array   workers started as a batch-scheduler job array (sbatch by default)
+#   fake    local worker processes posing as cluster nodes, optionally
+#           failing at random; a stand-in for ssh/array in tests
+#
+# ssh, array and fake share a work queue: a directory on a filesystem that
+# every node sees (the queue directory, by default .executor_queue in the
+# working directory), holding
+#   todo/<task>.json      tasks not yet claimed
+#   running/<task>.json   claimed by a worker (kept touched as a heartbeat)
+#   done/<task>.json      return code and node of the finished attempt
+#   closed                all tasks are finished; workers exit
+# A worker claims a task by renaming it from todo/ to running/, so nodes can
+# be added or lost at any time. A task whose heartbeat stops (its node died)
+# counts as a failed attempt. Workers are started with
+#   python executors.py worker QUEUE_DIR
+# from the driver's working directory, which must be on the shared
+# filesystem too.
+
+import argparse
+import glob
+import json
+import os
+import random
+import shlex
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from run_cache import cached_run
+
+executor_file = os.path.abspath(__file__)
+heartbeat_seconds = 30
+fail_rate_env = "EXECUTOR_FAIL_RATE"
+node_env = "EXECUTOR_NODE"
+timeout_returncode = 124 # as coreutils timeout
+
+
+class Task:
+
+    def __init__(self, cmd, output_dir, replicate=None, keep=None, quiet=False, timeout=None):
+        # cmd: drive_simulator command line; replicate/keep: see
+        # run_cache.cached_run; quiet: discard the simulator's output;
+        # timeout: seconds
+        self.cmd = [str(c) for c in cmd]
+        self.output_dir = str(output_dir)
+        self.replicate = replicate
+        self.keep = keep
+        self.quiet = quiet
+        self.timeout = timeout
+
+    def to_dict(self):
+        return {"cmd": self.cmd, "output_dir": self.output_dir, "replicate": self.replicate,
+                "keep": self.keep, "quiet": self.quiet, "timeout": self.timeout}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d["cmd"], d["output_dir"], d["replicate"], d["keep"], d["quiet"], d.get("timeout"))
+
+    def execute(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        output = {"stdout": subprocess.DEVNULL, "stderr": subprocess.DEVNULL} if self.quiet else {}
+        try:
+            return cached_run(self.cmd, self.output_dir, self.replicate, self.keep,
+                              timeout=self.timeout, **output)
+        except subprocess.TimeoutExpired:
+            print(f"executor: {self.output_dir} timed out after {self.timeout} s", flush=True)
+            return timeout_returncode
+
+
+class Executor:
+
+    def __init__(self, retries=2):
+        self.retries = retries
+
+    def run(self, tasks, callback=None):
+        # callback(i, returncode) is called as each task finishes for good
+        raise NotImplementedError
+
+    def gives_up(self, returncode, attempt):
+        return returncode == timeout_returncode or attempt > self.retries
+
+    def report_failure(self, task, returncode, attempt, node=None):
+        where = f" on {node}" if node else ""
+        final = "giving up" if self.gives_up(returncode, attempt) else "retrying"
+        print(f"executor: {task.output_dir} failed{where} (return code {returncode}, "
+              f"attempt {attempt} of {self.retries + 1}), {final}", flush=True)
+
+
+class LocalExecutor(Executor):
+
+    def __init__(self, ncores, retries=2):
+        super().__init__(retries)
+        self.ncores = ncores
+
+    def _run_one(self, i, task, callback):
+        attempt = 1
+        while True:
+            returncode = task.execute()
+            if returncode == 0:
+                break
+            self.report_failure(task, returncode, attempt)
+            if self.gives_up(returncode, attempt):
+                break
+            attempt += 1
+        if callback is not None:
+            callback(i, returncode)
+        return returncode
+
+    def run(self, tasks, callback=None):
+        # Threads only wait on the simulator subprocesses
+        with ThreadPoolExecutor(max_workers=max(1, self.ncores)) as pool:
+            return list(pool.map(self._run_one, range(len(tasks)), tasks, [callback] * len(tasks)))
+
+
+class QueueExecutor(Executor):
+    # Shared-directory work queue; subclasses start the workers
+
+    def __init__(self, queue_dir=None, retries=2, poll=2.0, stale_after=5 * heartbeat_seconds):
+        super().__init__(retries)
+        self.queue_dir = os.path.abspath(queue_dir or ".executor_queue")
+        self.poll = poll
+        self.stale_after = stale_after
+
+    def start_workers(self, queue, n):
+        raise NotImplementedError
+
+    def stop_workers(self):
+        pass
+
+    def worker_command(self, queue):
+        return [sys.executable, executor_file, "worker", queue]
+
+    def _enqueue(self, queue, i, task, attempt):
+        record = dict(task.to_dict(), id=i, attempt=attempt, cwd=os.getcwd())
+        tmp = os.path.join(queue, f"tmp-{uuid.uuid4().hex}")
+        with open(tmp, "w") as f:
+            json.dump(record, f)
+        os.replace(tmp, os.path.join(queue, "todo", f"{i}.json"))
+
+    def run(self, tasks, callback=None):
+        if not tasks:
+            return []
+        queue = os.path.join(self.queue_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}")
+        for sub in ["todo", "running", "done"]:
+            os.makedirs(os.path.join(queue, sub))
+        attempts = [1] * len(tasks)
+        results = [None] * len(tasks)
+        for i, task in enumerate(tasks):
+            self._enqueue(queue, i, task, 1)
+        self.start_workers(queue, len(tasks))
+        try:
+            while any(r is None for r in results):
+                time.sleep(self.poll)
+                finished = []
+                for path in glob.glob(os.path.join(queue, "done", "*.json")):
+                    with open(path, "r") as f:
+                        done = json.load(f)
+                    os.remove(path)
+                    finished.append((done["id"], done["attempt"], done["returncode"], done["node"]))
+                now = time.time()
+                for path in glob.glob(os.path.join(queue, "running", "*.json")):
+                    try:
+                        stale = now - os.stat(path).st_mtime > self.stale_after
+                        if stale:
+                            with open(path, "r") as f:
+                                lost = json.load(f)
+                            os.remove(path)
+                            finished.append((lost["id"], lost["attempt"], None, lost.get("node")))
+                    except (OSError, ValueError): # finished meanwhile
+                        continue
+                for i, attempt, returncode, node in finished:
+                    if results[i] is not None or attempt != attempts[i]:
+                        continue # a late report of an attempt already given up on
+                    if returncode == 0:
+                        results[i] = 0
+                    else:
+                        self.report_failure(tasks[i], "lost" if returncode is None else returncode, attempt, node)
+                        if self.gives_up(returncode, attempt):
+                            results[i] = 1 if returncode is None else returncode
+                    if results[i] is not None:
+                        if callback is not None:
+                            callback(i, results[i])
+                    else:
+                        attempts[i] += 1
+                        self._enqueue(queue, i, tasks[i], attempts[i])
+        finally:
+            open(os.path.join(queue, "closed"), "w").close()
+            self.stop_workers()
+        return results
+
+
+class SSHExecutor(QueueExecutor):
+
+    def __init__(self, hosts, **kwargs):
+        # hosts: list of "host" or "host:slots"
+        super().__init__(**kwargs)
+        self.slots = []
+        for host in hosts:
+            name, _, slots = host.partition(":")
+            self.slots += [name] * int(slots or 1)
+        self.procs = []
+
+    def start_workers(self, queue, n):
+        remote = f"cd {shlex.quote(os.getcwd())} && " + " ".join(
+            shlex.quote(c) for c in ["python3", executor_file, "worker", queue])
+        self.procs = [subprocess.Popen(["ssh", "-o", "BatchMode=yes", host, remote])
+                      for host in self.slots[:n]]
+
+    def stop_workers(self):
+        for p in self.procs:
+            p.wait()
+
+
+class ArrayExecutor(QueueExecutor):
+    # submit is a format string with {n} (array size), {queue} and {worker}
+    # (the worker command line), e.g. for PBS:
+    #   qsub -J 1-{n} -- {worker}
+
+    default_submit = "sbatch --array=1-{n} --output={queue}/worker-%a.log --wrap {worker}"
+
+    def __init__(self, workers, submit=None, **kwargs):
+        super().__init__(**kwargs)
+        self.workers = workers
+        self.submit = submit or self.default_submit
+
+    def start_workers(self, queue, n):
+        worker = " ".join(shlex.quote(c) for c in self.worker_command(queue))
+        cmd = self.submit.format(n=min(n, self.workers), queue=queue, worker=shlex.quote(worker))
+        print(f"executor: {cmd}", flush=True)
+        subprocess.run(shlex.split(cmd), check=True)
+
+
+class FakeClusterExecutor(QueueExecutor):
+
+    def __init__(self, nodes=2, slots_per_node=2, fail_rate=0.0, **kwargs):
+        kwargs.setdefault("poll", 0.2)
+        super().__init__(**kwargs)
+        self.nodes = nodes
+        self.slots_per_node = slots_per_node
+        self.fail_rate = fail_rate
+        self.procs = []
+
+    def start_workers(self, queue, n):
+        self.procs = []
+        for k in range(min(n, self.nodes * self.slots_per_node)):
+            env = dict(os.environ, **{node_env: f"fake-node-{k // self.slots_per_node}",
+                                      fail_rate_env: str(self.fail_rate)})
+            self.procs.append(subprocess.Popen(self.worker_command(queue) + ["--poll", "0.1"], env=env))
+
+    def stop_workers(self):
+        for p in self.procs:
+            p.wait()
+
+
+def worker(queue, poll=2.0):
+    node = os.environ.get(node_env) or socket.gethostname()
+    fail_rate = float(os.environ.get(fail_rate_env, 0))
+    name = f"{node}-{os.getpid()}"
+    while True:
+        claimed = None
+        for path in sorted(glob.glob(os.path.join(queue, "todo", "*.json"))):
+            target = os.path.join(queue, "running", f"{os.path.basename(path)[:-5]}.{name}.json")
+            try:
+                os.rename(path, target)
+            except OSError: # claimed by another worker
+                continue
+            claimed = target
+            break
+        if claimed is None:
+            if os.path.exists(os.path.join(queue, "closed")):
+                return
+            time.sleep(poll)
+            continue
+
+        with open(claimed, "r") as f:
+            record = json.load(f)
+        record["node"] = node
+        with open(claimed, "w") as f:
+            json.dump(record, f)
+        stop = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(heartbeat_seconds):
+                try:
+                    os.utime(claimed)
+                except OSError:
+                    return
+        threading.Thread(target=heartbeat, daemon=True).start()
+        try:
+            if random.random() < fail_rate:
+                returncode = 1 # fake node failure
+            else:
+                os.chdir(record["cwd"])
+                returncode = Task.from_dict(record).execute()
+        except Exception as e:
+            print(f"executor worker {name}: {e}", file=sys.stderr)
+            returncode = 1
+        stop.set()
+
+        done = {"id": record["id"], "attempt": record["attempt"], "returncode": returncode, "node": node}
+        tmp = os.path.join(queue, f"tmp-{uuid.uuid4().hex}")
+        with open(tmp, "w") as f:
+            json.dump(done, f)
+        os.replace(tmp, os.path.join(queue, "done", f"{record['id']}.{record['attempt']}.json"))
+        try:
+            os.remove(claimed)
+        except OSError:
+            pass
+
+
+def add_executor_arguments(parser):
+    group = parser.add_argument_group('executor')
+    group.add_argument('--executor', choices=['local', 'ssh', 'array', 'fake'], default='local',
+                       help='where the simulator runs go (see cpp-simulator/executors.py)')
+    group.add_argument('--hosts', default=None,
+                       help='ssh: comma separated host[:slots] list')
+    group.add_argument('--workers', type=int, default=None,
+                       help='array: job array size (default: one worker per run)')
+    group.add_argument('--submit', default=None,
+                       help=f'array: submit command, default "{ArrayExecutor.default_submit}"')
+    group.add_argument('--queue_dir', default=None,
+                       help='ssh/array/fake: shared work queue directory (default: .executor_queue)')
+    group.add_argument('--retries', type=int, default=2,
+                       help='times a failed run is retried')
+    group.add_argument('--fake_nodes', type=int, default=2,
+                       help='fake: number of nodes')
+    group.add_argument('--fake_fail_rate', type=float, default=0.0,
+                       help='fake: probability that a run fails')
+    return group
+
+
+def executor_from_args(args, ncores):
+    common = {"retries": args.retries}
+    if args.executor == 'local':
+        return LocalExecutor(ncores, **common)
+    common["queue_dir"] = args.queue_dir
+    if args.executor == 'ssh':
+        assert args.hosts, "--executor ssh needs --hosts"
+        return SSHExecutor(args.hosts.split(","), **common)
+    if args.executor == 'array':
+        return ArrayExecutor(args.workers or 1 << 30, args.submit, **common)
+    return FakeClusterExecutor(args.fake_nodes, max(1, ncores // args.fake_nodes),
+                               args.fake_fail_rate, **common)
+
+
+def main():
+    my_parser = argparse.ArgumentParser(description='drive_simulator run executor')
+    sub = my_parser.add_subparsers(dest='command', required=True)
+    w = sub.add_parser('worker', help='claim and run tasks from a work queue until it is closed')
+    w.add_argument('queue')
+    w.add_argument('--poll', type=float, default=2.0)
+    args = my_parser.parse_args()
+    if args.command == 'worker':
+        worker(args.queue, args.poll)
+
+
+if __name__ == "__main__":
+    main()
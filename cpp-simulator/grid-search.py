@@ -6,7 +6,7 @@ import numpy as np
 options = {
     'NUM_DAYS': '120',
     'INIT_FRAC_INFECTED': '0.0001',
-    'INCUBATION_PERIOD': '2.25',
+    'MEAN_INCUBATION_PERIOD': '2.25',
     'MEAN_ASYMPTOMATIC_PERIOD': '0.5',
     'MEAN_SYMPTOMATIC_PERIOD': '5',
     'SYMPTOMATIC_FRACTION': '0.67',
@@ -42,21 +42,27 @@ options = {
 
 grid_points = np.linspace(start = 0.8, stop = 1.2, num = 5)
 
-BETA_H_VALUES = grid_points*options["BETA_H"]
-BETA_W_VALUES = grid_points*options["BETA_W"]
-BETA_S_VALUES = grid_points*options["BETA_S"]
-BETA_C_VALUES = grid_points*options["BETA_C"]
+#Parameters to sweep, each between grid_points[0] and grid_points[-1]
+#times its value above. The full grid (--design grid) has
+#len(grid_points) values of each; the other designs sample the same box.
+sweep_parameters = ["BETA_H", "BETA_W", "BETA_S", "BETA_C"]
 
 #Do not edit below this line for editing inputs
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import csv
+import json
 import logging
+import matplotlib
 import matplotlib.pyplot as plt
+import os
 import pandas as pd
 from pathlib import Path
-import subprocess
 import sys
 
+import executors
+import sweep_designs
+
 from sklearn.linear_model import LinearRegression
 import sklearn.metrics as metrics
 
@@ -71,11 +77,37 @@ parser.add_argument("--lower-end-of-fatality-curve", '-l', type=int, default = 1
 parser.add_argument("--upper-end-of-fatality-curve", '-u', type=int, default = 200,
                     dest = "max_fatalities",
                     help="total fatalities at time at which regression stops (default: 200)")
+parser.add_argument("--jobs", "-j", type=int, default = os.cpu_count(),
+                    help="local executor: simulator runs at a time (default: number of cpus)")
+parser.add_argument("--timeout", type=float, default = None,
+                    help="seconds after which a run is killed and its point skipped (default: none)")
+parser.add_argument("--yes", "-y", action="store_true",
+                    help="do not ask before resuming in an existing output directory")
+parser.add_argument("--design", choices = sweep_designs.designs, default = "grid",
+                    help="grid: full factorial; lhs/sobol: --samples space-filling points; "
+                    "adaptive: --rounds rounds of --samples/--rounds points, each round refining around "
+                    "the best fits so far; saltelli: --samples*(parameters+2) points, "
+                    "followed by Sobol sensitivity indices (default: grid)")
+parser.add_argument("--samples", type=int, default = 256,
+                    help="points for lhs, sobol and adaptive; base sample size for saltelli. "
+                    "Powers of 2 keep the Sobol sequence balanced (default: 256)")
+parser.add_argument("--rounds", type=int, default = 4,
+                    help="adaptive: number of rounds (default: 4)")
+parser.add_argument("--seed", type=int, default = 0,
+                    help="seed of the random designs (default: 0)")
+parser.add_argument("--target-slope", type=float, default = 0.1803300052477795, dest = "target_slope",
+                    help="adaptive: log daily fatality growth rate that the best fits are closest to, "
+                    "with lambda H/W/C closest to 1/3 (default: calibration target)")
+parser.add_argument("--outputs", type=str, default = "calibration",
+                    help="time series each run writes (drive_simulator --outputs); the fit reads num_fatalities "
+                    "and the cumulative mean lambda fractions (default: calibration)")
+executors.add_executor_arguments(parser)
 
 
 args = parser.parse_args()
 options["input_directory"] = args.input_directory
 options["output_directory"] = args.output_directory
+options["outputs"] = args.outputs
 min_fatalities = args.min_fatalities
 max_fatalities = args.max_fatalities
 
@@ -86,12 +118,14 @@ if options["output_directory"][-1] == "/":
 output_directory_base_path = Path(options["output_directory"])
 if output_directory_base_path.exists():
     if output_directory_base_path.is_dir():
-        print(f'{options["output_directory"]} is a directory; its contents will be overwritten. Continue (y/n)? ',
-              end = "", flush = True)
-        choice = input().lower()
-        if (choice != "y"):
-            print("Not continuing as directed.  Please provide another output directory.", flush = True)
-            sys.exit(1)
+        # Only ask when someone can answer
+        if not args.yes and sys.stdin.isatty():
+            print(f'{options["output_directory"]} is a directory; points already in its beta_fit_data.csv will be skipped '
+                  f'and the others overwritten. Continue (y/n)? ', end = "", flush = True)
+            choice = input().lower()
+            if (choice != "y"):
+                print("Not continuing as directed.  Please provide another output directory.", flush = True)
+                sys.exit(1)
     else:
         print(f'{options["output_directory"]} is a non-directory and already exists.', flush = True)
         print(f"Exiting. Please provide another output directory", flush = True)
@@ -110,7 +144,7 @@ print(f"check the log file {log_file_name} for updates", flush = True)
 lambda_params = ["lambda_H", "lambda_W", "lambda_C", "lambda_T"]
 
 # Field names for the output CSV file
-field_names = ["run_index", "BETA_H", "BETA_W", "BETA_S", "BETA_C", "r2_score", "fit_growth_rate"] + lambda_params
+field_names = ["run_index"] + sweep_parameters + ["r2_score", "fit_growth_rate"] + lambda_params
 
 
 def evaluate_betas(options, plot_file, min_fatalities, max_fatalities):
@@ -160,6 +194,7 @@ def evaluate_betas(options, plot_file, min_fatalities, max_fatalities):
     plt.legend()
 
     plt.savefig(plot_file)
+    plt.close()
     logging.info(f"Saved plot to {plot_file}.")
 
     #Collect the cumulative mean lambda fraction data
@@ -170,70 +205,175 @@ def evaluate_betas(options, plot_file, min_fatalities, max_fatalities):
     
     return beta_data
 
-#Run the simlator throughout the grid
-run_index = 0
+#Sampling design. Its points are kept in design_points.csv (run_index,
+#block, row, the unit-cube coordinates u_<parameter> and the parameter
+#values), so that a resumed sweep runs the same points. The options that
+#chose them are kept in design_points.json; resuming with other ones is
+#refused rather than silently running the old design.
+design_file_name = Path(output_base, "design_points.csv")
+design_settings_file_name = Path(output_base, "design_points.json")
+design_settings = {"design": args.design}
+if args.design != "grid":
+    design_settings.update(samples = args.samples, seed = args.seed)
+if args.design == "adaptive":
+    design_settings["rounds"] = args.rounds
+unit_columns = [f"u_{name}" for name in sweep_parameters]
+low = np.array([grid_points[0] * options[name] for name in sweep_parameters])
+high = np.array([grid_points[-1] * options[name] for name in sweep_parameters])
 
-with open(csv_file_name, "w") as csv_file:
-    
-    csv_writer = csv.DictWriter(csv_file, fieldnames = field_names)
+def add_to_design(design, labels, unit):
+    new = labels.copy()
+    start = 1 if design is None else design["run_index"].max() + 1
+    new.insert(0, "run_index", np.arange(start, start + len(new)))
+    for k, name in enumerate(sweep_parameters):
+        new[f"u_{name}"] = unit[:, k]
+    for k, name in enumerate(sweep_parameters):
+        new[name] = low[k] + unit[:, k] * (high[k] - low[k])
+    design = new if design is None else pd.concat([design, new], ignore_index = True)
+    design.to_csv(design_file_name, index = False)
+    return design
 
-    csv_writer.writeheader()
-    
-    for BETA_H in BETA_H_VALUES:
-        for BETA_W  in BETA_W_VALUES:
-            for BETA_S in BETA_S_VALUES:
-                for BETA_C in BETA_C_VALUES:
-                    run_index += 1
-                    
-                    options["BETA_H"] = BETA_H
-                    options["BETA_W"] = BETA_W
-                    options["BETA_S"] = BETA_S
-                    options["BETA_C"] = BETA_C                
-                    
-                    output_directory = output_base + f"/run_{run_index:07d}"
-                    options["output_directory"] = output_directory
-                    plot_file = Path(output_base, f"plot_for_run_index_{run_index:07d}.png")
-
-                    output_directory_path = Path(output_directory)
-                    if not output_directory_path.exists():
-                        output_directory_path.mkdir()
-                    
-                    command = ["./drive_simulator"] + [f"--{key}={value}" for (key, value) in options.items()]
-                    
-                    logging.info(f"Run number = {run_index}\n"
-                          f"BETA_H = {BETA_H}\n"
-                          f"BETA_W = {BETA_W}\n"
-                          f"BETA_S = {BETA_S}\n"
-                          f"BETA_C = {BETA_S}\n"
-                    )
-                    logging.info("Command to be run\n" + " ".join(command))
-
-                    try:
-                        result = subprocess.run(command)
-                        if result.returncode != 0:
-                            raise Exception("simulator returned with error")
-                        
-                        beta_data = evaluate_betas(options, plot_file, min_fatalities, max_fatalities)
-                        
-                    except Exception as e:
-                        print(f"error: run {run_index} terminated with error. Not using its data.\n"
-                              f"error: see the log file {log_file_name}")
-                        logging.error(f"error: run {run_index} terminated with error. Not using its data.")
-                        logging.error("description of error follows")
-                        logging.error(e)
-                        continue
-
-                    row = {
-                        'run_index': run_index,
-                        "BETA_H": BETA_H,
-                        "BETA_W": BETA_W,
-                        "BETA_S": BETA_S,
-                        "BETA_C": BETA_C,
-                        "r2_score": beta_data['r2_score'],
-                        "fit_growth_rate": beta_data['daily_growth_rate']
-                    }
-
-                    for name in lambda_params:
-                        row[name] = beta_data[name]
-
-                    csv_writer.writerow(row)
+def initial_design():
+    dim = len(sweep_parameters)
+    if args.design == "grid":
+        return sweep_designs.grid(len(grid_points), dim)
+    if args.design == "lhs":
+        return sweep_designs.lhs(args.samples, dim, args.seed)
+    if args.design == "sobol":
+        return sweep_designs.sobol(args.samples, dim, args.seed)
+    if args.design == "adaptive":
+        labels, unit = sweep_designs.sobol(max(1, args.samples // args.rounds), dim, args.seed)
+        labels["block"] = "round0"
+        return labels, unit
+    return sweep_designs.saltelli(args.samples, dim, args.seed)
+
+if design_file_name.exists():
+    saved_settings = None
+    if design_settings_file_name.exists():
+        with open(design_settings_file_name) as f:
+            saved_settings = json.load(f)
+    if saved_settings != design_settings:
+        if saved_settings is None:
+            print(f"{design_file_name} has no {design_settings_file_name} to say how it was made.", flush = True)
+        else:
+            print(f"{design_file_name} was made with {saved_settings}, not {design_settings}.", flush = True)
+        print(f"Exiting. Rerun with those options or provide another output directory", flush = True)
+        sys.exit(1)
+    design = pd.read_csv(design_file_name)
+    print(f"Using the {len(design)} points of {design_file_name}", flush = True)
+else:
+    with open(design_settings_file_name, "w") as f:
+        json.dump(design_settings, f)
+    design = add_to_design(None, *initial_design())
+
+def fit_losses(design):
+    # Distance of each design point's fit from the calibration targets, as
+    # in Calibration.py; NaN for points without a usable fit
+    results = pd.read_csv(csv_file_name).set_index("run_index") if csv_file_name.exists() else pd.DataFrame()
+    results = results.reindex(design["run_index"])
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        slope_diff = np.log(results["fit_growth_rate"].to_numpy(dtype = float)) - args.target_slope
+    loss = (slope_diff / 0.001) ** 2
+    for name in ["lambda_H", "lambda_W", "lambda_C"]:
+        loss += ((results[name].to_numpy(dtype = float) - 1.0 / 3) / 0.01) ** 2
+    return loss
+
+#Run the simulator on the design points. Runs go to the executor (a pool of
+#--jobs local processes by default); each finished run is fitted, plotted
+#and recorded in the csv by a single worker thread, off the critical path.
+#Points already in the csv are skipped, so an interrupted sweep resumes.
+def point_options(point):
+    return dict(options, **{name: point[name] for name in sweep_parameters},
+                output_directory = output_base + f"/run_{int(point['run_index']):07d}")
+
+def point_task(point):
+    point_opts = point_options(point)
+    command = ["./drive_simulator"] + [f"--{key}={value}" for (key, value) in point_opts.items()]
+
+    logging.info(f"Run number = {int(point['run_index'])}\n" +
+                 "".join(f"{name} = {point[name]}\n" for name in sweep_parameters))
+    logging.info("Command to be run\n" + " ".join(command))
+    # Served from the run cache if DRIVE_SIM_CACHE is set
+    return executors.Task(command, point_opts["output_directory"], replicate = 0, timeout = args.timeout)
+
+def record_point(point, returncode, csv_file, csv_writer):
+    run_index = int(point["run_index"])
+    point_opts = point_options(point)
+    plot_file = Path(output_base, f"plot_for_run_index_{run_index:07d}.png")
+    try:
+        if returncode != 0:
+            raise Exception(f"simulator returned with error {returncode}")
+
+        beta_data = evaluate_betas(point_opts, plot_file, min_fatalities, max_fatalities)
+
+    except Exception as e:
+        print(f"error: run {run_index} terminated with error. Not using its data.\n"
+              f"error: see the log file {log_file_name}")
+        logging.error(f"error: run {run_index} terminated with error. Not using its data.")
+        logging.error("description of error follows")
+        logging.error(e)
+        return
+
+    row = {
+        'run_index': run_index,
+        "r2_score": beta_data['r2_score'],
+        "fit_growth_rate": beta_data['daily_growth_rate']
+    }
+    for name in sweep_parameters:
+        row[name] = point[name]
+
+    for name in lambda_params:
+        row[name] = beta_data[name]
+
+    csv_writer.writerow(row)
+    csv_file.flush()
+
+matplotlib.use("Agg")
+executor = executors.executor_from_args(args, args.jobs)
+
+def run_design(design):
+    recorded = set()
+    if csv_file_name.exists():
+        recorded = set(pd.read_csv(csv_file_name)["run_index"])
+        print(f"{len(recorded)} of {len(design)} points already in {csv_file_name}; skipping them", flush = True)
+    points = [point for _, point in design.iterrows() if point["run_index"] not in recorded]
+    new_file = not csv_file_name.exists()
+
+    with open(csv_file_name, "a") as csv_file, ThreadPoolExecutor(max_workers = 1) as fit_worker:
+
+        csv_writer = csv.DictWriter(csv_file, fieldnames = field_names)
+
+        if new_file:
+            csv_writer.writeheader()
+
+        fits = []
+        executor.run([point_task(point) for point in points],
+                     lambda i, returncode: fits.append(
+                         fit_worker.submit(record_point, points[i], returncode, csv_file, csv_writer)))
+        for fit in fits:
+            fit.result()
+
+run_design(design)
+
+if args.design == "adaptive":
+    for round_index in range(1, args.rounds):
+        if not (design["block"] == f"round{round_index}").any():
+            labels, unit = sweep_designs.refine(design[unit_columns].to_numpy(), fit_losses(design),
+                                                max(1, args.samples // args.rounds), round_index, args.seed)
+            design = add_to_design(design, labels, unit)
+        run_design(design)
+    best = design.assign(loss = fit_losses(design)).nsmallest(5, "loss")
+    print("Best fits:\n" + best[["run_index"] + sweep_parameters + ["loss"]].to_string(index = False), flush = True)
+
+if args.design == "saltelli":
+    results = pd.read_csv(csv_file_name).set_index("run_index").reindex(design["run_index"])
+    indices = []
+    for output in ["fit_growth_rate", "r2_score", "lambda_H", "lambda_W", "lambda_C"]:
+        table = sweep_designs.sobol_indices(design, results[output].to_numpy(dtype = float), seed = args.seed)
+        table.insert(0, "parameter", sweep_parameters)
+        table.insert(0, "output", output)
+        indices.append(table)
+    indices = pd.concat(indices, ignore_index = True)
+    indices_file_name = Path(output_base, "sobol_indices.csv")
+    indices.to_csv(indices_file_name, index = False)
+    print(f"Sobol indices (written to {indices_file_name}):\n" + indices.to_string(index = False), flush = True)
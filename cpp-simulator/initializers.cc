@@ -12,6 +12,9 @@
 #include <string>
 #include <cmath>
 #include <set>
+#include <map>
+#include <memory>
+#include <sys/stat.h>
 
 #include "models.h"
 #include "initializers.h"
@@ -26,11 +29,63 @@ using std::vector;
 using std::set;
 using std::to_string;
 
-auto readJSONFile(string filename){
+namespace {
+  //Parsed input files kept between the runs of a batch (see
+  //GLOBAL.BATCH_CACHE_BYTES), with the size and modification time of the
+  //file when it was read
+  struct json_cache_entry{
+	off_t size;
+	struct timespec mtime;
+	count_type last_used;
+	std::shared_ptr<const rapidjson::Document> document;
+  };
+  std::map<string, json_cache_entry> JSON_CACHE;
+  count_type JSON_CACHE_CLOCK = 0;
+
+  bool same_mtime(const struct timespec& a, const struct timespec& b){
+	return a.tv_sec == b.tv_sec && a.tv_nsec == b.tv_nsec;
+  }
+
+  //Drops the least recently used documents until the cached files add up to
+  //at most budget bytes
+  void trim_json_cache(count_type budget){
+	count_type total = 0;
+	for(const auto& entry: JSON_CACHE){
+	  total += entry.second.size;
+	}
+	while(total > budget && !JSON_CACHE.empty()){
+	  auto oldest = std::min_element(JSON_CACHE.begin(), JSON_CACHE.end(),
+									 [](const auto& a, const auto& b){
+									   return a.second.last_used < b.second.last_used;
+									 });
+	  total -= oldest->second.size;
+	  JSON_CACHE.erase(oldest);
+	}
+  }
+}
+
+std::shared_ptr<const rapidjson::Document> readJSONFile(string filename){
+  struct stat file_stat;
+  bool cache = GLOBAL.BATCH_MODE && GLOBAL.BATCH_CACHE_BYTES > 0
+	&& stat(filename.c_str(), &file_stat) == 0
+	&& count_type(file_stat.st_size) <= GLOBAL.BATCH_CACHE_BYTES;
+  if(cache){
+	auto cached = JSON_CACHE.find(filename);
+	if(cached != JSON_CACHE.end()
+	   && cached->second.size == file_stat.st_size
+	   && same_mtime(cached->second.mtime, file_stat.st_mtim)){
+	  cached->second.last_used = ++JSON_CACHE_CLOCK;
+	  return cached->second.document;
+	}
+  }
   std::ifstream ifs(filename, std::ifstream::in);
   rapidjson::IStreamWrapper isw(ifs);
-  rapidjson::Document d;
-  d.ParseStream(isw);
+  auto d = std::make_shared<rapidjson::Document>();
+  d->ParseStream(isw);
+  if(cache){
+	JSON_CACHE[filename] = {file_stat.st_size, file_stat.st_mtim, ++JSON_CACHE_CLOCK, d};
+	trim_json_cache(GLOBAL.BATCH_CACHE_BYTES);
+  }
   return d;
 }
 
@@ -41,9 +96,75 @@ auto prettyJSON(const rapidjson::Document& d){
   return buffer.GetString();
 }
 
+//Reads the per-house neighbourhood cells precomputed by CityGen from
+//cityMetadata.json. They are used only if the file was written for the same
+//bounding box and cell size as the current run; returns false otherwise, in
+//which case the cells are computed from the house locations as before.
+bool read_nbr_cell_metadata(count_type num_homes, vector<grid_cell>& cells){
+  string filename = GLOBAL.input_base + "cityMetadata.json";
+  std::ifstream ifs(filename, std::ifstream::in);
+  if(!ifs.good()){
+	return false;
+  }
+  rapidjson::IStreamWrapper isw(ifs);
+  rapidjson::Document d;
+  d.ParseStream(isw);
+  if(d.HasParseError() || !d.IsObject()){
+	std::cerr<<"Could not parse "<<filename<<". Computing neighbourhood cells."<<std::endl;
+	return false;
+  }
+
+  const double tolerance = 1e-9;
+  auto matches = [&d, tolerance](const char* key, double value){
+	return d.HasMember(key) && d[key].IsNumber()
+	  && std::abs(d[key].GetDouble() - value) < tolerance;
+  };
+  if(!(matches("CITY_SW_LAT", GLOBAL.city_SW.lat)
+	   && matches("CITY_SW_LON", GLOBAL.city_SW.lon)
+	   && matches("CITY_NE_LAT", GLOBAL.city_NE.lat)
+	   && matches("CITY_NE_LON", GLOBAL.city_NE.lon)
+	   && matches("NBR_CELL_SIZE", GLOBAL.NBR_CELL_SIZE))){
+	std::cerr<<filename<<" was generated for a different bounding box or NBR_CELL_SIZE. "
+			 <<"Computing neighbourhood cells."<<std::endl;
+	return false;
+  }
+  if(!(d.HasMember("house_nbr_cell_x") && d["house_nbr_cell_x"].IsArray()
+	   && d.HasMember("house_nbr_cell_y") && d["house_nbr_cell_y"].IsArray()
+	   && d["house_nbr_cell_x"].Size() == num_homes
+	   && d["house_nbr_cell_y"].Size() == num_homes)){
+	std::cerr<<filename<<" does not match houses.json. Computing neighbourhood cells."<<std::endl;
+	return false;
+  }
+
+  //Same grid dimensions as init_nbr_cells
+  location loc_temp;
+  loc_temp.lat = GLOBAL.city_SW.lat;
+  loc_temp.lon = GLOBAL.city_NE.lon;
+  count_type num_x_grids = ceil(earth_distance(GLOBAL.city_SW,loc_temp)/GLOBAL.NBR_CELL_SIZE);
+  loc_temp.lon = GLOBAL.city_SW.lon;
+  loc_temp.lat = GLOBAL.city_NE.lat;
+  count_type num_y_grids = ceil(earth_distance(GLOBAL.city_SW,loc_temp)/GLOBAL.NBR_CELL_SIZE);
+
+  cells.resize(num_homes);
+  const auto& cells_x = d["house_nbr_cell_x"];
+  const auto& cells_y = d["house_nbr_cell_y"];
+  for(count_type i = 0; i < num_homes; ++i){
+	if(!cells_x[i].IsUint64() || !cells_y[i].IsUint64()
+	   || cells_x[i].GetUint64() >= num_x_grids
+	   || cells_y[i].GetUint64() >= num_y_grids){
+	  std::cerr<<filename<<": neighbourhood cell of house "<<i<<" is out of range. "
+			   <<"Computing neighbourhood cells."<<std::endl;
+	  return false;
+	}
+	cells[i].cell_x = cells_x[i].GetUint64();
+	cells[i].cell_y = cells_y[i].GetUint64();
+  }
+  return true;
+}
+
 vector<house> init_homes(){
   auto houseJSON = readJSONFile(GLOBAL.input_base + "houses.json");
-  auto size = houseJSON.GetArray().Size();
+  auto size = houseJSON->GetArray().Size();
   vector<house> homes(size);
   GLOBAL.num_homes = size;
   double temp_non_compliance_metric = 0;
@@ -51,7 +172,11 @@ vector<house> init_homes(){
 
   bool compliance;
 
-  for (auto &elem: houseJSON.GetArray()){
+  vector<grid_cell> metadata_cells;
+  bool use_metadata_cells = GLOBAL.ENABLE_NBR_CELLS
+	&& read_nbr_cell_metadata(size, metadata_cells);
+
+  for (auto &elem: houseJSON->GetArray()){
     temp_non_compliance_metric = get_non_compliance_metric();
     if(elem.HasMember("slum") && elem["slum"].GetInt()){
 	  compliance = (temp_non_compliance_metric<=GLOBAL.HD_COMPLIANCE_PROBABILITY);
@@ -61,7 +186,11 @@ vector<house> init_homes(){
 	homes[index].set(elem["lat"].GetDouble(),
 					 elem["lon"].GetDouble(),
 					 compliance,
-					 temp_non_compliance_metric);
+					 temp_non_compliance_metric,
+					 !use_metadata_cells);
+	if(use_metadata_cells){
+	  homes[index].neighbourhood = metadata_cells[index];
+	}
 
 	//Cyclic strategy class
 	if(GLOBAL.CYCLIC_POLICY_ENABLED && GLOBAL.CYCLIC_POLICY_TYPE == Cycle_Type::home){
@@ -81,10 +210,10 @@ vector<workplace> init_workplaces() {
   auto schoolJSON = readJSONFile(GLOBAL.input_base + "schools.json");
   auto wpJSON = readJSONFile(GLOBAL.input_base + "workplaces.json");
 
-  auto school_size = schoolJSON.GetArray().Size();
+  auto school_size = schoolJSON->GetArray().Size();
   GLOBAL.num_schools = school_size;
 
-  auto wp_size = wpJSON.GetArray().Size();
+  auto wp_size = wpJSON->GetArray().Size();
   GLOBAL.num_workplaces = wp_size;
 
   auto size = wp_size +  school_size;
@@ -92,7 +221,7 @@ vector<workplace> init_workplaces() {
 
   count_type index = 0;
   // schools come first followed by workspaces, as in the JSON version
-  for (auto &elem: schoolJSON.GetArray()){
+  for (auto &elem: schoolJSON->GetArray()){
 	wps[index].set(elem["lat"].GetDouble(),
 				   elem["lon"].GetDouble(),
 				   WorkplaceType::school);
@@ -104,7 +233,7 @@ vector<workplace> init_workplaces() {
     ++index;
   }
   assert(index == GLOBAL.num_schools);
-  for (auto &elem: wpJSON.GetArray()){
+  for (auto &elem: wpJSON->GetArray()){
 	wps[index].set(elem["lat"].GetDouble(),
 				   elem["lon"].GetDouble(),
 				   WorkplaceType::office);
@@ -123,14 +252,14 @@ vector<workplace> init_workplaces() {
 vector<community> init_community() {
   auto comJSON = readJSONFile(GLOBAL.input_base + "commonArea.json");
 
-  auto size = comJSON.GetArray().Size();
+  auto size = comJSON->GetArray().Size();
   GLOBAL.num_communities = size;
 
   vector<community> communities(size);
 
   count_type index = 0;
 
-  for (auto &elem: comJSON.GetArray()){
+  for (auto &elem: comJSON->GetArray()){
 	communities[index].set(elem["lat"].GetDouble(),
 						   elem["lon"].GetDouble(),
 						   elem["wardNo"].GetInt());
@@ -198,10 +327,10 @@ vector<intervention_params> init_intervention_params(){
 	std::cout<<std::endl<<"Inside init_intervention_params";
 	auto intvJSON = readJSONFile(GLOBAL.input_base + GLOBAL.intervention_filename);
 
-	intv_params.reserve(intvJSON.GetArray().Size());
+	intv_params.reserve(intvJSON->GetArray().Size());
 
 	int index = 0;
-	for (auto &elem: intvJSON.GetArray()){
+	for (auto &elem: intvJSON->GetArray()){
 	  intervention_params temp;
 	  if((elem.HasMember("num_days")) && (elem["num_days"].GetInt() > 0)){
 		temp.num_days = elem["num_days"].GetInt();
@@ -414,9 +543,9 @@ vector<testing_probability> init_testing_protocol(){
 	std::cout<<std::endl<<"Inside init_testing_protocol";
 	auto testProtJSON = readJSONFile(GLOBAL.input_base + GLOBAL.testing_protocol_filename);
 
-	testing_protocol.reserve(testProtJSON.GetArray().Size());
+	testing_protocol.reserve(testProtJSON->GetArray().Size());
 	count_type index = 0;
-	for (auto &elem: testProtJSON.GetArray()){
+	for (auto &elem: testProtJSON->GetArray()){
 	  testing_probability temp;
 	  if((elem.HasMember("num_days")) && (elem["num_days"].GetInt() > 0)){
 		temp.num_days = elem["num_days"].GetInt();
@@ -606,14 +735,14 @@ vector<testing_probability> init_testing_protocol(){
 
 vector<double> compute_prob_infection_given_community(double infection_probability, bool set_uniform){
   auto fracPopJSON = readJSONFile(GLOBAL.input_base + "fractionPopulation.json");
-  auto num_communities = fracPopJSON.GetArray().Size();
+  auto num_communities = fracPopJSON->GetArray().Size();
   if(set_uniform){
 	return vector<double>(num_communities, infection_probability);
   }
   else {
 	auto fracQuarantinesJSON = readJSONFile(GLOBAL.input_base + "quarantinedPopulation.json");
-	const rapidjson::Value& quar_array = fracQuarantinesJSON.GetArray();
-	const rapidjson::Value& frac_array = fracPopJSON.GetArray();
+	const rapidjson::Value& quar_array = *fracQuarantinesJSON;
+	const rapidjson::Value& frac_array = *fracPopJSON;
 	vector<double> prob_infec_given_community(num_communities);
 	for(count_type index = 0; index < num_communities; ++index){
 	  prob_infec_given_community[index] =
@@ -673,7 +802,7 @@ void set_node_initial_infection(agent& node,
 
 vector<agent> init_nodes(){
   auto indivJSON = readJSONFile(GLOBAL.input_base + "individuals.json");
-  auto size = indivJSON.GetArray().Size();
+  auto size = indivJSON->GetArray().Size();
   GLOBAL.num_people = size;
   vector<agent> nodes(size);
   auto community_infection_prob = compute_prob_infection_given_community(GLOBAL.INIT_FRAC_INFECTED, GLOBAL.USE_SAME_INFECTION_PROB_FOR_ALL_WARDS);
@@ -683,7 +812,7 @@ vector<agent> init_nodes(){
   vector<count_type> seed_candidates;
   seed_candidates.reserve(size);
 
-  for (auto &elem: indivJSON.GetArray()){
+  for (auto &elem: indivJSON->GetArray()){
  	nodes[i].loc = location{elem["lat"].GetDouble(),
 							elem["lon"].GetDouble()};
 
@@ -822,10 +951,10 @@ vector<agent> init_nodes(){
 vector<double> read_JSON_convert_array(const string& file_name){
   vector<double> return_object;
   auto file_JSON = readJSONFile(GLOBAL.input_base + "age_tx/" + file_name);
-  auto size = file_JSON.GetArray().Size();
+  auto size = file_JSON->GetArray().Size();
   return_object.resize(size);
   int i = 0;
-  for (auto &elem: file_JSON.GetArray()){
+  for (auto &elem: file_JSON->GetArray()){
     return_object[i] = elem[to_string(i).c_str()].GetDouble();
     i += 1;
   }
@@ -835,10 +964,10 @@ vector<double> read_JSON_convert_array(const string& file_name){
 matrix<double> read_JSON_convert_matrix(const string& file_name){
   matrix<double> return_object;
   auto file_JSON = readJSONFile(GLOBAL.input_base + "age_tx/" + file_name);
-  auto size = file_JSON.GetArray().Size();
+  auto size = file_JSON->GetArray().Size();
   return_object.resize(size, vector<double>(size));
   int i = 0;
-  for (auto &elem: file_JSON.GetArray()){
+  for (auto &elem: file_JSON->GetArray()){
     for (count_type j = 0; j < size; ++j){
        return_object[i][j] = elem[to_string(j).c_str()].GetDouble();
     }
@@ -883,7 +1012,7 @@ svd init_community_age_interaction_matrix(){
 
 matrix<double> compute_community_distances(const vector<community>& communities){
   auto wardDistJSON = readJSONFile(GLOBAL.input_base + "wardCentreDistance.json");
-  const rapidjson::Value& mat = wardDistJSON.GetArray();
+  const rapidjson::Value& mat = *wardDistJSON;
   auto size = mat.Size();
   GLOBAL.num_wards = size;
   matrix<double> dist_matrix(size, vector<double>(size));
@@ -1155,10 +1284,10 @@ void initialize_office_attendance(){
 
   //constexpr count_type NUMBER_OF_OFFICE_TYPES = 6;
   auto attendanceJSON = readJSONFile(GLOBAL.input_base + GLOBAL.attendance_filename);
-  ATTENDANCE.number_of_entries = attendanceJSON.GetArray().Size(); //will change for new file type
+  ATTENDANCE.number_of_entries = attendanceJSON->GetArray().Size(); //will change for new file type
   ATTENDANCE.probabilities.reserve(ATTENDANCE.number_of_entries); //will change for new file type
   count_type index = 0;
-  for(auto& elem: attendanceJSON.GetArray()){
+  for(auto& elem: attendanceJSON->GetArray()){
 	count_type num_days = 1;
 	if(elem.HasMember("num_days")){
 		num_days = elem["num_days"].GetInt();
@@ -1,9 +1,13 @@
+import json
 import os
-import subprocess
+import shutil
 import time
 import itertools
 from multiprocessing import Pool
 
+import batch_sim
+from run_cache import cached_run
+
 BASE_PATH = '/home/sharadshriram/code/iisc/covid/markov_simuls'
 INPUT_PATH = F'{BASE_PATH}/staticInst/data/web_input_files/mumbai_cohorts_100K'
 OUTPUT_PATH = F'{BASE_PATH}/temp_output'
@@ -11,6 +15,9 @@ SIMULATOR_PATH = './drive_simulator'
 
 ITERATIONS_PER_CONFIG = 1
 NUM_DAYS = 20
+CALIBRATION_DELAY = 1
+DAYS_BEFORE_LOCKDOWN = 2
+INTERVENTION_FILENAME = '2020091_intervention_params_community_leakage_factor_1_fix_May18-31.json'
 
 BETA_COHORT = [0.0005]  # '0.0001', '0.0005']
 ISOLATION_POLICY = ['--ISOLATE_COHORTS']
@@ -20,12 +27,40 @@ COHORT_SEVERITY_FRACTION = [0.4]
 COHORT_STRATEGY = [1]
 STORE_STATE_TIME_STEP = 0
 LOAD_STATE_TIME_STEP = 0
+SIM_STEPS_PER_DAY = 4
+# Time series each run writes (drive_simulator --outputs): full, dashboard,
+# calibration or a comma-separated list of names
+OUTPUTS = 'full'
 ONE_OFF_TRAVELERS_RATIO = [0.0]
 # FRACTION_IN_TRAINS = [0.1, 0.5, 1.0]
 
 MAX_CONFIGS_TO_RUN = 0
 PROC_TO_RUN = 1
 
+# Used when the input folder has no cityMetadata.json (cities generated
+# before CityGen started writing it).
+CITY_BOUNDS = {
+    'CITY_SW_LAT': '18.89395643371942',
+    'CITY_NE_LAT': '19.270176667777736',
+    'CITY_SW_LON': '72.77633295153348',
+    'CITY_NE_LON': '72.97973149704592',
+}
+
+
+def city_bounds_args(input_path):
+    '''Bounding box (and neighbourhood cell size) options for the city in input_path.'''
+    bounds = dict(CITY_BOUNDS)
+    metadata_file = os.path.join(input_path, 'cityMetadata.json')
+    if os.path.isfile(metadata_file):
+        with open(metadata_file) as f:
+            metadata = json.load(f)
+        bounds = {k: F'{metadata[k]}' for k in
+                  ['CITY_SW_LAT', 'CITY_NE_LAT', 'CITY_SW_LON', 'CITY_NE_LON', 'NBR_CELL_SIZE']}
+    args = []
+    for k, v in bounds.items():
+        args += [F'--{k}', v]
+    return args
+
 
 def make_folder_if_not_exist(path):
     '''Returns if sim should run.'''
@@ -44,6 +79,82 @@ def make_folder_if_not_exist(path):
         return False
 
 
+def simulator_args(beta, cohortSize, crowdingFactor, isolationPolicy,
+                   cohortSeverityFraction, cohortStrategy, oneOff, outputPath,
+                   numDays=NUM_DAYS, storeStep=STORE_STATE_TIME_STEP,
+                   loadStep=LOAD_STATE_TIME_STEP, loadFile=None):
+    args = [F'{SIMULATOR_PATH}',
+            '--SEED_FIXED_NUMBER',
+            '--NUM_DAYS', F'{numDays}',
+            *city_bounds_args(INPUT_PATH),
+            '--INIT_FRAC_INFECTED', '0.00001',
+            '--INIT_FIXED_NUMBER_INFECTED', '100',
+            '--MEAN_INCUBATION_PERIOD', '4.6',
+            '--MEAN_ASYMPTOMATIC_PERIOD', '0.5',
+            '--MEAN_SYMPTOMATIC_PERIOD', '5',
+            '--SYMPTOMATIC_FRACTION', '0.67',
+            '--MEAN_HOSPITAL_REGULAR_PERIOD', '8',
+            '--MEAN_HOSPITAL_CRITICAL_PERIOD', '8',
+            '--F_KERNEL_A', '2.709',
+            '--F_KERNEL_B', '1.279',
+            '--BETA_H', '0.792844',
+            '--BETA_W', '0.141709',
+            '--BETA_C', '0.0149375',
+            '--BETA_S', '0.283418',
+            '--BETA_PROJECT', '1.2753',
+            '--BETA_CLASS', '2.5507',
+            '--BETA_RANDOM_COMMUNITY', '0.1344',
+            '--BETA_NBR_CELLS', '0.1344',
+            '--BETA_TRAVEL', '0',
+            '--HD_AREA_FACTOR', '2.0',
+            '--HD_AREA_EXPONENT', '0',
+            '--INTERVENTION', '16',
+            '--output_directory', F'{outputPath}',
+            '--input_directory', F'{INPUT_PATH}',
+            '--IGNORE_ATTENDANCE_FILE',
+            '--ENABLE_NBR_CELLS',
+            '--CALIBRATION_DELAY', F'{CALIBRATION_DELAY}',
+            '--DAYS_BEFORE_LOCKDOWN', F'{DAYS_BEFORE_LOCKDOWN}',
+            '--FIRST_PERIOD', '3',
+            '--SECOND_PERIOD', '4',
+            '--THIRD_PERIOD', '5',
+            '--OE_SECOND_PERIOD', '6',
+            '--ENABLE_TESTING',
+            '--LOCKED_COMMUNITY_LEAKAGE', '0.25',
+            '--TESTING_PROTOCOL', '2',
+            '--attendance_filename', 'mumbai_attendance.json',
+            '--testing_protocol_filename', 'testing_protocol.json',
+            '--MASK_ACTIVE',
+            '--MASK_FACTOR', '0.8',
+            '--MASK_START_DELAY', '5',
+            '--PROVIDE_INITIAL_SEED_GRAPH', '4123',
+            '--PROVIDE_INITIAL_SEED', '1723530071',
+            '--intervention_filename', F'{INTERVENTION_FILENAME}',
+            '--ENABLE_CONTAINMENT',
+            '--ENABLE_COHORTS',
+            '--COHORT_SIZE', F'{cohortSize}',
+            '--BETA_COHORT', F'{beta}',
+            '--CROWDING_FACTOR_COHORTS', F'{crowdingFactor}',
+            '--COHORT_SEVERITY_FRACTION', F'{cohortSeverityFraction}',
+            '--COHORT_STRATEGY', F'{cohortStrategy}',
+            '--STORE_STATE_TIME_STEP', F'{storeStep}',
+            '--LOAD_STATE_TIME_STEP', F'{loadStep}',
+            '--ONE_OFF_TRAVELERS_RATIO', F'{oneOff}',
+            '--outputs', OUTPUTS,
+            F'{isolationPolicy}']
+    if loadFile is not None:
+        args += ['--agent_load_file', loadFile]
+    return args
+
+
+def run_simulator(args, outputPath, cache=True):
+    streams = dict(stdout=open(F'{outputPath}/cout.txt', 'w'),
+                   stderr=open(F'{outputPath}/cerr.txt', 'w'))
+    if not cache:
+        return batch_sim.run(args, **streams).returncode
+    return cached_run(args, outputPath, **streams)
+
+
 def launch_proc_with_config(
         jobNum, beta, cohortSize, crowdingFactor, 
         isolationPolicy, cohortSeverityFraction, cohortStrategy,
@@ -55,69 +166,117 @@ def launch_proc_with_config(
 
     sleep_duration = 23 * (jobNum % PROC_TO_RUN)
     time.sleep(sleep_duration)
-    subprocess.run(args=[F'{SIMULATOR_PATH}',
-                         '--SEED_FIXED_NUMBER',
-                         '--NUM_DAYS', F'{NUM_DAYS}',
-                         '--CITY_SW_LAT', '18.89395643371942',
-                         '--CITY_NE_LAT', '19.270176667777736',
-                         '--CITY_SW_LON', '72.77633295153348',
-                         '--CITY_NE_LON', '72.97973149704592',
-                         '--INIT_FRAC_INFECTED', '0.00001',
-                         '--INIT_FIXED_NUMBER_INFECTED', '100',
-                         '--MEAN_INCUBATION_PERIOD', '4.6',
-                         '--MEAN_ASYMPTOMATIC_PERIOD', '0.5',
-                         '--MEAN_SYMPTOMATIC_PERIOD', '5',
-                         '--SYMPTOMATIC_FRACTION', '0.67',
-                         '--MEAN_HOSPITAL_REGULAR_PERIOD', '8',
-                         '--MEAN_HOSPITAL_CRITICAL_PERIOD', '8',
-                         '--F_KERNEL_A', '2.709',
-                         '--F_KERNEL_B', '1.279',
-                         '--BETA_H', '0.792844',
-                         '--BETA_W', '0.141709',
-                         '--BETA_C', '0.0149375',
-                         '--BETA_S', '0.283418',
-                         '--BETA_PROJECT', '1.2753',
-                         '--BETA_CLASS', '2.5507',
-                         '--BETA_RANDOM_COMMUNITY', '0.1344',
-                         '--BETA_NBR_CELLS', '0.1344',
-                         '--BETA_TRAVEL', '0',
-                         '--HD_AREA_FACTOR', '2.0',
-                         '--HD_AREA_EXPONENT', '0',
-                         '--INTERVENTION', '16',
-                         '--output_directory', F'{outputPath}',
-                         '--input_directory', F'{INPUT_PATH}',
-                         '--IGNORE_ATTENDANCE_FILE',
-                         '--ENABLE_NBR_CELLS',
-                         '--CALIBRATION_DELAY', '1',
-                         '--DAYS_BEFORE_LOCKDOWN', '2',
-                         '--FIRST_PERIOD', '3',
-                         '--SECOND_PERIOD', '4',
-                         '--THIRD_PERIOD', '5',
-                         '--OE_SECOND_PERIOD', '6',
-                         '--ENABLE_TESTING',
-                         '--LOCKED_COMMUNITY_LEAKAGE', '0.25',
-                         '--TESTING_PROTOCOL', '2',
-                         '--attendance_filename', 'mumbai_attendance.json',
-                         '--testing_protocol_filename', 'testing_protocol.json',
-                         '--MASK_ACTIVE',
-                         '--MASK_FACTOR', '0.8',
-                         '--MASK_START_DELAY', '5',
-                         '--PROVIDE_INITIAL_SEED_GRAPH', '4123',
-                         '--PROVIDE_INITIAL_SEED', '1723530071',
-                         '--intervention_filename', '2020091_intervention_params_community_leakage_factor_1_fix_May18-31.json',
-                         '--ENABLE_CONTAINMENT',
-                         '--ENABLE_COHORTS',
-                         '--COHORT_SIZE', F'{cohortSize}',
-                         '--BETA_COHORT', F'{beta}',
-                         '--CROWDING_FACTOR_COHORTS', F'{crowdingFactor}',
-                         '--COHORT_SEVERITY_FRACTION', F'{cohortSeverityFraction}',
-                         '--COHORT_STRATEGY', F'{cohortStrategy}',
-                         '--STORE_STATE_TIME_STEP', F'{STORE_STATE_TIME_STEP}',
-                         '--LOAD_STATE_TIME_STEP', F'{LOAD_STATE_TIME_STEP}',
-                         '--ONE_OFF_TRAVELERS_RATIO', F'{oneOff}', 
-                         F'{isolationPolicy}'],
-                   stdout=open(F'{outputPath}/cout.txt', 'w'),
-                   stderr=open(F'{outputPath}/cerr.txt', 'w'))
+    run_simulator(simulator_args(beta, cohortSize, crowdingFactor, isolationPolicy,
+                                 cohortSeverityFraction, cohortStrategy, oneOff, outputPath),
+                  outputPath)
+
+
+# ---- shared prefixes ----
+#
+# Configs that differ only in cohort options (BETA_COHORT, COHORT_SIZE,
+# CROWDING_FACTOR_COHORTS, ISOLATE_COHORTS, COHORT_SEVERITY_FRACTION,
+# COHORT_STRATEGY) simulate the same days until the trains start running:
+# cohorts only act while GLOBAL.TRAINS_RUNNING. With SHARE_PREFIX, each
+# such group runs those days once (a prefix_* run that stores the agent
+# state with STORE_STATE_TIME_STEP), and every config of the group continues
+# from the stored state (LOAD_STATE_TIME_STEP). The prefix rows are then
+# put in front of each branch's csv files, so the output folders look like
+# those of full runs, except that
+#   - the branches are continuations of one prefix, not independent runs:
+#     only the agents are stored, so the random number generator restarts
+#     at the branch point, and
+#   - the cumulative_mean_fraction_lambda_* series restart there.
+# The branches are therefore not equivalent to full runs (community,
+# containment and cohort state is not stored either), which is why this is
+# off by default: only switch it on for sweeps where that is acceptable.
+# Store/load needs a drive_simulator built with -DENABLE_PROTO (the default
+# Makefiles do not define it); with other builds the prefix stores nothing
+# and the configs are run in full, after the prefix run.
+SHARE_PREFIX = False
+PREFIX_FILE = 'agentStore.pbstore'
+
+
+def trains_start_day():
+    '''First day with trains running under INTERVENTION_FILENAME, or None.'''
+    with open(os.path.join(INPUT_PATH, INTERVENTION_FILENAME)) as f:
+        interventions = json.load(f)
+    day = CALIBRATION_DELAY + DAYS_BEFORE_LOCKDOWN
+    for intervention in interventions:
+        if intervention.get('trains', {}).get('active', False):
+            return day
+        day += intervention['num_days']
+    return None
+
+
+def run_prefix(jobNum, config, prefixPath, day):
+    '''Runs config up to day, storing the agent state. Returns whether it was stored.'''
+    state_file = os.path.join(prefixPath, PREFIX_FILE)
+    if os.path.isfile(state_file):
+        print(F'Prefix state exists for {prefixPath}. Skipping')
+        return True
+    print(F'starting prefix # {jobNum} (days 0-{day})')
+    os.makedirs(prefixPath, exist_ok=True)
+    # The state is stored at the start of step day * SIM_STEPS_PER_DAY, so
+    # the run goes one day further.
+    run_simulator(simulator_args(*config[:7], prefixPath, numDays=day + 1,
+                                 storeStep=day * SIM_STEPS_PER_DAY),
+                  prefixPath)
+    if not os.path.isfile(state_file):
+        print(F'{prefixPath}: no {PREFIX_FILE} (drive_simulator built without ENABLE_PROTO?)')
+        return False
+    return True
+
+
+def stitch_prefix(prefixPath, outputPath, day):
+    '''Prepends the rows of the prefix run before day to the branch csv files.'''
+    for name in os.listdir(outputPath):
+        prefix_file = os.path.join(prefixPath, name)
+        if not name.endswith('.csv') or not os.path.isfile(prefix_file):
+            continue
+        with open(os.path.join(outputPath, name)) as f:
+            branch_lines = f.readlines()
+        with open(prefix_file) as f:
+            prefix_lines = f.readlines()
+        if not branch_lines or not branch_lines[0].startswith('Time,') or branch_lines[0] != prefix_lines[0]:
+            continue
+        early = [line for line in prefix_lines[1:] if float(line.split(',', 1)[0]) < day]
+        with open(os.path.join(outputPath, name), 'w') as f:
+            f.writelines(branch_lines[:1] + early + branch_lines[1:])
+
+
+def launch_branch(jobNum, config, outputPath, prefixPath, day):
+    print(F'starting branch # {jobNum} from day {day}')
+    if not make_folder_if_not_exist(outputPath):
+        print(F'Sim results exist for {outputPath}. Skipping')
+        return
+    load_file = os.path.relpath(os.path.join(prefixPath, PREFIX_FILE), INPUT_PATH)
+    # Not cached: a run whose load fails still exits 0 and writes its
+    # outputs, and must not be served for the branch later.
+    run_simulator(simulator_args(*config[:7], outputPath,
+                                 loadStep=day * SIM_STEPS_PER_DAY, loadFile=load_file),
+                  outputPath, cache=False)
+    with open(F'{outputPath}/cout.txt') as f:
+        loaded = 'Loading state failed' not in f.read()
+    if not loaded:
+        print(F'{outputPath}: loading {load_file} failed, running the config in full')
+        shutil.rmtree(outputPath)
+        os.mkdir(outputPath)
+        run_simulator(simulator_args(*config[:7], outputPath), outputPath)
+        return
+    stitch_prefix(prefixPath, outputPath, day)
+
+
+def config_path(config):
+    isolation_num = '0' if len(config[3]) == 0 else '1'
+    return F'CB_{config[0]}_CS_{config[1]}_CF_{config[2]}_ISO_{isolation_num}_CSF_{config[4]}_STRAT_{config[5]}_ONE_{config[6]}_id_{config[7]}'
+
+
+def prefix_groups(configs):
+    '''Groups of configs (by index) that can share a prefix: same ONE_OFF_TRAVELERS_RATIO and replicate.'''
+    groups = {}
+    for index, config in enumerate(configs):
+        groups.setdefault(config[6:], []).append(index)
+    return groups
 
 
 if not os.path.isdir(INPUT_PATH):
@@ -138,18 +297,38 @@ configs = list(itertools.product(BETA_COHORT,
                                  COHORT_STRATEGY,
                                  ONE_OFF_TRAVELERS_RATIO,
                                  list(range(ITERATIONS_PER_CONFIG))))
+if MAX_CONFIGS_TO_RUN != 0:
+    configs = configs[:MAX_CONFIGS_TO_RUN]
+
+# Prefixes: (key, prefix path) -> config indices, for groups of more than one
+# config when the branch point falls inside the run
+prefixes = {}
+day = trains_start_day() if SHARE_PREFIX and LOAD_STATE_TIME_STEP == 0 and STORE_STATE_TIME_STEP == 0 else None
+if day is not None and 0 < day < NUM_DAYS:
+    for key, indices in prefix_groups(configs).items():
+        if len(indices) > 1:
+            prefixes[F'{OUTPUT_PATH}/prefix_ONE_{key[0]}_id_{key[1]}_day_{day}'] = indices
+    print(F'{len(configs)} configs share {len(prefixes)} prefixes of {day} days')
 
-with Pool(processes=min((os.cpu_count() - 1), PROC_TO_RUN)) as pool:
+with Pool(processes=max(1, min((os.cpu_count() - 1), PROC_TO_RUN))) as pool:
+    prefix_stored = {}
+    for index, (prefixPath, indices) in enumerate(prefixes.items(), start=1):
+        prefix_stored[prefixPath] = pool.apply_async(run_prefix, [index, configs[indices[0]], prefixPath, day])
+
+    branches = {i: prefixPath for prefixPath, indices in prefixes.items() for i in indices}
+    results = []
     for index, config in enumerate(configs, start=1):
-        isolation_num = '0' if len(config[3]) == 0 else '1'
-        config_path = F'CB_{config[0]}_CS_{config[1]}_CF_{config[2]}_ISO_{isolation_num}_CSF_{config[4]}_STRAT_{config[5]}_ONE_{config[6]}_id_{config[7]}'
-        outputPath = F'{OUTPUT_PATH}/{config_path}'
-        pool.apply_async(launch_proc_with_config,
-                         [index, config[0], config[1], config[2], config[3], config[4], config[5], config[6], outputPath])
-        if MAX_CONFIGS_TO_RUN != 0 and index >= MAX_CONFIGS_TO_RUN:
-            break
+        outputPath = F'{OUTPUT_PATH}/{config_path(config)}'
+        prefixPath = branches.get(index - 1)
+        if prefixPath is not None and prefix_stored[prefixPath].get():
+            results.append(pool.apply_async(launch_branch, [index, config, outputPath, prefixPath, day]))
+        else:
+            results.append(pool.apply_async(launch_proc_with_config,
+                                            [index, config[0], config[1], config[2], config[3], config[4], config[5], config[6], outputPath]))
 
     pool.close()
     pool.join()
+    for result in results:
+        result.get()
 
 print("\n\nALL CONFIGS COMPLETE")
@@ -492,6 +492,36 @@ struct global_params{
   count_type STORE_STATE_TIME_STEP = 0;
   count_type LOAD_STATE_TIME_STEP = 0;
 
+  //////////// EARLY TERMINATION //////////////
+  // Stop once more than STOP_FATALITIES people have died (0: never) and,
+  // if STOP_LAMBDA_TOLERANCE > 0, no cumulative mean lambda fraction has
+  // changed by more than STOP_LAMBDA_TOLERANCE over the last day.
+  count_type STOP_FATALITIES = 0;
+  double STOP_LAMBDA_TOLERANCE = 0;
+  count_type STOPPED_AT_TIME_STEP = 0; //Set by run_simulation, 0 if run to completion
+
+  //////////// OUTPUT FORMAT //////////////
+  // output_format "csv": one csv file per time series, with gnuplot_script.gnuplot
+  // and plots.html; "npz": every time series in run.npz; "both".
+  bool OUTPUT_CSV = true;
+  bool OUTPUT_NPZ = false;
+
+  //////////// OUTPUT SELECTION //////////////
+  // Time series written (see set_output_selection in outputs.cc): names, or
+  // name prefixes ending in '*'. OUTPUT_PLOTS also writes
+  // gnuplot_script.gnuplot and plots.html with the csv files.
+  std::string OUTPUTS = "full";
+  std::vector<std::string> OUTPUT_SERIES;
+  bool OUTPUT_PLOTS = true;
+
+  //////////// BATCH MODE //////////////
+  // Set for the runs of drive_simulator --batch.
+  bool BATCH_MODE = false;
+  // --batch_cache_mb: parsed input files are kept from one run of a batch to
+  // the next, up to this many bytes of input files (see readJSONFile). 0: no
+  // caching.
+  count_type BATCH_CACHE_BYTES = 0;
+
 };
 extern global_params GLOBAL;
 
@@ -952,11 +982,14 @@ struct house{
   house(double latitude, double longitude, bool compliance):
 	loc{latitude, longitude}, compliant(compliance) {}
 
-  void set(double latitude, double longitude, bool compliance, double non_compl_metric){
+  //compute_nbr_cell is false when the cell has been precomputed by CityGen
+  //(see read_nbr_cell_metadata in initializers.cc).
+  void set(double latitude, double longitude, bool compliance, double non_compl_metric,
+		   bool compute_nbr_cell = true){
     this->loc = {latitude, longitude};
     this->compliant = compliance;
     this->non_compliance_metric = non_compl_metric;
-	if(GLOBAL.ENABLE_NBR_CELLS){
+	if(GLOBAL.ENABLE_NBR_CELLS && compute_nbr_cell){
 	  set_nbr_cell();  //Requires location to be set
 	}
   }
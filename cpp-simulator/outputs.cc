@@ -5,14 +5,26 @@
 #include <fstream>
 #include <iostream>
 #include <string>
+#include <sstream>
 #include <cassert>
+#include <cstdint>
+#include <type_traits>
+#include <utility>
+#include <algorithm>
+#include <rapidjson/writer.h>
+#include <rapidjson/stringbuffer.h>
 
 using std::string;
 using std::vector;
 using std::endl;
 using std::cerr;
 
+//Files written for the current run, listed in manifest.json. Every output
+//file is opened through check_stream, which adds it here.
+vector<string> OUTPUT_FILES;
+
 void check_stream(const std::ofstream& fout, const std::string& path){
+  OUTPUT_FILES.push_back(path);
   if(!fout){
 	cerr << "simulator: could not open file "
 		 << path << "\n"
@@ -262,7 +274,11 @@ void output_global_params(const string& output_dir){
   // store or load state.
   fout << "STORE_STATE_TIME_STEP: " << GLOBAL.STORE_STATE_TIME_STEP << ";" <<endl;
   fout << "LOAD_STATE_TIME_STEP: " << GLOBAL.LOAD_STATE_TIME_STEP << ";" <<endl;
+  fout << "STOP_FATALITIES: " << GLOBAL.STOP_FATALITIES << ";" <<endl;
+  fout << "STOP_LAMBDA_TOLERANCE: " << GLOBAL.STOP_LAMBDA_TOLERANCE << ";" <<endl;
+  fout << "STOPPED_AT_TIME_STEP: " << GLOBAL.STOPPED_AT_TIME_STEP << ";" <<endl;
   fout << "ONE_OFF_TRAVELERS_RATIO: " << GLOBAL.ONE_OFF_TRAVELERS_RATIO << ";" <<endl;
+  fout << "OUTPUTS: " << GLOBAL.OUTPUTS << ";" <<endl;
 
 
   fout.close();
@@ -323,143 +339,413 @@ gnuplot::~gnuplot(){
 }
 
 
-void output_csv_files(const std::string& output_directory,
-					  gnuplot& gnuplot,
-					  const plot_data_struct& plot_data){
+const std::vector<std::string> CSV_CONTENT_FIELDS = {"community",
+  "affected",
+  "susceptible",
+  "exposed",
+  "infective",
+  "symptomatic",
+  "hospitalised",
+  "critical",
+  "dead",
+  "recovered",
+  "recovered_from_infective",
+  "recovered_from_symptomatic",
+  "recovered_from_hospitalised",
+  "recovered_from_critical",
+  "hd_area_affected",
+  "hd_area_susceptible",
+  "hd_area_exposed",
+  "hd_area_infective",
+  "hd_area_symptomatic",
+  "hd_area_hospitalised",
+  "hd_area_critical",
+  "hd_area_dead",
+  "hd_area_recovered",
+  "hd_area_recovered_from_infective",
+  "hd_area_recovered_from_symptomatic",
+  "hd_area_recovered_from_hospitalised",
+  "hd_area_recovered_from_critical"
+};
+
+//Presets of the outputs option
+const std::map<string, vector<string>> OUTPUT_PRESETS = {
+  {"full", {"*", "plots"}},
+  //What calibrate_betas/Calibration.py reads (see ensemble_store.py)
+  {"calibration", {"num_fatalities", "cumulative_mean_fraction_lambda_*"}},
+  //Headline counts, testing, quarantine and ward statistics, with plots
+  {"dashboard", {"num_*", "disease_label_stats", "quarantined_stats", "ward_infected", "plots"}},
+};
+
+void set_output_selection(const std::string& outputs){
+  //Called once per run, as the options are read
+  OUTPUT_FILES.clear();
+  GLOBAL.OUTPUTS = outputs;
+  GLOBAL.OUTPUT_SERIES.clear();
+  GLOBAL.OUTPUT_PLOTS = false;
+  std::stringstream tokens(outputs);
+  string token;
+  while(std::getline(tokens, token, ',')){
+	if(token.empty()){
+	  continue;
+	}
+	auto preset = OUTPUT_PRESETS.find(token);
+	for(const auto& item: (preset == OUTPUT_PRESETS.end()) ? vector<string>{token} : preset->second){
+	  if(item == "plots"){
+		GLOBAL.OUTPUT_PLOTS = true;
+	  } else {
+		GLOBAL.OUTPUT_SERIES.push_back(item);
+	  }
+	}
+  }
+}
+
+bool matches_output_pattern(const string& name, const string& pattern){
+  if(!pattern.empty() && pattern.back() == '*'){
+	return name.compare(0, pattern.size() - 1, pattern, 0, pattern.size() - 1) == 0;
+  }
+  return name == pattern;
+}
+
+bool output_selected(const std::string& name){
+  for(const auto& pattern: GLOBAL.OUTPUT_SERIES){
+	if(matches_output_pattern(name, pattern)){
+	  return true;
+	}
+  }
+  return false;
+}
+
+//Calls f(group, name, fields, data, plot) for every time series in
+//plot_data, in the order of the csv files: group is the plot_data member,
+//fields the column names after Time, and plot whether the series gets a
+//gnuplot plot.
+template <class F>
+void enumerate_series(const plot_data_struct& plot_data, F f){
   for(const auto& elem: plot_data.nums){
-	std::string csvfile_name = elem.first + ".csv";
-	std::string csvfile_path = output_directory + "/" + csvfile_name;
 	if(elem.first == "csvContent"){
 	  //This file contains everything!
-	  output_timed_csv({"community",
-						"affected",
-						"susceptible",
-						"exposed",
-						"infective",
-						"symptomatic",
-						"hospitalised",
-						"critical",
-						"dead",
-						"recovered",
-						"recovered_from_infective",
-						"recovered_from_symptomatic",
-						"recovered_from_hospitalised",
-						"recovered_from_critical",
-						"hd_area_affected",
-						"hd_area_susceptible",
-						"hd_area_exposed",
-                        "hd_area_infective",
-						"hd_area_symptomatic",
-                        "hd_area_hospitalised",
-                        "hd_area_critical",
-                        "hd_area_dead",
-						"hd_area_recovered",
-						"hd_area_recovered_from_infective",
-						"hd_area_recovered_from_symptomatic",
-						"hd_area_recovered_from_hospitalised",
-						"hd_area_recovered_from_critical"
-		},
-		csvfile_path, elem.second);
+	  f("nums", elem.first, CSV_CONTENT_FIELDS, elem.second, false);
 	} else {
-	  output_timed_csv({elem.first},
-					   csvfile_path,
-					   elem.second);
-	  gnuplot.plot_data(elem.first);
+	  f("nums", elem.first, {elem.first}, elem.second, true);
 	}
   }
 
   //Now output lambdas
   for(const auto& elem: plot_data.susceptible_lambdas){
-	std::string csvfile_name = elem.first + ".csv";
-	std::string csvfile_path = output_directory + "/" + csvfile_name;
-	output_timed_csv({elem.first},
-					 csvfile_path,
-					 elem.second);
-	gnuplot.plot_data(elem.first);
+	f("susceptible_lambdas", elem.first, {elem.first}, elem.second, true);
   }
 
   //Now output fractional lambda contributions: total version
   for(const auto& elem: plot_data.total_lambda_fractions){
-	std::string csvfile_name = elem.first + ".csv";
-	std::string csvfile_path = output_directory + "/" + csvfile_name;
-	output_timed_csv({elem.first},
-					 csvfile_path,
-					 elem.second);
-	gnuplot.plot_data(elem.first);
+	f("total_lambda_fractions", elem.first, {elem.first}, elem.second, true);
   }
 
   //Now output fractional lambda contributions: mean version
   for(const auto& elem: plot_data.mean_lambda_fractions){
-	std::string csvfile_name = elem.first + ".csv";
-	std::string csvfile_path = output_directory + "/" + csvfile_name;
-	output_timed_csv({elem.first},
-					 csvfile_path,
-					 elem.second);
-	gnuplot.plot_data(elem.first);
+	f("mean_lambda_fractions", elem.first, {elem.first}, elem.second, true);
   }
 
   //Now output fractional lambda contributions: cumulative mean version
   for(const auto& elem: plot_data.cumulative_mean_lambda_fractions){
-	std::string csvfile_name = elem.first + ".csv";
-	std::string csvfile_path = output_directory + "/" + csvfile_name;
-	output_timed_csv({elem.first},
-					 csvfile_path,
-					 elem.second);
-	gnuplot.plot_data(elem.first);
+	f("cumulative_mean_lambda_fractions", elem.first, {elem.first}, elem.second, true);
   }
 
   //Now output infections by individuals that became infective at this time
   for(const auto& elem: plot_data.infections_by_new_infectives){
-	std::string csvfile_name = elem.first + ".csv";
-	std::string csvfile_path = output_directory + "/" + csvfile_name;
-	output_timed_csv({elem.first},
-					 csvfile_path,
-					 elem.second);
-	gnuplot.plot_data(elem.first);
+	f("infections_by_new_infectives", elem.first, {elem.first}, elem.second, true);
   }
 
   for(const auto& elem: plot_data.quarantined_stats){
-    std::string csvfile_name = elem.first + ".csv";
-    std::string csvfile_path = output_directory + "/" + csvfile_name;
-    //This file contains quarantine_stats
-    output_timed_csv({"quarantined_individuals",
-            "quarantined_infectious",
-            "quarantined_cases","quarantined_individuals_cohorts","quarantined_infectious_cohorts"},
-    csvfile_path, elem.second);
+	f("quarantined_stats", elem.first,
+	  {"quarantined_individuals",
+	   "quarantined_infectious",
+	   "quarantined_cases","quarantined_individuals_cohorts","quarantined_infectious_cohorts"},
+	  elem.second, false);
   }
 
   for(const auto& elem: plot_data.curtailment_stats){
-    std::string csvfile_name = elem.first + ".csv";
-    std::string csvfile_path = output_directory + "/" + csvfile_name;
-    //This file contains quarantine_stats
-    output_timed_csv({"normal_interactions",
-            "curtailed_interactions"},
-    csvfile_path, elem.second);
+	f("curtailment_stats", elem.first,
+	  {"normal_interactions",
+	   "curtailed_interactions"},
+	  elem.second, false);
   }
   for(const auto& elem: plot_data.disease_label_stats){
-    std::string csvfile_name = elem.first + ".csv";
-    std::string csvfile_path = output_directory + "/" + csvfile_name;
-    //This file contains quarantine_stats
-    output_timed_csv({"primary_contact",
-            "mild_symptomatic_tested",
-            "moderate_symptomatic_tested",
-            "severe_symptomatic_tested",
-            "icu","requested_tests","cumulative_positive_cases"},
-    csvfile_path, elem.second);
+	f("disease_label_stats", elem.first,
+	  {"primary_contact",
+	   "mild_symptomatic_tested",
+	   "moderate_symptomatic_tested",
+	   "severe_symptomatic_tested",
+	   "icu","requested_tests","cumulative_positive_cases"},
+	  elem.second, false);
   }
   for(const auto& elem: plot_data.ward_wise_stats){
-	std::string csvfile_name = elem.first + ".csv";
-	std::string csvfile_path = output_directory + "/" + csvfile_name;
-	output_timed_csv({elem.first}, csvfile_path, elem.second);	
-  }  
+	f("ward_wise_stats", elem.first, {elem.first}, elem.second, false);
+  }
   if(GLOBAL.ENABLE_COHORTS){
-    for(const auto& elem: plot_data.coach_stats){
-      std::string csvfile_name = elem.first + ".csv";
-      std::string csvfile_path = output_directory + "/" + csvfile_name;
-      //This file contains quarantine_stats
-      output_timed_csv({"train_coaches_am",
-              "train_coaches_pm"},
-      csvfile_path, elem.second);
-    }
+	for(const auto& elem: plot_data.coach_stats){
+	  f("coach_stats", elem.first,
+		{"train_coaches_am",
+		 "train_coaches_pm"},
+		elem.second, false);
+	}
   }
 }
+
+//enumerate_series for every selected time series (every one with all),
+//each name once. A name can come up in two groups (quarantined_stats has a
+//curtailment_stats entry that is never filled); the last one wins, as it
+//did when it overwrote the csv file of the first.
+template <class F>
+void for_each_series(const plot_data_struct& plot_data, F f_selected, bool all = false){
+  std::map<string, string> last_group;
+  enumerate_series(plot_data, [&](const string& group, const string& name,
+								  const vector<string>& fields, const auto& data, bool plot){
+	last_group[name] = group;
+  });
+  enumerate_series(plot_data, [&](const string& group, const string& name,
+								  const vector<string>& fields, const auto& data, bool plot){
+	if(last_group[name] == group && (all || output_selected(name))){
+	  f_selected(group, name, fields, data, plot);
+	}
+  });
+}
+
+void output_csv_files(const std::string& output_directory,
+					  gnuplot* gnuplot,
+					  const plot_data_struct& plot_data){
+  for_each_series(plot_data, [&](const string& group, const string& name,
+								 const vector<string>& fields, const auto& data, bool plot){
+	output_timed_csv(fields, output_directory + "/" + name + ".csv", data);
+	if(plot && gnuplot){
+	  gnuplot->plot_data(name);
+	}
+  });
+}
+
+
+//////////// NPZ OUTPUT //////////////
+//run.npz is an uncompressed zip archive of .npy arrays, as written by
+//numpy.savez, so numpy.load reads it directly. For every series NAME:
+//  NAME.npy       values [time, field], in the type of the series
+//  time/NAME.npy  float64 [time], in days
+//and metadata.json gives the fields and plot_data group of each series
+//and the run's global_params.txt. Values are written in the byte order of
+//the machine, which is assumed to be little-endian.
+
+template <class T> struct npy_type{};
+template <> struct npy_type<count_type>{ using type = uint64_t; static constexpr const char* descr = "<u8"; };
+template <> struct npy_type<int>{ using type = int32_t; static constexpr const char* descr = "<i4"; };
+template <> struct npy_type<double>{ using type = double; static constexpr const char* descr = "<f8"; };
+template <> struct npy_type<long double>{ using type = double; static constexpr const char* descr = "<f8"; };
+
+uint32_t crc32(const string& data){
+  static uint32_t table[256] = {0};
+  if(!table[1]){
+	for(uint32_t i = 0; i < 256; ++i){
+	  uint32_t c = i;
+	  for(int k = 0; k < 8; ++k){
+		c = (c & 1) ? 0xEDB88320u ^ (c >> 1) : c >> 1;
+	  }
+	  table[i] = c;
+	}
+  }
+  uint32_t crc = 0xFFFFFFFFu;
+  for(unsigned char byte: data){
+	crc = table[(crc ^ byte) & 0xFF] ^ (crc >> 8);
+  }
+  return crc ^ 0xFFFFFFFFu;
+}
+
+template <class T>
+void append_bytes(string& out, T value){
+  out.append(reinterpret_cast<const char*>(&value), sizeof(T));
+}
+
+//.npy file (format version 1.0) of a [rows, cols] array
+string npy_array(const char* descr, const string& data, size_t rows, size_t cols){
+  string header = string("{'descr': '") + descr + "', 'fortran_order': False, 'shape': ("
+	+ std::to_string(rows) + ", " + (cols ? std::to_string(cols) : "") + "), }";
+  //Magic, version and header length take 10 bytes; the header ends with a
+  //newline and pads the whole preamble to a multiple of 64 bytes
+  header.append(63 - (10 + header.size()) % 64, ' ');
+  header += '\n';
+  string out("\x93NUMPY\x01\x00", 8);
+  append_bytes<uint16_t>(out, header.size());
+  return out + header + data;
+}
+
+void output_zip(const string& path, const vector<std::pair<string, string>>& entries){
+  std::ofstream fout(path, std::ios::out | std::ios::binary);
+  check_stream(fout, path);
+  string central;
+  uint32_t offset = 0;
+  for(const auto& entry: entries){
+	const string& name = entry.first;
+	const string& data = entry.second;
+	uint32_t crc = crc32(data);
+	string local;
+	append_bytes<uint32_t>(local, 0x04034b50); //local file header
+	append_bytes<uint16_t>(local, 20); //version needed
+	append_bytes<uint16_t>(local, 0); //flags
+	append_bytes<uint16_t>(local, 0); //stored, no compression
+	append_bytes<uint16_t>(local, 0); //time
+	append_bytes<uint16_t>(local, 0x21); //date: 1980-01-01
+	append_bytes<uint32_t>(local, crc);
+	append_bytes<uint32_t>(local, data.size());
+	append_bytes<uint32_t>(local, data.size());
+	append_bytes<uint16_t>(local, name.size());
+	append_bytes<uint16_t>(local, 0); //extra field length
+	local += name;
+
+	append_bytes<uint32_t>(central, 0x02014b50); //central directory header
+	append_bytes<uint16_t>(central, 20); //version made by
+	central.append(local, 4, 26); //version needed .. extra field length
+	append_bytes<uint16_t>(central, 0); //comment length
+	append_bytes<uint16_t>(central, 0); //disk number
+	append_bytes<uint16_t>(central, 0); //internal attributes
+	append_bytes<uint32_t>(central, 0); //external attributes
+	append_bytes<uint32_t>(central, offset);
+	central += name;
+
+	fout.write(local.data(), local.size());
+	fout.write(data.data(), data.size());
+	offset += local.size() + data.size();
+  }
+  string end;
+  append_bytes<uint32_t>(end, 0x06054b50); //end of central directory
+  append_bytes<uint16_t>(end, 0);
+  append_bytes<uint16_t>(end, 0);
+  append_bytes<uint16_t>(end, entries.size());
+  append_bytes<uint16_t>(end, entries.size());
+  append_bytes<uint32_t>(end, central.size());
+  append_bytes<uint32_t>(end, offset);
+  append_bytes<uint16_t>(end, 0); //comment length
+  fout.write(central.data(), central.size());
+  fout.write(end.data(), end.size());
+  fout.close();
+}
+
+void output_npz_file(const std::string& output_directory, const plot_data_struct& plot_data){
+  vector<std::pair<string, string>> entries;
+  rapidjson::StringBuffer buffer;
+  rapidjson::Writer<rapidjson::StringBuffer> writer(buffer);
+  writer.StartObject();
+  writer.Key("format");
+  writer.String("drive_simulator run.npz");
+  writer.Key("version");
+  writer.Int(1);
+  writer.Key("SIM_STEPS_PER_DAY");
+  writer.Uint64(GLOBAL.SIM_STEPS_PER_DAY);
+  writer.Key("series");
+  writer.StartObject();
+  for_each_series(plot_data, [&](const string& group, const string& name,
+								 const vector<string>& fields, const auto& data, bool plot){
+	using value_type = typename std::decay_t<decltype(std::get<1>(data[0]))>::value_type;
+	using stored_type = typename npy_type<value_type>::type;
+	string times, values;
+	times.reserve(data.size() * sizeof(double));
+	values.reserve(data.size() * fields.size() * sizeof(stored_type));
+	for(const auto& row: data){
+	  append_bytes<double>(times, double(std::get<0>(row))/GLOBAL.SIM_STEPS_PER_DAY);
+	  assert(std::get<1>(row).size() == fields.size());
+	  for(const auto& value: std::get<1>(row)){
+		append_bytes<stored_type>(values, value);
+	  }
+	}
+	entries.emplace_back(name + ".npy", npy_array(npy_type<value_type>::descr, values, data.size(), fields.size()));
+	entries.emplace_back("time/" + name + ".npy", npy_array("<f8", times, data.size(), 0));
+
+	writer.Key(name.c_str());
+	writer.StartObject();
+	writer.Key("group");
+	writer.String(group.c_str());
+	writer.Key("fields");
+	writer.StartArray();
+	for(const auto& field: fields){
+	  writer.String(field.c_str());
+	}
+	writer.EndArray();
+	writer.EndObject();
+  });
+  writer.EndObject();
+
+  std::ifstream params(output_directory + "/global_params.txt");
+  if(params.good()){
+	std::stringstream text;
+	text << params.rdbuf();
+	writer.Key("global_params");
+	writer.String(text.str().c_str());
+  }
+  writer.EndObject();
+  entries.emplace_back("metadata.json", buffer.GetString());
+
+  output_zip(output_directory + "/run.npz", entries);
+}
+
+
+void output_manifest(const std::string& output_directory, const plot_data_struct& plot_data){
+  std::string manifest_path = output_directory + "/manifest.json";
+  std::ofstream fout(manifest_path, std::ios::out);
+  check_stream(fout, manifest_path);
+
+  rapidjson::StringBuffer buffer;
+  rapidjson::Writer<rapidjson::StringBuffer> writer(buffer);
+  writer.StartObject();
+  writer.Key("outputs");
+  writer.String(GLOBAL.OUTPUTS.c_str());
+  writer.Key("output_format");
+  writer.String(GLOBAL.OUTPUT_CSV ? (GLOBAL.OUTPUT_NPZ ? "both" : "csv") : "npz");
+  writer.Key("plots");
+  writer.Bool(GLOBAL.OUTPUT_CSV && GLOBAL.OUTPUT_PLOTS);
+
+  writer.Key("series");
+  writer.StartObject();
+  vector<string> recorded;
+  for_each_series(plot_data, [&](const string& group, const string& name,
+								 const vector<string>& fields, const auto& data, bool plot){
+	recorded.push_back(name);
+	if(!output_selected(name)){
+	  return;
+	}
+	writer.Key(name.c_str());
+	writer.StartObject();
+	writer.Key("group");
+	writer.String(group.c_str());
+	writer.Key("fields");
+	writer.StartArray();
+	for(const auto& field: fields){
+	  writer.String(field.c_str());
+	}
+	writer.EndArray();
+	writer.Key("rows");
+	writer.Uint64(data.size());
+	writer.EndObject();
+  }, true);
+  writer.EndObject();
+
+  //Names or patterns of the outputs option that select nothing
+  writer.Key("unmatched");
+  writer.StartArray();
+  for(const auto& pattern: GLOBAL.OUTPUT_SERIES){
+	if(std::none_of(recorded.begin(), recorded.end(),
+					[&](const string& name){ return matches_output_pattern(name, pattern); })){
+	  writer.String(pattern.c_str());
+	  cerr << "simulator: outputs: " << pattern << " matches no time series\n";
+	}
+  }
+  writer.EndArray();
+
+  writer.Key("files");
+  writer.StartArray();
+  auto prefix = output_directory + "/";
+  for(const auto& path: OUTPUT_FILES){
+	auto file = (path.compare(0, prefix.size(), prefix) == 0) ? path.substr(prefix.size()) : path;
+	writer.String(file.c_str());
+  }
+  writer.EndArray();
+  writer.EndObject();
+
+  fout << buffer.GetString() << endl;
+  fout.close();
+}
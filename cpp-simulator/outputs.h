@@ -50,7 +50,20 @@ private:
   std::ofstream html_out;
 };
 
-void output_csv_files(const std::string& output_directory, gnuplot& gnuplot, const plot_data_struct& plot_data);
+//gnuplot may be nullptr: no plots
+void output_csv_files(const std::string& output_directory, gnuplot* gnuplot, const plot_data_struct& plot_data);
+
+//All the time series of a run in output_directory/run.npz (see outputs.cc)
+void output_npz_file(const std::string& output_directory, const plot_data_struct& plot_data);
+
+//Sets GLOBAL.OUTPUT_SERIES and GLOBAL.OUTPUT_PLOTS from the outputs option
+void set_output_selection(const std::string& outputs);
+
+//Whether the time series name is to be written
+bool output_selected(const std::string& name);
+
+//manifest.json: the outputs option and every file written for this run
+void output_manifest(const std::string& output_directory, const plot_data_struct& plot_data);
 
 void check_stream(const std::ofstream& fout, const std::string& path);
 
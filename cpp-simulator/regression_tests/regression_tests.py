@@ -1,575 +1,287 @@
-import os
+# Regression tests for drive_simulator: every test in tests.json is a seeded
+# simulator run whose outputs are compared with reference_files/<test id>.
+#
+# tests.json holds the default options and flags and, for each test, its id
+# and the options/flags it changes. A test may also have
+#   "extends": id of an earlier test to start from instead of the defaults,
+#   "after":   ids of tests whose outputs it reads (they are run first and
+#              always selected with it),
+#   "timeout": seconds, instead of --timeout.
+#
+# Tests run concurrently, one simulator process per worker (-j). Each test
+# writes to its own output_files/<test id>, emptied before the run, and its
+# simulator output goes to logs/<test id>.out and .err. Results are
+# written to regression_results.txt, and optionally as JUnit XML and JSON;
+# the exit status is 1 unless every test passed. A test without
+# reference_files/<test id> is skipped, which does not count as passing.
+#
+#   python regression_tests.py                     all tests
+#   python regression_tests.py -k intervention_1 -k 'smaller_*' -j 4
+#   python regression_tests.py --list
+#   python regression_tests.py --junit results.xml --json results.json
+
+import argparse
+import concurrent.futures
 import filecmp
+import fnmatch
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+invocation_directory = os.getcwd()
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append("..")
+import run_cache
+
+tests_file = "tests.json"
+output_root = "./output_files/"
+log_root = "./logs/"
+default_timeout = 3600
 
-os.chdir(os.path.dirname(__file__))
-
-default_options = {}
-default_flags={}
-default_options['--NUM_DAYS'] = 20
-default_options['--INIT_FRAC_INFECTED'] = 0.001
-default_options['--MEAN_INCUBATION_PERIOD'] = 2.3 * 2
-default_options['--MEAN_ASYMPTOMATIC_PERIOD'] = 0.5
-default_options['--MEAN_SYMPTOMATIC_PERIOD'] =5
-default_options['--SYMPTOMATIC_FRACTION'] =0.67
-default_options['--MEAN_HOSPITAL_REGULAR_PERIOD'] =8
-default_options['--MEAN_HOSPITAL_CRITICAL_PERIOD'] =8
-default_options['--COMPLIANCE_PROBABILITY'] =0.9
-default_options['--F_KERNEL_A'] =10.751
-default_options['--F_KERNEL_B'] =5.384
-default_options['--BETA_H'] =1.0925
-default_options['--BETA_W'] =0.524166
-default_options['--BETA_C'] =0.206177
-default_options['--BETA_S'] =1.04833
-default_options['--BETA_TRAVEL'] =0
-default_options['--HD_AREA_FACTOR'] = 1.0
-default_options['--HD_AREA_EXPONENT'] = 0
-default_options['--INTERVENTION'] =0
-default_options['--output_directory'] ="./output_files/"
-default_options['--input_directory'] ="../../staticInst/data/web_input_files/bengaluru/"
-default_options['--CALIBRATION_DELAY'] =1
-default_options['--DAYS_BEFORE_LOCKDOWN'] =2
-default_options['--FIRST_PERIOD'] =3
-default_options['--SECOND_PERIOD'] =4
-default_options['--THIRD_PERIOD'] =5
-default_options['--OE_SECOND_PERIOD'] =6
-default_options['--BETA_CLASS']=0
-default_options['--BETA_PROJECT']=0
-default_options['--BETA_RANDOM_COMMUNITY']=0
-default_options['--BETA_NBR_CELLS']=0
-default_flags['--ENABLE_TESTING']= False
-# Set this to "--SEED_HD_AREA_POPULATION" to seed hd area population
-# as well.
-# SEED_HD_AREA_POPULATION="--SEED_HD_AREA_POPULATION"
-default_flags['--SEED_HD_AREA_POPULATION'] = False
-# Set this to "--SEED_ONLY_NON_COMMUTER" to seed only those who do not
-# take public transit
-# SEED_ONLY_NON_COMMUTER="--SEED_ONLY_NON_COMMUTER"
-default_flags['--SEED_ONLY_NON_COMMUTER'] = False
-# Set this to "--SEED_FIXED_NUMBER" to seed only a fixed number of
-# people. In this case, the value of INIT_FRAC_INFECTED will be
-# ignored in favour of the value of INIT_FIXED_NUMBER_INFECTED
-default_flags['--SEED_FIXED_NUMBER'] = True
-default_flags['--IGNORE_ATTENDANCE_FILE'] = True
-#SEED_FIXED_NUMBER=
-default_options['--INIT_FIXED_NUMBER_INFECTED'] =100
-default_options['--LOCKED_COMMUNITY_LEAKAGE'] =1 #0.25
-default_options['--PROVIDE_INITIAL_SEED'] = 1234
-
-#print(default_options)
 
 ###############
-def launch_test(params,flags):
-	os.system("mkdir -p "+params['--output_directory'])
-	command="time"+ " "
-	command+="../drive_simulator "
-	for key, value in params.items():
-		command+=(" "+key+" "+ str(value))
-	
-	for key, value in flags.items():
+def load_tests(path):
+	with open(path, "r") as f:
+		spec = json.load(f)
+	tests = {}
+	for test in spec['tests']:
+		test_id = test['id']
+		assert test_id not in tests, path + ": test " + test_id + " defined twice"
+		base = spec['defaults']
+		if 'extends' in test:
+			assert test['extends'] in tests, path + ": " + test_id + " extends " + test['extends'] + ", which is not defined before it"
+			base = tests[test['extends']]
+		options = dict(base['options'])
+		options.update(test.get('options', {}))
+		flags = dict(base['flags'])
+		flags.update(test.get('flags', {}))
+		tests[test_id] = {'id': test_id, 'options': options, 'flags': flags,
+		                  'after': test.get('after', []), 'timeout': test.get('timeout')}
+	for test in tests.values():
+		for dependency in test['after']:
+			assert dependency in tests, path + ": " + test['id'] + " runs after unknown test " + dependency
+	return list(tests.values())
+
+
+def select_tests(tests, patterns):
+	# A test is selected if its id contains one of the patterns, or matches
+	# it as a glob; the tests it runs after come along.
+	if not patterns:
+		return tests
+	by_id = {test['id']: test for test in tests}
+	def matches(test_id):
+		return any(p in test_id or fnmatch.fnmatchcase(test_id, p) for p in patterns)
+	selected = set()
+	todo = [test['id'] for test in tests if matches(test['id'])]
+	while todo:
+		test_id = todo.pop()
+		if test_id not in selected:
+			selected.add(test_id)
+			todo.extend(by_id[test_id]['after'])
+	return [test for test in tests if test['id'] in selected]
+
+
+def test_command(test, binary, overrides):
+	options = dict(test['options'])
+	options.update(overrides)
+	options['output_directory'] = output_root + test['id']
+	command = [binary]
+	for key, value in options.items():
+		command += ["--" + key, str(value)]
+	for key, value in test['flags'].items():
 		if(value):
-			command+=(" "+key)
+			command.append("--" + key)
+	return command
+
 
-	print(command)
+###############
+def compare_test(test_id):
+	# Differences between reference_files/<test id> and the test's outputs
+	reference_directory = os.path.join('reference_files', test_id)
+	messages = []
+	for reference_file in sorted(os.listdir(reference_directory)):
+		ref_file = os.path.join(reference_directory, reference_file)
+		test_file = os.path.join('output_files', test_id, reference_file)
+		if(os.path.exists(test_file)):
+			if(not filecmp.cmp(ref_file, test_file, shallow=False)):
+				messages.append(ref_file + " " + test_file + " differ.")
+		else:
+			messages.append(test_file + " does not exist")
+	return messages
+
+
+def launch_test(test, binary, overrides, timeout):
+	test_id = test['id']
+	command = test_command(test, binary, overrides)
+	output_directory = output_root + test_id
+	shutil.rmtree(output_directory, ignore_errors=True)
+	os.makedirs(output_directory)
+	os.makedirs(log_root, exist_ok=True)
+	timeout = timeout or test['timeout'] or default_timeout
+	result = {'id': test_id, 'command': " ".join(command), 'output_directory': output_directory,
+	          'log': log_root + test_id + ".out", 'returncode': None, 'messages': []}
+
+	# Runs are seeded and compared with reference outputs, so treat them
+	# as reproducible. cached_run also keeps the simulator processes alive
+	# from one test to the next.
+	start = time.time()
+	try:
+		with open(log_root + test_id + ".out", "w") as out, open(log_root + test_id + ".err", "w") as err:
+			result['returncode'] = run_cache.cached_run(command, output_directory, replicate=0,
+			                                            stdout=out, stderr=err, timeout=timeout)
+	except subprocess.TimeoutExpired:
+		result['status'] = 'timeout'
+		result['messages'].append("timed out after " + str(timeout) + "s")
+	result['seconds'] = round(time.time() - start, 3)
+	if 'status' in result:
+		return result
+	if result['returncode'] != 0:
+		result['status'] = 'error'
+		result['messages'].append("drive_simulator exited with status " + str(result['returncode'])
+		                          + ", see " + log_root + test_id + ".err")
+		return result
+	if not os.path.isdir(os.path.join('reference_files', test_id)):
+		# Nothing to compare with: not a pass
+		result['status'] = 'skipped'
+		result['messages'].append("no reference files in reference_files/" + test_id)
+		return result
+	result['messages'] = compare_test(test_id)
+	result['status'] = 'fail' if result['messages'] else 'pass'
+	return result
+
+
+def report(result):
+	for message in result['messages']:
+		print(message)
+	print("Test : " + result['id'] + ": " + result['status'].upper() + " [" + str(result.get('seconds', 0)) + "s]", flush=True)
 
-	os.system(command)
 
 ###################
-def launch_regression(regression_tests):
-	for test in regression_tests:
-		print("Launching test for " + test['test_id'])
-		launch_test(test['test_options'],test['test_flags'])
+def launch_regression(tests, binary, overrides, jobs, timeout):
+	# Runs the tests on jobs workers, each test once the tests it runs after
+	# have finished. A test whose dependency did not run to completion is
+	# skipped.
+	results = {}
+	pending = list(tests)
+	running = {}
+	with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+		while pending or running:
+			for test in list(pending):
+				if not all(dependency in results for dependency in test['after']):
+					continue
+				pending.remove(test)
+				broken = [d for d in test['after'] if results[d]['status'] not in ('pass', 'fail')]
+				if broken:
+					results[test['id']] = {'id': test['id'], 'status': 'skipped', 'seconds': 0,
+					                       'messages': [test['id'] + " needs " + ", ".join(broken) + ", which did not run to completion"]}
+					report(results[test['id']])
+				else:
+					running[pool.submit(launch_test, test, binary, overrides, timeout)] = test
+			if not running:
+				assert not pending, "Tests that run after each other in a cycle: " + ", ".join(t['id'] for t in pending)
+				continue
+			done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+			for future in done:
+				test = running.pop(future)
+				results[test['id']] = future.result()
+				report(results[test['id']])
+	return [results[test['id']] for test in tests]
+
+
 ###################
+def write_results(results, path):
+	with open(path, "w") as f:
+		for result in sorted(results, key=lambda r: r['id']):
+			for message in result['messages']:
+				f.writelines(message + "\n")
+			f.writelines("Test : " + result['id'] + ": " + result['status'].upper() + "\n")
+
+
+def write_junit(results, path, seconds):
+	counts = {status: sum(r['status'] == status for r in results) for status in ['fail', 'error', 'timeout', 'skipped']}
+	suite = ET.Element('testsuite', name='regression_tests', tests=str(len(results)),
+	                   failures=str(counts['fail']), errors=str(counts['error'] + counts['timeout']),
+	                   skipped=str(counts['skipped']), time=str(seconds))
+	for result in results:
+		case = ET.SubElement(suite, 'testcase', classname='regression_tests', name=result['id'],
+		                     time=str(result['seconds']))
+		details = "\n".join(result['messages'])
+		if result['status'] == 'fail':
+			ET.SubElement(case, 'failure', message="outputs differ from reference_files").text = details
+		elif result['status'] in ('error', 'timeout'):
+			ET.SubElement(case, 'error', message=result['status']).text = details
+		elif result['status'] == 'skipped':
+			ET.SubElement(case, 'skipped', message=details)
+		if 'command' in result:
+			ET.SubElement(case, 'system-out').text = result['command']
+	suites = ET.Element('testsuites')
+	suites.append(suite)
+	ET.ElementTree(suites).write(path, encoding='utf-8', xml_declaration=True)
+
+
+def write_json(results, path, seconds):
+	summary = {'tests': len(results), 'seconds': seconds}
+	for status in ['pass', 'fail', 'error', 'timeout', 'skipped']:
+		summary[status] = sum(r['status'] == status for r in results)
+	with open(path, "w") as f:
+		json.dump({'summary': summary, 'tests': results}, f, indent=2)
 
-def compare_regressions():
-	result_array=[]
-	f = open("regression_results.txt", "w")
-	for reference_directory in sorted(os.listdir('reference_files')):
-			test_pass = True
-			for reference_file in os.listdir(os.path.join('reference_files',reference_directory)):
-				ref_file=os.path.join('reference_files',reference_directory,reference_file)
-				test_file =os.path.join('output_files',reference_directory,reference_file)
-				if(os.path.exists(test_file)):
-					if(not filecmp.cmp(ref_file,test_file)):
-						temp= ref_file +" "+ test_file + " differ."
-						f.writelines(temp + "\n")
-						print(temp)
-						test_pass=False
-				else:
-					temp= test_file +" does not exist"
-					f.writelines(temp + "\n")
-					print(temp)
-					test_pass=False
-			if(test_pass):
-				temp="Test : " + reference_directory + ": PASS"
-				print (temp)
-				f.writelines(temp + "\n")
-			else:
-				temp="Test : " + reference_directory + ": FAIL"
-				print (temp)
-				f.writelines(temp + "\n")
-	
-	f.close()
-	
-
-
-regression_tests= []
-
-###############################################
-#### Start adding regression tests
-# 1
-current_test={}
-test_id = 'test_001'
-
-test_options = default_options.copy() #IMPORTANT to use the copy method.
-test_options['--output_directory'] += test_id
-
-test_flags = default_flags.copy()
-
-current_test['test_id'] = test_id
-current_test['test_options'] = test_options
-current_test['test_flags'] = test_flags
-
-regression_tests.append(current_test)
-
-# 2 Test all interventions
-for intervention in range(16):	
-	current_test={}
-	test_id = 'intervention_'+str(intervention).zfill(2)
-	
-	test_options = default_options.copy()
-	test_options['--output_directory'] += test_id
-	test_options['--INTERVENTION'] = intervention
-	
-	test_flags = default_flags.copy()
-
-	current_test['test_id'] = test_id
-	current_test['test_options'] = test_options
-	current_test['test_flags'] = test_flags
-
-	regression_tests.append(current_test)
-
-#3
-current_test={}
-test_id = 'intervention_14_enabled'
-
-test_options = default_options.copy()
-test_options['--output_directory'] += test_id
-test_options['--INTERVENTION'] = 14
-test_options['--WARD_CONTAINMENT_THRESHOLD'] = 0
-
-test_flags = default_flags.copy()
-test_flags['--ENABLE_CONTAINMENT'] = True
-
-current_test['test_id'] = test_id
-current_test['test_options'] = test_options
-current_test['test_flags'] = test_flags
-
-regression_tests.append(current_test)
-
-## configure a new regression text
-#4
-current_test={}
-test_id = 'intervention_15_enabled'
-
-test_options = default_options.copy()
-test_options['--output_directory'] += test_id
-test_options['--INTERVENTION'] = 15
-test_options['--WARD_CONTAINMENT_THRESHOLD'] = 0
-
-test_flags = default_flags.copy()
-test_flags['--ENABLE_CONTAINMENT'] = True
-
-current_test['test_id'] = test_id
-current_test['test_options'] = test_options
-current_test['test_flags'] = test_flags
-
-regression_tests.append(current_test)
-## end of regresstion test addition
-
-###########
-#5 file based intervention configuration testing
-for intervention in range(16):	
-	current_test={}
-	test_id = 'intervention_'+str(intervention).zfill(2)+'_file_read'
-	test_options = default_options.copy()
-	test_options['--output_directory'] += test_id
-	test_options['--INTERVENTION'] = 16
-	test_options['--intervention_filename']='../../../../cpp-simulator/regression_tests/input_files/intervention_'+str(intervention).zfill(2)+'.json'
-	
-	test_flags = default_flags.copy()
-	if(intervention == 14 or intervention == 15):
-		test_flags['--ENABLE_CONTAINMENT'] = True
-
-	current_test['test_id'] = test_id
-	current_test['test_options'] = test_options
-	current_test['test_flags'] = test_flags
-
-	regression_tests.append(current_test)
-
-## configure a new regression text
-#6
-current_test={}
-test_id = 'smaller_networks'
-
-test_options = default_options.copy()
-test_options['--output_directory'] += test_id
-test_options['--INTERVENTION'] = 15
-test_options['--WARD_CONTAINMENT_THRESHOLD'] = 0
-test_options['--BETA_CLASS']=0.1
-test_options['--BETA_PROJECT']=0.1
-test_options['--BETA_RANDOM_COMMUNITY']=0.1
-test_options['--BETA_NBR_CELLS']=0.1
-test_options['--PROVIDE_INITIAL_SEED_GRAPH']=4123
-
-test_flags = default_flags.copy()
-test_flags['--ENABLE_CONTAINMENT'] = True
-test_flags['--ENABLE_NBR_CELLS'] = True
-test_flags['--ENABLE_TESTING'] = False
-
-
-current_test['test_id'] = test_id
-current_test['test_options'] = test_options
-current_test['test_flags'] = test_flags
-
-regression_tests.append(current_test)
-## end of regresstion test addition
-
-## configure a new regression text
-#7
-current_test={}
-test_id = 'smaller_networks_testing_001'
-
-test_options = default_options.copy()
-test_options['--output_directory'] += test_id
-test_options['--INTERVENTION'] = 15
-test_options['--WARD_CONTAINMENT_THRESHOLD'] = 0
-test_options['--BETA_CLASS']=0.1
-test_options['--BETA_PROJECT']=0.1
-test_options['--BETA_RANDOM_COMMUNITY']=0.1
-test_options['--BETA_NBR_CELLS']=0.1
-test_options['--PROVIDE_INITIAL_SEED_GRAPH']=4123
-test_options['--TESTING_PROTOCOL']=2
-test_options['--testing_protocol_filename']='../../../../cpp-simulator/regression_tests/input_files/testing_protocol_001.json'
-
-
-test_flags = default_flags.copy()
-test_flags['--ENABLE_CONTAINMENT'] = True
-test_flags['--ENABLE_NBR_CELLS'] = True
-test_flags['--ENABLE_TESTING'] = True
-
-
-current_test['test_id'] = test_id
-current_test['test_options'] = test_options
-current_test['test_flags'] = test_flags
-
-regression_tests.append(current_test)
-## end of regresstion test addition
-
-## configure a new regression text
-#7
-current_test={}
-test_id = 'smaller_networks_testing_002'
-
-test_options = default_options.copy()
-test_options['--output_directory'] += test_id
-test_options['--INTERVENTION'] = 15
-test_options['--WARD_CONTAINMENT_THRESHOLD'] = 0
-test_options['--BETA_CLASS']=0.1
-test_options['--BETA_PROJECT']=0.1
-test_options['--BETA_RANDOM_COMMUNITY']=0.1
-test_options['--BETA_NBR_CELLS']=0.1
-test_options['--PROVIDE_INITIAL_SEED_GRAPH']=4123
-test_options['--TESTING_PROTOCOL']=2
-test_options['--testing_protocol_filename']='../../../../cpp-simulator/regression_tests/input_files/testing_protocol_002.json'
-
-
-test_flags = default_flags.copy()
-test_flags['--ENABLE_CONTAINMENT'] = True
-test_flags['--ENABLE_NBR_CELLS'] = True
-test_flags['--ENABLE_TESTING'] = True
-
-
-current_test['test_id'] = test_id
-current_test['test_options'] = test_options
-current_test['test_flags'] = test_flags
-
-regression_tests.append(current_test)
-## end of regresstion test addition
-
-
-
-## configure a new regression test
-# attendance file based test
-current_test={}
-test_id = 'attendance_file_001'
-
-test_options = default_options.copy()
-test_options['--output_directory'] += test_id
-test_options['--INTERVENTION'] = 8
-test_options['--LOCKED_COMMUNITY_LEAKAGE'] = 0.25
-test_options['--attendance_filename']='../../../../cpp-simulator/regression_tests/input_files/attendance_file_001.json'
-
-test_flags = default_flags.copy()
-test_flags['--ENABLE_CONTAINMENT'] = True
-test_flags['--IGNORE_ATTENDANCE_FILE'] = False
-
-current_test['test_id'] = test_id
-current_test['test_options'] = test_options
-current_test['test_flags'] = test_flags
-
-regression_tests.append(current_test)
-
-## configure a new regression test
-# attendance file based test
-current_test={}
-test_id = 'attendance_file_002'
-
-test_options = default_options.copy()
-test_options['--output_directory'] += test_id
-test_options['--INTERVENTION'] = 8
-test_options['--LOCKED_COMMUNITY_LEAKAGE'] = 0.25
-test_options['--attendance_filename']='../../../../cpp-simulator/regression_tests/input_files/attendance_file_002.json'
-
-test_flags = default_flags.copy()
-test_flags['--ENABLE_CONTAINMENT'] = True
-test_flags['--IGNORE_ATTENDANCE_FILE'] = False
-
-current_test['test_id'] = test_id
-current_test['test_options'] = test_options
-current_test['test_flags'] = test_flags
-
-regression_tests.append(current_test)
-
-
-## configure new regression tests for masks
-current_test={}
-test_id = 'masks'
-
-test_options = default_options.copy()
-test_options['--output_directory'] += test_id
-test_options['--INTERVENTION'] = 15
-test_options['--WARD_CONTAINMENT_THRESHOLD'] = 0
-test_options['--BETA_CLASS']=0.1
-test_options['--BETA_PROJECT']=0.1
-test_options['--BETA_RANDOM_COMMUNITY']=0.1
-test_options['--BETA_NBR_CELLS']=0.1
-test_options['--PROVIDE_INITIAL_SEED_GRAPH']=4123
-test_options['--TESTING_PROTOCOL']=2
-test_options['--testing_protocol_filename']='../../../../cpp-simulator/regression_tests/input_files/testing_protocol_002.json'
-test_options['--MASK_START_DELAY'] = 5
-
-
-test_flags = default_flags.copy()
-test_flags['--ENABLE_CONTAINMENT'] = True
-test_flags['--ENABLE_NBR_CELLS'] = True
-test_flags['--ENABLE_TESTING'] = True
-test_flags['--MASK_ACTIVE'] = True
-
-current_test['test_id'] = test_id
-current_test['test_options'] = test_options
-current_test['test_flags'] = test_flags
-
-regression_tests.append(current_test)
-
-
-## configure new regression tests for soft ward containment
-current_test={}
-test_id = 'soft_ward'
-
-test_options = default_options.copy()
-test_options['--output_directory'] += test_id
-test_options['--INTERVENTION'] = 15
-test_options['--WARD_CONTAINMENT_THRESHOLD'] = 0
-test_options['--BETA_CLASS']=0.1
-test_options['--BETA_PROJECT']=0.1
-test_options['--BETA_RANDOM_COMMUNITY']=0.1
-test_options['--BETA_NBR_CELLS']=0.1
-test_options['--PROVIDE_INITIAL_SEED_GRAPH']=4123
-test_options['--TESTING_PROTOCOL']=2
-test_options['--testing_protocol_filename']='../../../../cpp-simulator/regression_tests/input_files/testing_protocol_002.json'
-test_options['--MASK_START_DELAY'] = 5
-test_options['--LOCKED_COMMUNITY_LEAKAGE'] = 0.5
-
-test_flags = default_flags.copy()
-test_flags['--ENABLE_CONTAINMENT'] = True
-test_flags['--ENABLE_NBR_CELLS'] = False
-test_flags['--ENABLE_TESTING'] = True
-test_flags['--MASK_ACTIVE'] = True
-
-
-current_test['test_id'] = test_id
-current_test['test_options'] = test_options
-current_test['test_flags'] = test_flags
-
-regression_tests.append(current_test)
-
-
-## configure new regression tests for soft neighborhood containment 
-current_test={}
-test_id = 'soft_nbr'
-
-test_options = default_options.copy()
-test_options['--output_directory'] += test_id
-test_options['--INTERVENTION'] = 15
-test_options['--WARD_CONTAINMENT_THRESHOLD'] = 0
-test_options['--BETA_CLASS']=0.1
-test_options['--BETA_PROJECT']=0.1
-test_options['--BETA_RANDOM_COMMUNITY']=0.1
-test_options['--BETA_NBR_CELLS']=0.1
-test_options['--PROVIDE_INITIAL_SEED_GRAPH']=4123
-test_options['--TESTING_PROTOCOL']=2
-test_options['--testing_protocol_filename']='../../../../cpp-simulator/regression_tests/input_files/testing_protocol_002.json'
-test_options['--MASK_START_DELAY'] = 5
-test_options['--LOCKED_NEIGHBORHOOD_LEAKAGE'] = 0.5
-
-test_flags = default_flags.copy()
-test_flags['--ENABLE_CONTAINMENT'] = True
-test_flags['--ENABLE_NBR_CELLS'] = True
-test_flags['--ENABLE_TESTING'] = True
-test_flags['--MASK_ACTIVE'] = True
-
-
-current_test['test_id'] = test_id
-current_test['test_options'] = test_options
-current_test['test_flags'] = test_flags
-
-regression_tests.append(current_test)  
-
-
-##Regressions for cohorts in mumbai locals
-current_test = {}
-test_id = "cohorts_base"
-
-cohort_options = default_options.copy()
-cohort_options['--CITY_SW_LAT'] = 18.89395643371942
-cohort_options['--CITY_NE_LAT'] = 19.270176667777736
-cohort_options['--CITY_SW_LON'] = 72.77633295153348
-cohort_options['--CITY_NE_LON'] = 72.97973149704592
-cohort_options['--F_KERNEL_A'] = 2.709
-cohort_options['--F_KERNEL_B'] = 1.279
-cohort_options['--BETA_H'] = 0.792844
-cohort_options['--BETA_W'] = 0.141709
-cohort_options['--BETA_C'] = 0.0149375
-cohort_options['--BETA_S'] = 0.283418
-cohort_options['--BETA_TRAVEL'] =0
-cohort_options['--BETA_CLASS']=2.5507
-cohort_options['--BETA_PROJECT']=1.2753
-cohort_options['--BETA_RANDOM_COMMUNITY']=0.1344
-cohort_options['--BETA_NBR_CELLS']=0.1344
-cohort_options['--HD_AREA_FACTOR'] = 2.0
-cohort_options['--INTERVENTION'] = 16
-cohort_options['--output_directory'] += test_id
-cohort_options['--input_directory'] ="../../staticInst/data/web_input_files/mumbai_cohorts_100K/"
-cohort_options['--TESTING_PROTOCOL']=2
-cohort_options['--testing_protocol_filename']='testing_protocol.json'
-cohort_options['--attendance_filename']='mumbai_attendance.json'
-cohort_options['--intervention_filename']='2020091_intervention_params_community_leakage_factor_1_fix_May18-31.json'
-cohort_options['--MASK_START_DELAY'] = 5
-cohort_options['--MASK_FACTOR'] = 0.8
-cohort_options['--PROVIDE_INITIAL_SEED_GRAPH'] = 4123
-cohort_options['--PROVIDE_INITIAL_SEED'] = 1723530071
-
-cohort_options['--STORE_STATE_TIME_STEP'] = 0
-cohort_options['--LOAD_STATE_TIME_STEP'] = 0
-
-cohort_options['--COHORT_SIZE'] = 20
-cohort_options['--BETA_COHORT'] = 0.0005
-cohort_options['--CROWDING_FACTOR_COHORTS'] = 5
-cohort_options['--COHORT_SEVERITY_FRACTION'] = 0.4
-cohort_options['--COHORT_STRATEGY'] = 1
-cohort_options['--ONE_OFF_TRAVELERS_RATIO'] = 0
-
-cohort_flags = default_flags.copy() 
-cohort_flags['--ENABLE_CONTAINMENT'] = True
-cohort_flags['--ENABLE_COHORTS'] = True
-cohort_flags['--ENABLE_NBR_CELLS'] = True
-cohort_flags['--ENABLE_TESTING'] = True
-cohort_flags['--MASK_ACTIVE'] = True
-cohort_flags['--ISOLATE_COHORTS'] = True
-
-current_test['test_id'] = test_id
-current_test['test_options'] = cohort_options
-current_test['test_flags'] = cohort_flags
-
-regression_tests.append(current_test)
-
-#NOTE: RUN THIS ONLY WHEN PROTOBUF IS ENABLED
-### Store simulator state for Bengaluru
-current_test={}
-test_id = 'store_state'
-
-test_options = default_options.copy()
-test_options['--output_directory'] += test_id
-test_options['--INTERVENTION'] = 15
-test_options['--WARD_CONTAINMENT_THRESHOLD'] = 0
-test_options['--BETA_CLASS']=0.1
-test_options['--BETA_PROJECT']=0.1
-test_options['--BETA_RANDOM_COMMUNITY']=0.1
-test_options['--BETA_NBR_CELLS']=0.1
-test_options['--PROVIDE_INITIAL_SEED_GRAPH']=4123
-test_options['--TESTING_PROTOCOL']=2
-test_options['--testing_protocol_filename']='../../../../cpp-simulator/regression_tests/input_files/testing_protocol_002.json'
-test_options['--MASK_START_DELAY'] = 5
-test_options['--LOCKED_COMMUNITY_LEAKAGE'] = 0.5
-test_options['--STORE_STATE_TIME_STEP'] = 40
-test_options['--LOAD_STATE_TIME_STEP'] = 0
-
-
-test_flags = default_flags.copy()
-test_flags['--ENABLE_CONTAINMENT'] = True
-test_flags['--ENABLE_NBR_CELLS'] = False
-test_flags['--ENABLE_TESTING'] = True
-test_flags['--MASK_ACTIVE'] = True
-
-
-current_test['test_id'] = test_id
-current_test['test_options'] = test_options
-current_test['test_flags'] = test_flags
-
-regression_tests.append(current_test)
-
-### Load simulator state for Bengaluru.
-### NOTE: This is dependent on the store_state regression's output
-current_test={}
-test_id = 'load_state'
-
-test_options = default_options.copy()
-test_options['--output_directory'] += test_id
-test_options['--INTERVENTION'] = 15
-test_options['--WARD_CONTAINMENT_THRESHOLD'] = 0
-test_options['--BETA_CLASS']=0.1
-test_options['--BETA_PROJECT']=0.1
-test_options['--BETA_RANDOM_COMMUNITY']=0.1
-test_options['--BETA_NBR_CELLS']=0.1
-test_options['--PROVIDE_INITIAL_SEED_GRAPH']=4123
-test_options['--TESTING_PROTOCOL']=2
-test_options['--testing_protocol_filename']='../../../../cpp-simulator/regression_tests/input_files/testing_protocol_002.json'
-test_options['--MASK_START_DELAY'] = 5
-test_options['--LOCKED_COMMUNITY_LEAKAGE'] = 0.5
-test_options['--STORE_STATE_TIME_STEP'] = 0
-test_options['--LOAD_STATE_TIME_STEP'] = 40
-test_options['--agent_load_file'] = "../../../../cpp-simulator/regression_tests/output_files/store_state/agentStore.pbstore"
-
-test_flags = default_flags.copy()
-test_flags['--ENABLE_CONTAINMENT'] = True
-test_flags['--ENABLE_NBR_CELLS'] = False
-test_flags['--ENABLE_TESTING'] = True
-test_flags['--MASK_ACTIVE'] = True
-
-current_test['test_id'] = test_id
-current_test['test_options'] = test_options
-current_test['test_flags'] = test_flags
-
-regression_tests.append(current_test)
-
-
-
-## end of regresstion test addition
-
-#remove old output files
-# os.system('rm -rf ./output_files/')
-
-# Launch all regresstion tests
-launch_regression(regression_tests)
-
-compare_regressions()
+
+###################
+def main():
+	my_parser = argparse.ArgumentParser(description='Run the drive_simulator regression tests')
+	my_parser.add_argument('-k', action='append', default=[], metavar='PATTERN',
+	                       help='only tests whose id contains PATTERN or matches it as a glob (repeatable)')
+	my_parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='tests to run at once')
+	my_parser.add_argument('--timeout', type=float, default=None,
+	                       help='seconds per test (default: the test\'s timeout in ' + tests_file + ', or ' + str(default_timeout) + ')')
+	my_parser.add_argument('--tests', default=None, help='test definitions (default: ' + tests_file + ' here)')
+	my_parser.add_argument('--binary', default='../drive_simulator', help='simulator, relative to this directory')
+	my_parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+	                       help='override an option in every test (outputs will not match the references)')
+	my_parser.add_argument('--list', action='store_true', help='list the selected tests and their commands')
+	my_parser.add_argument('--junit', default=None, help='write JUnit XML results to this file')
+	my_parser.add_argument('--json', default=None, help='write JSON results to this file')
+	args = my_parser.parse_args()
+	# Paths given on the command line are relative to where it was run
+	for name in ['tests', 'junit', 'json']:
+		if getattr(args, name):
+			setattr(args, name, os.path.join(invocation_directory, getattr(args, name)))
+
+	overrides = {}
+	for item in args.set:
+		assert "=" in item, "--set takes KEY=VALUE, got " + item
+		key, value = item.split("=", 1)
+		overrides[key.lstrip("-")] = value
+
+	tests = select_tests(load_tests(args.tests or tests_file), args.k)
+	if not tests:
+		print("No tests match " + " ".join(args.k))
+		return 1
+	if args.list:
+		for test in tests:
+			print(test['id'] + ": " + " ".join(test_command(test, args.binary, overrides)))
+		return 0
+
+	jobs = max(1, min(args.jobs, len(tests)))
+	print("Running " + str(len(tests)) + " tests, " + str(jobs) + " at a time", flush=True)
+	start = time.time()
+	results = launch_regression(tests, args.binary, overrides, jobs, args.timeout)
+	seconds = round(time.time() - start, 3)
+
+	write_results(results, "regression_results.txt")
+	if args.junit:
+		write_junit(results, args.junit, seconds)
+	if args.json:
+		write_json(results, args.json, seconds)
+	passed = sum(r['status'] == 'pass' for r in results)
+	print(str(passed) + "/" + str(len(results)) + " tests passed in " + str(seconds) + "s")
+	return 0 if passed == len(results) else 1
+
+
+if __name__ == "__main__":
+	sys.exit(main())
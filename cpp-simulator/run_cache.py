@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Content-addressed cache of drive_simulator runs, shared by the launchers
+# (calibrate_betas/Calibration.py, calibrate_betas/tune_model_CPP.py,
+# grid-search.py, launch_drive_sim.py, regression_tests/regression_tests.py).
+#
+# A run is identified by the SHA-256 of
+#   - the drive_simulator binary,
+#   - the contents of the input directory, and of any *_filename/*_file
+#     option that names a file (resolved relative to the input directory),
+#   - the normalised options: --KEY VALUE and --KEY=VALUE are the same,
+#     numbers are compared as numbers, order does not matter, and
+#     output_directory is left out,
+#   - the seed: PROVIDE_INITIAL_SEED/PROVIDE_INITIAL_SEED_GRAPH, or, for
+#     unseeded runs, a replicate id supplied by the launcher.
+# Unseeded runs without a replicate id are never cached: they are meant to
+# be fresh random draws.
+#
+# The cache is off unless DRIVE_SIM_CACHE names a directory (or a RunCache
+# is constructed explicitly). Entries are <root>/<key[:2]>/<key>/ with the
+# run's output files and entry.json; the least recently used entries are
+# evicted once the cache is larger than DRIVE_SIM_CACHE_BUDGET (default
+# 20G).
+#
+#   python run_cache.py list            entries, most recently used first
+#   python run_cache.py stats
+#   python run_cache.py show KEY
+#   python run_cache.py prune --budget 5G
+#   python run_cache.py clear
+
+import argparse
+import fnmatch
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+
+import batch_sim
+
+cache_env = "DRIVE_SIM_CACHE"
+budget_env = "DRIVE_SIM_CACHE_BUDGET"
+default_budget = "20G"
+entry_file = "entry.json"
+seed_options = ["PROVIDE_INITIAL_SEED", "PROVIDE_INITIAL_SEED_GRAPH"]
+
+
+def parse_size(size):
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    size = str(size).strip().upper().rstrip("B")
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(float(size))
+
+
+def format_size(n):
+    for unit in ["B", "K", "M", "G"]:
+        if n < 1024:
+            return f"{n:.1f}{unit}"
+        n /= 1024
+    return f"{n:.1f}T"
+
+
+def parse_options(args):
+    # drive_simulator arguments (without the binary) -> {KEY: value}, with
+    # True for flags given without a value.
+    options = {}
+    i = 0
+    while i < len(args):
+        arg = str(args[i])
+        i += 1
+        if not arg.strip():
+            continue
+        assert arg.startswith("--"), f"unexpected drive_simulator argument {arg}"
+        key = arg[2:]
+        if "=" in key:
+            key, value = key.split("=", 1)
+        elif i < len(args) and not str(args[i]).startswith("--") and str(args[i]).strip():
+            value = str(args[i])
+            i += 1
+        else:
+            value = True
+        options[key] = value
+    return options
+
+
+def normalise_value(value):
+    if value is True:
+        return True
+    try:
+        number = float(value)
+    except ValueError:
+        return value
+    return int(number) if number.is_integer() else repr(number)
+
+
+def file_sha256(path, chunk=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class RunCache:
+
+    def __init__(self, root, budget=None):
+        self.root = os.path.abspath(root)
+        self.budget = parse_size(budget or os.environ.get(budget_env, default_budget))
+        os.makedirs(self.root, exist_ok=True)
+        self.hash_index_path = os.path.join(self.root, "file_hashes.json")
+        self.hash_index = None
+
+    # ---- hashing ----
+
+    def _load_hash_index(self):
+        if self.hash_index is None:
+            self.hash_index = {}
+            if os.path.isfile(self.hash_index_path):
+                try:
+                    with open(self.hash_index_path, "r") as f:
+                        self.hash_index = json.load(f)
+                except ValueError:
+                    pass
+
+    def _save_hash_index(self):
+        tmp = f"{self.hash_index_path}.{uuid.uuid4().hex}"
+        with open(tmp, "w") as f:
+            json.dump(self.hash_index, f)
+        os.replace(tmp, self.hash_index_path)
+
+    def file_hash(self, path):
+        # Content hash, remembered by (path, size, mtime) so that large city
+        # files are only read once.
+        self._load_hash_index()
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        stamp = f"{st.st_size}:{st.st_mtime_ns}"
+        known = self.hash_index.get(path)
+        if known is not None and known[0] == stamp:
+            return known[1]
+        digest = file_sha256(path)
+        self.hash_index[path] = [stamp, digest]
+        self._save_hash_index()
+        return digest
+
+    def directory_hash(self, path):
+        h = hashlib.sha256()
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+            for name in sorted(filenames):
+                if name.startswith("."):
+                    continue
+                full = os.path.join(dirpath, name)
+                h.update(os.path.relpath(full, path).encode())
+                h.update(self.file_hash(full).encode())
+        return h.hexdigest()
+
+    def key(self, cmd, replicate=None, keep=None):
+        # Cache key of the drive_simulator command line cmd, or None if the
+        # run is not reproducible (unseeded and no replicate id). keep is
+        # part of the key: an entry stored with only some of the output files
+        # must not be served to a launcher that wants the others.
+        binary = shutil.which(str(cmd[0])) or str(cmd[0])
+        options = parse_options(cmd[1:])
+        seeded = all(k in options for k in seed_options)
+        if not seeded and replicate is None:
+            return None
+        input_dir = options.get("input_directory", "")
+        normalised = {}
+        for k, v in options.items():
+            if k == "output_directory":
+                continue
+            if k == "input_directory":
+                v = self.directory_hash(v) if os.path.isdir(v) else v
+            elif (k.endswith("_filename") or k.endswith("_file")) and v is not True:
+                path = os.path.join(input_dir, v)
+                v = self.file_hash(path) if os.path.isfile(path) else v
+            else:
+                v = normalise_value(v)
+            normalised[k] = v
+        description = {
+            "binary": self.file_hash(binary),
+            "options": normalised,
+            "replicate": None if seeded else str(replicate),
+            "keep": None if keep is None else sorted(keep),
+        }
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    # ---- entries ----
+
+    def entry_dir(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def entries(self):
+        out = []
+        for prefix in os.listdir(self.root):
+            prefix_dir = os.path.join(self.root, prefix)
+            if len(prefix) != 2 or not os.path.isdir(prefix_dir):
+                continue
+            for key in os.listdir(prefix_dir):
+                path = os.path.join(prefix_dir, key, entry_file)
+                if os.path.isfile(path):
+                    with open(path, "r") as f:
+                        entry = json.load(f)
+                    entry["last_used"] = os.stat(path).st_mtime
+                    out.append(entry)
+        return sorted(out, key=lambda e: e["last_used"], reverse=True)
+
+    def get(self, key, output_dir):
+        # Copies a cached run into output_dir. Returns whether it was a hit.
+        entry = self.entry_dir(key)
+        if not os.path.isfile(os.path.join(entry, entry_file)):
+            return False
+        os.makedirs(output_dir, exist_ok=True)
+        for name in os.listdir(entry):
+            if name != entry_file:
+                shutil.copy2(os.path.join(entry, name), os.path.join(output_dir, name))
+        os.utime(os.path.join(entry, entry_file)) # LRU
+        return True
+
+    def put(self, key, output_dir, cmd, keep=None):
+        # Stores the files of output_dir (only those matching one of the
+        # glob patterns in keep, if given).
+        entry = self.entry_dir(key)
+        if os.path.isdir(entry):
+            return
+        tmp = os.path.join(self.root, f"tmp-{uuid.uuid4().hex}")
+        os.makedirs(tmp)
+        size = 0
+        for name in sorted(os.listdir(output_dir)):
+            src = os.path.join(output_dir, name)
+            if not os.path.isfile(src) or (keep is not None and not any(fnmatch.fnmatch(name, p) for p in keep)):
+                continue
+            shutil.copy2(src, os.path.join(tmp, name))
+            size += os.path.getsize(src)
+        with open(os.path.join(tmp, entry_file), "w") as f:
+            json.dump({"key": key, "cmd": [str(c) for c in cmd], "size": size,
+                       "created": time.time()}, f, indent=1)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        try:
+            os.rename(tmp, entry)
+        except OSError: # stored concurrently by another launcher
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.prune(self.budget)
+
+    def prune(self, budget):
+        # Evicts least recently used entries until the cache fits in budget
+        entries = self.entries()
+        total = sum(e["size"] for e in entries)
+        removed = 0
+        for e in reversed(entries):
+            if total <= budget:
+                break
+            shutil.rmtree(self.entry_dir(e["key"]), ignore_errors=True)
+            total -= e["size"]
+            removed += 1
+        return removed
+
+    def clear(self):
+        return self.prune(-1)
+
+    def run(self, cmd, output_dir, replicate=None, keep=None, **kwargs):
+        # batch_sim.run(cmd, **kwargs), served from the cache when possible.
+        # Returns the CompletedProcess, or None on a cache hit.
+        key = self.key(cmd, replicate, keep)
+        if key is not None and self.get(key, output_dir):
+            print(f"run_cache: {output_dir} served from {self.entry_dir(key)}", flush=True)
+            return None
+        result = batch_sim.run(cmd, **kwargs)
+        if key is not None and result.returncode == 0:
+            self.put(key, output_dir, cmd, keep)
+        return result
+
+
+def default_cache():
+    root = os.environ.get(cache_env)
+    return RunCache(root) if root else None
+
+
+def cached_run(cmd, output_dir, replicate=None, keep=None, **kwargs):
+    # Drop-in for subprocess.run in the launchers, running the simulator in
+    # a persistent process (batch_sim) when it can. Returns the return code.
+    cache = default_cache()
+    if cache is None:
+        return batch_sim.run(cmd, **kwargs).returncode
+    result = cache.run(cmd, output_dir, replicate, keep, **kwargs)
+    return 0 if result is None else result.returncode
+
+
+def main():
+    my_parser = argparse.ArgumentParser(description='Inspect or prune the drive_simulator run cache')
+    my_parser.add_argument('--root', help='cache directory', default=os.environ.get(cache_env))
+    sub = my_parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('list', help='entries, most recently used first')
+    sub.add_parser('stats', help='number of entries and total size')
+    show = sub.add_parser('show', help='one entry')
+    show.add_argument('key')
+    prune = sub.add_parser('prune', help='evict least recently used entries')
+    prune.add_argument('--budget', help='size to prune to, e.g. 5G', default=None)
+    sub.add_parser('clear', help='remove every entry')
+    args = my_parser.parse_args()
+
+    assert args.root, f"give --root or set {cache_env}"
+    cache = RunCache(args.root)
+    if args.command == 'list':
+        for e in cache.entries():
+            used = time.strftime("%Y-%m-%d %H:%M", time.localtime(e["last_used"]))
+            print(f"{e['key'][:16]}  {format_size(e['size']):>8}  {used}  {' '.join(e['cmd'][:1])}")
+    elif args.command == 'stats':
+        entries = cache.entries()
+        print(f"{len(entries)} entries, {format_size(sum(e['size'] for e in entries))} "
+              f"(budget {format_size(cache.budget)}) in {cache.root}")
+    elif args.command == 'show':
+        matches = [e for e in cache.entries() if e["key"].startswith(args.key)]
+        assert len(matches) == 1, f"{len(matches)} entries match {args.key}"
+        print(json.dumps(matches[0], indent=1))
+        print("\n".join(sorted(os.listdir(cache.entry_dir(matches[0]["key"])))))
+    elif args.command == 'prune':
+        budget = parse_size(args.budget) if args.budget else cache.budget
+        print(f"removed {cache.prune(budget)} entries")
+    elif args.command == 'clear':
+        print(f"removed {cache.clear()} entries")
+
+
+if __name__ == "__main__":
+    main()
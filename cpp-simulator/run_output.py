@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Reading drive_simulator outputs, from run.npz (--output_format npz) or from
+# the csv files of a run. Either way only the series selected with
+# --outputs are there, as listed in the run's manifest.json.
+#
+# run.npz is a numpy .npz archive holding, for every time series NAME (the
+# NAME.csv of a csv run),
+#   NAME         values [time, field], in the simulator's type for the series
+#   time/NAME    float64 [time], in days
+#   metadata.json  {"series": {NAME: {"group": ..., "fields": [...]}},
+#                   "SIM_STEPS_PER_DAY": ..., "global_params": <global_params.txt>}
+# csvContent has one row per community and time step; every other series
+# one row per time step.
+#
+#   load_run(run_dir)       tidy DataFrame: series, field, time, value
+#   load_runs(run_dirs)     the same with a run column, for many runs
+#   read_series(run_dir, NAME)  DataFrame as in NAME.csv (Time, fields...)
+#
+#   python run_output.py show RUN_DIR
+#   python run_output.py export RUN_DIR... -o runs.parquet [--series num_affected ...]
+#   python run_output.py convert RUN_DIR... [--remove]   csv files -> run.npz
+
+import argparse
+import glob
+import json
+import os
+import re
+import zipfile
+
+import joblib
+import numpy as np
+import pandas as pd
+
+npz_name = "run.npz"
+metadata_name = "metadata.json"
+manifest_name = "manifest.json"
+
+
+def parse_global_params(text):
+    # global_params.txt: "KEY: value;" lines, # comments
+    params = {}
+    for line in text.splitlines():
+        m = re.match(r"\s*([^#:][^:]*):\s*(.*?);?\s*$", line)
+        if m:
+            params[m.group(1).strip()] = m.group(2).strip()
+    return params
+
+
+class RunOutput:
+
+    def __init__(self, run_dir):
+        self.run_dir = run_dir
+        self.npz_path = os.path.join(run_dir, npz_name)
+        self.npz = None
+        if os.path.isfile(self.npz_path):
+            self.npz = np.load(self.npz_path)
+            with zipfile.ZipFile(self.npz_path) as z:
+                self.metadata = json.loads(z.read(metadata_name))
+        elif os.path.isfile(os.path.join(run_dir, manifest_name)):
+            # Series selected with drive_simulator --outputs
+            with open(os.path.join(run_dir, manifest_name), "r") as f:
+                self.metadata = {"series": json.load(f)["series"]}
+        else:
+            names = sorted(os.path.splitext(os.path.basename(f))[0]
+                           for f in glob.glob(os.path.join(run_dir, "*.csv")))
+            assert names, f"{run_dir}: no {npz_name} and no csv files"
+            self.metadata = {"series": {n: {"group": "", "fields": None} for n in names}}
+        if self.npz is None:
+            params_file = os.path.join(run_dir, "global_params.txt")
+            if os.path.isfile(params_file):
+                with open(params_file, "r") as f:
+                    self.metadata["global_params"] = f.read()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.npz is not None:
+            self.npz.close()
+
+    def series_names(self):
+        return list(self.metadata["series"])
+
+    def global_params(self):
+        return parse_global_params(self.metadata.get("global_params", ""))
+
+    def read(self, name):
+        # (time [time], values [time, field], fields) of one series
+        if self.npz is not None:
+            assert name in self.metadata["series"], f"{self.npz_path}: no series {name}"
+            return self.npz[f"time/{name}"], self.npz[name], self.metadata["series"][name]["fields"]
+        data = pd.read_csv(os.path.join(self.run_dir, f"{name}.csv"))
+        return data.iloc[:, 0].to_numpy(), data.iloc[:, 1:].to_numpy(), list(data.columns[1:])
+
+    def read_series(self, name):
+        time, values, fields = self.read(name)
+        frame = pd.DataFrame(values, columns=fields)
+        frame.insert(0, "Time", time)
+        return frame
+
+    def tidy(self, series=None):
+        frames = []
+        for name in series or self.series_names():
+            time, values, fields = self.read(name)
+            rows, cols = values.shape
+            frames.append(pd.DataFrame({
+                "series": name,
+                "field": np.tile(np.asarray(fields, dtype=object), rows),
+                "time": np.repeat(time, cols),
+                "value": values.reshape(-1).astype(float),
+            }))
+        table = pd.concat(frames, ignore_index=True)
+        table["series"] = table["series"].astype("category")
+        table["field"] = table["field"].astype("category")
+        return table
+
+
+def load_run(run_dir, series=None):
+    # Tidy DataFrame of a run: one row per series, field and time (and
+    # community, for csvContent)
+    with RunOutput(run_dir) as run:
+        return run.tidy(series)
+
+
+def load_runs(run_dirs, series=None, n_jobs=1):
+    tables = joblib.Parallel(n_jobs=n_jobs)(joblib.delayed(load_run)(d, series) for d in run_dirs)
+    for run_dir, table in zip(run_dirs, tables):
+        table.insert(0, "run", run_dir)
+    table = pd.concat(tables, ignore_index=True)
+    for column in ["run", "series", "field"]:
+        table[column] = table[column].astype("category")
+    return table
+
+
+def read_series(run_dir, name):
+    with RunOutput(run_dir) as run:
+        return run.read_series(name)
+
+
+def convert(run_dir, remove=False):
+    # Packs the csv files of a run into run.npz; with remove, deletes the csv
+    # files and the gnuplot/html files once it is written
+    with RunOutput(run_dir) as run:
+        assert run.npz is None, f"{run_dir} already has {npz_name}"
+        arrays = {}
+        metadata = {"format": "drive_simulator run.npz", "version": 1, "series": {}}
+        for name in run.series_names():
+            time, values, fields = run.read(name)
+            arrays[name] = values
+            arrays[f"time/{name}"] = time.astype(float)
+            metadata["series"][name] = {"group": "", "fields": fields}
+        if "global_params" in run.metadata:
+            metadata["global_params"] = run.metadata["global_params"]
+    path = os.path.join(run_dir, npz_name)
+    np.savez(path, **arrays)
+    with zipfile.ZipFile(path, "a") as z:
+        z.writestr(metadata_name, json.dumps(metadata))
+    if remove:
+        for name in metadata["series"]:
+            os.remove(os.path.join(run_dir, f"{name}.csv"))
+        for f in ["gnuplot_script.gnuplot", "plots.html"]:
+            if os.path.isfile(os.path.join(run_dir, f)):
+                os.remove(os.path.join(run_dir, f))
+    return path
+
+
+def main():
+    my_parser = argparse.ArgumentParser(description='Read drive_simulator outputs (run.npz or csv files)')
+    sub = my_parser.add_subparsers(dest='command', required=True)
+    show = sub.add_parser('show', help='series and global parameters of a run')
+    show.add_argument('run_dir')
+    export = sub.add_parser('export', help='tidy table of runs, to .csv or .parquet')
+    export.add_argument('run_dirs', nargs='+')
+    export.add_argument('-o', required=True)
+    export.add_argument('--series', nargs='+', help='only these series', default=None)
+    export.add_argument('-c', type=int, help='processes', default=1)
+    conv = sub.add_parser('convert', help='pack the csv files of runs into run.npz')
+    conv.add_argument('run_dirs', nargs='+')
+    conv.add_argument('--remove', action='store_true', help='delete the csv, gnuplot and html files')
+    args = my_parser.parse_args()
+
+    if args.command == 'show':
+        with RunOutput(args.run_dir) as run:
+            print("source: " + (run.npz_path if run.npz is not None else "csv files"))
+            for name in run.series_names():
+                info = run.metadata["series"][name]
+                print(f"  {name} {info['group']} {info['fields'] or ''}")
+            for key, value in run.global_params().items():
+                print(f"{key}: {value}")
+    elif args.command == 'export':
+        table = load_runs(args.run_dirs, args.series, args.c)
+        if args.o.endswith(".parquet"):
+            table.to_parquet(args.o, index=False)
+        else:
+            table.to_csv(args.o, index=False)
+        print(f"Wrote {len(table)} rows to {args.o}")
+    else:
+        for run_dir in args.run_dirs:
+            print(convert(run_dir, args.remove))
+
+
+if __name__ == "__main__":
+    main()
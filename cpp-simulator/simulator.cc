@@ -4,6 +4,7 @@
 #include <algorithm>
 #include <map>
 #include <string>
+#include <cmath>
 
 #include "models.h"
 #include "initializers.h"
@@ -39,6 +40,28 @@ int num_coaches(const std::unordered_map<count_type, std::vector<train_coach>>&
 	}
 	return i;
 }
+
+// Early termination: see STOP_FATALITIES and STOP_LAMBDA_TOLERANCE in models.h
+bool stopping_condition_met(const plot_data_struct& plot_data, count_type n_fatalities) {
+	if (GLOBAL.STOP_FATALITIES == 0 || n_fatalities <= GLOBAL.STOP_FATALITIES) {
+		return false;
+	}
+	if (GLOBAL.STOP_LAMBDA_TOLERANCE <= 0) {
+		return true;
+	}
+	for (const auto& elem : plot_data.cumulative_mean_lambda_fractions) {
+		const auto& series = elem.second;
+		if (series.size() <= GLOBAL.SIM_STEPS_PER_DAY) {
+			return false;
+		}
+		auto now = std::get<1>(series.back())[0];
+		auto day_before = std::get<1>(series[series.size() - 1 - GLOBAL.SIM_STEPS_PER_DAY])[0];
+		if (std::fabs(now - day_before) > GLOBAL.STOP_LAMBDA_TOLERANCE) {
+			return false;
+		}
+	}
+	return true;
+}
 }
 
 plot_data_struct run_simulation()
@@ -135,8 +158,13 @@ plot_data_struct run_simulation()
 	{
 		elem.second.reserve(GLOBAL.NUM_TIMESTEPS);
 	}
-	plot_data.nums["csvContent"] = {};
-	plot_data.nums["csvContent"].reserve(GLOBAL.NUM_TIMESTEPS * GLOBAL.num_communities);
+	//One row per community and time step: only kept if it is to be written
+	const bool record_csv_content = output_selected("csvContent");
+	if (record_csv_content)
+	{
+		plot_data.nums["csvContent"] = {};
+		plot_data.nums["csvContent"].reserve(GLOBAL.NUM_TIMESTEPS * GLOBAL.num_communities);
+	}
 
 	plot_data.susceptible_lambdas =
 		{
@@ -421,7 +449,10 @@ plot_data_struct run_simulation()
 		{
 			auto temp_stats = get_infected_community(nodes, communities[c]);
 			//let row = [time_step/SIM_STEPS_PER_DAY,c,temp_stats[0],temp_stats[1],temp_stats[2],temp_stats[3],temp_stats[4]].join(",");
-			plot_data.nums["csvContent"].push_back({time_step, {c, temp_stats.affected, temp_stats.susceptible, temp_stats.exposed, temp_stats.infective, temp_stats.symptomatic, temp_stats.hospitalised, temp_stats.critical, temp_stats.dead, temp_stats.recovered, temp_stats.recovered_from_infective, temp_stats.recovered_from_symptomatic, temp_stats.recovered_from_hospitalised, temp_stats.recovered_from_critical, temp_stats.hd_area_affected, temp_stats.hd_area_susceptible, temp_stats.hd_area_exposed, temp_stats.hd_area_infective, temp_stats.hd_area_symptomatic, temp_stats.hd_area_hospitalised, temp_stats.hd_area_critical, temp_stats.hd_area_dead, temp_stats.hd_area_recovered, temp_stats.hd_area_recovered_from_infective, temp_stats.hd_area_recovered_from_symptomatic, temp_stats.hd_area_recovered_from_hospitalised, temp_stats.hd_area_recovered_from_critical}});
+			if (record_csv_content)
+			{
+				plot_data.nums["csvContent"].push_back({time_step, {c, temp_stats.affected, temp_stats.susceptible, temp_stats.exposed, temp_stats.infective, temp_stats.symptomatic, temp_stats.hospitalised, temp_stats.critical, temp_stats.dead, temp_stats.recovered, temp_stats.recovered_from_infective, temp_stats.recovered_from_symptomatic, temp_stats.recovered_from_hospitalised, temp_stats.recovered_from_critical, temp_stats.hd_area_affected, temp_stats.hd_area_susceptible, temp_stats.hd_area_exposed, temp_stats.hd_area_infective, temp_stats.hd_area_symptomatic, temp_stats.hd_area_hospitalised, temp_stats.hd_area_critical, temp_stats.hd_area_dead, temp_stats.hd_area_recovered, temp_stats.hd_area_recovered_from_infective, temp_stats.hd_area_recovered_from_symptomatic, temp_stats.hd_area_recovered_from_hospitalised, temp_stats.hd_area_recovered_from_critical}});
+			}
 
 			//Update w_c value for this community, followed by update of lambdas
 			if (communities[c].individuals.size() > 0)
@@ -698,6 +729,12 @@ plot_data_struct run_simulation()
 		auto end_time_timestep = std::chrono::high_resolution_clock::now();
 		cerr << "Time step: simulation time (ms): " << duration(start_time_timestep, end_time_timestep) << "\n";
 #endif
+		if (stopping_condition_met(plot_data, n_fatalities))
+		{
+			GLOBAL.STOPPED_AT_TIME_STEP = time_step;
+			std::cout << "Stopping early at time step " << time_step << " (" << n_fatalities << " fatalities)" << std::endl;
+			break;
+		}
 	}
 	
 	for(count_type nwards = 0; nwards < GLOBAL.num_wards; nwards++){
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Sampling designs and Sobol sensitivity analysis for parameter sweeps
+# (grid-search.py --design).
+#
+# Designs give points in the unit cube [0, 1]^d, one column per swept
+# parameter; the sweep maps them to parameter values. Every point carries
+# a `block` label:
+#   grid      full factorial, `levels` values per parameter ("grid")
+#   lhs       Latin hypercube ("lhs")
+#   sobol     scrambled Sobol sequence ("sobol")
+#   adaptive  a Sobol start ("round0"), then rounds that sample boxes around
+#             the best points so far, each half as wide as the last ("roundK")
+#   saltelli  Saltelli's design for Sobol indices: n points of a
+#             2d-dimensional Sobol sequence split into matrices A and B, and
+#             d matrices AB_i (A with column i taken from B); n (d + 2) points
+#             ("A", "B", "AB0" .. "AB{d-1}", with a `row` index)
+# sobol_indices() computes first-order (Saltelli 2010) and total (Jansen)
+# indices of any output from the results of a saltelli design.
+
+import itertools
+
+import numpy as np
+import pandas as pd
+from scipy.stats import qmc
+
+designs = ["grid", "lhs", "sobol", "adaptive", "saltelli"]
+
+
+def grid(levels, dim):
+    values = np.linspace(0, 1, levels)
+    points = np.array(list(itertools.product(values, repeat=dim)))
+    return pd.DataFrame({"block": "grid", "row": np.arange(len(points))}), points
+
+
+def lhs(n, dim, seed=0):
+    points = qmc.LatinHypercube(d=dim, seed=seed).random(n)
+    return pd.DataFrame({"block": "lhs", "row": np.arange(n)}), points
+
+
+def sobol_points(n, dim, seed=0):
+    sampler = qmc.Sobol(d=dim, scramble=True, seed=seed)
+    m = int(np.ceil(np.log2(max(n, 1))))
+    # Balance properties hold for powers of two; extra points are dropped
+    return sampler.random_base2(m)[:n]
+
+
+def sobol(n, dim, seed=0):
+    return pd.DataFrame({"block": "sobol", "row": np.arange(n)}), sobol_points(n, dim, seed)
+
+
+def saltelli(n, dim, seed=0):
+    base = sobol_points(n, 2 * dim, seed)
+    A, B = base[:, :dim], base[:, dim:]
+    blocks, points = ["A", "B"], [A, B]
+    for i in range(dim):
+        AB = A.copy()
+        AB[:, i] = B[:, i]
+        blocks.append(f"AB{i}")
+        points.append(AB)
+    labels = pd.DataFrame({"block": np.repeat(blocks, n), "row": np.tile(np.arange(n), len(blocks))})
+    return labels, np.vstack(points)
+
+
+def refine(points, losses, n, round_index, seed=0, top=0.1, width=0.5):
+    # n new points in boxes around the best `top` fraction of points (lowest
+    # loss). The boxes are width / 2^(round_index - 1) wide, clipped to the
+    # unit cube; points are split between the boxes by Latin hypercube.
+    rng = np.random.default_rng([seed, round_index])
+    points = np.asarray(points)
+    losses = np.asarray(losses, dtype=float)
+    known = np.isfinite(losses)
+    assert known.any(), "adaptive design: no point has a result to refine around"
+    order = np.flatnonzero(known)[np.argsort(losses[known])]
+    best = points[order[:max(1, int(np.ceil(top * known.sum())))]]
+    half = width / 2 ** round_index
+    centres = best[np.arange(n) % len(best)]
+    offsets = qmc.LatinHypercube(d=points.shape[1], seed=rng).random(n) * 2 - 1
+    new = np.clip(centres + half * offsets, 0, 1)
+    return pd.DataFrame({"block": f"round{round_index}", "row": np.arange(n)}), new
+
+
+def sobol_indices(design, values, n_boot=200, confidence=0.95, seed=0):
+    # design: the labels of a saltelli design (block, row); values: an output
+    # for each design point (NaN for failed runs, whose rows are dropped).
+    # Returns a DataFrame with S1 and ST per parameter and bootstrap
+    # confidence intervals.
+    table = pd.DataFrame({"block": design["block"].to_numpy(), "row": design["row"].to_numpy(),
+                          "value": np.asarray(values, dtype=float)})
+    wide = table.pivot(index="row", columns="block", values="value").dropna()
+    dim = sum(1 for b in wide.columns if b.startswith("AB"))
+    yA, yB = wide["A"].to_numpy(), wide["B"].to_numpy()
+    yAB = np.column_stack([wide[f"AB{i}"].to_numpy() for i in range(dim)])
+
+    def estimate(idx):
+        a, b, ab = yA[idx], yB[idx], yAB[idx]
+        var = np.var(np.concatenate((a, b)), ddof=1)
+        if var == 0:
+            return np.full(dim, np.nan), np.full(dim, np.nan)
+        s1 = np.mean(b[:, None] * (ab - a[:, None]), axis=0) / var
+        st = 0.5 * np.mean((a[:, None] - ab) ** 2, axis=0) / var
+        return s1, st
+
+    rows = np.arange(len(yA))
+    s1, st = estimate(rows)
+    rng = np.random.default_rng(seed)
+    boots = [estimate(rng.integers(0, len(rows), len(rows))) for _ in range(n_boot)] if len(rows) > 1 else []
+    alpha = (1 - confidence) / 2
+    result = pd.DataFrame({"S1": s1, "ST": st})
+    if boots:
+        s1_boot = np.array([b[0] for b in boots])
+        st_boot = np.array([b[1] for b in boots])
+        result["S1_low"], result["S1_high"] = np.nanquantile(s1_boot, [alpha, 1 - alpha], axis=0)
+        result["ST_low"], result["ST_high"] = np.nanquantile(st_boot, [alpha, 1 - alpha], axis=0)
+    result["runs"] = len(rows)
+    return result
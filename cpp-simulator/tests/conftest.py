@@ -0,0 +1,5 @@
+# The modules under test are scripts in cpp-simulator/, not a package
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
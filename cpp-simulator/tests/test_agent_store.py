@@ -0,0 +1,86 @@
+# agent_store.py against a message-by-message encoding of the layout that
+# storeAgentsInfo writes (every field written, in field order).
+
+import numpy as np
+
+import agent_store
+from agent_store import AgentStore
+
+
+def varint(value):
+    # protobuf int32 encoding: negative values are sign extended to 64 bits
+    value &= (1 << 64) - 1
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def field(number, value):
+    return varint(number << 3 | agent_store.varint) + varint(int(value))
+
+
+def message(number, body):
+    return varint(number << 3 | agent_store.length_delimited) + varint(len(body)) + body
+
+
+def encode_agent(agent):
+    test_status = b"".join(field(number, agent[name]) for name, _, number in agent_store.test_fields)
+    body = b"".join(field(number, agent[name]) for name, _, number in agent_store.agent_fields)
+    body += message(7, test_status)
+    body += b"".join(field(number, agent[name]) for name, _, number in agent_store.late_fields)
+    return message(1, body)
+
+
+def random_agents(n, seed=0):
+    rng = np.random.default_rng(seed)
+    agents = []
+    for _ in range(n):
+        agent = {}
+        for name, dtype, _ in agent_store.agent_fields + agent_store.test_fields + agent_store.late_fields:
+            if dtype is bool:
+                agent[name] = bool(rng.integers(2))
+            else:
+                # Mostly small values, some needing several bytes, some negative
+                agent[name] = int(rng.choice([rng.integers(0, 8), rng.integers(0, 1 << 20),
+                                              rng.integers(-(1 << 31), 0), -1]))
+        agents.append(agent)
+    return agents
+
+
+def test_round_trip_is_byte_identical(tmp_path):
+    agents = random_agents(500)
+    original = b"".join(encode_agent(agent) for agent in agents)
+    path = tmp_path / "agentStore.pbstore"
+    path.write_bytes(original)
+
+    # Small chunks, so that agents and varints straddle chunk boundaries
+    store = AgentStore.read(str(path), chunk_bytes=97)
+    assert len(store) == len(agents)
+    for name in agent_store.dtypes:
+        assert list(store[name]) == [agent[name] for agent in agents], name
+
+    copy = tmp_path / "copy.pbstore"
+    store.write(str(copy), chunk_agents=64)
+    assert copy.read_bytes() == original
+
+
+def test_negative_int32_is_a_ten_byte_varint(tmp_path):
+    agent = random_agents(1)[0]
+    agent.update(tested_epoch=-1, contact_traced_epoch=-(1 << 31), time_of_infection=(1 << 31) - 1)
+    path = tmp_path / "agentStore.pbstore"
+    path.write_bytes(encode_agent(agent))
+    assert len(varint(-1)) == 10
+
+    store = AgentStore.read(str(path))
+    assert store["tested_epoch"][0] == -1
+    assert store["contact_traced_epoch"][0] == -(1 << 31)
+    assert store["time_of_infection"][0] == (1 << 31) - 1
+
+    store.write(str(tmp_path / "copy.pbstore"))
+    assert (tmp_path / "copy.pbstore").read_bytes() == path.read_bytes()
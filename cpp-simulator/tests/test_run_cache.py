@@ -0,0 +1,72 @@
+# run_cache.py: option parsing and cache key normalisation.
+
+import pytest
+
+import run_cache
+
+
+def test_parse_options():
+    args = ["--NUM_DAYS", "30", "--SEED_FIXED_NUMBER", "--BETA_H=0.5", "", "--input_directory", "city/"]
+    assert run_cache.parse_options(args) == {"NUM_DAYS": "30", "SEED_FIXED_NUMBER": True,
+                                             "BETA_H": "0.5", "input_directory": "city/"}
+    # A flag followed by an option is still a flag
+    assert run_cache.parse_options(["--A", "--B", "1"]) == {"A": True, "B": "1"}
+    with pytest.raises(AssertionError):
+        run_cache.parse_options(["NUM_DAYS"])
+
+
+def test_normalise_value():
+    assert run_cache.normalise_value("30") == run_cache.normalise_value("30.0") == 30
+    assert run_cache.normalise_value("0.5") == run_cache.normalise_value(".50")
+    assert run_cache.normalise_value("city/") == "city/"
+    assert run_cache.normalise_value(True) is True
+
+
+@pytest.fixture
+def setup(tmp_path):
+    binary = tmp_path / "drive_simulator"
+    binary.write_bytes(b"binary")
+    city = tmp_path / "city"
+    city.mkdir()
+    (city / "individuals.json").write_text("[]")
+    (city / "intervention_params.json").write_text("[{}]")
+    cache = run_cache.RunCache(str(tmp_path / "cache"))
+    seeds = ["--PROVIDE_INITIAL_SEED", "5", "--PROVIDE_INITIAL_SEED_GRAPH", "3"]
+    return cache, str(binary), city, seeds
+
+
+def test_key_normalises_options(setup):
+    cache, binary, city, seeds = setup
+    key = cache.key([binary, "--NUM_DAYS", "30", "--input_directory", str(city),
+                     "--output_directory", "out1"] + seeds)
+    assert key is not None
+    # Same run: --KEY=VALUE, numbers as numbers, another order and output directory
+    assert key == cache.key([binary, "--output_directory=out2", "--input_directory", str(city)] + seeds
+                            + ["--NUM_DAYS=30.0"])
+    assert key != cache.key([binary, "--NUM_DAYS", "31", "--input_directory", str(city)] + seeds)
+
+
+def test_key_follows_file_contents(setup):
+    cache, binary, city, seeds = setup
+    cmd = [binary, "--input_directory", str(city), "--intervention_filename", "intervention_params.json"] + seeds
+    key = cache.key(cmd)
+    (city / "intervention_params.json").write_text("[{\"num_days\": 1}]")
+    assert cache.key(cmd) != key
+    (city / "individuals.json").write_text("[{}]")
+    changed = cache.key(cmd)
+    assert changed != key and cache.key(cmd) == changed
+
+
+def test_key_seed_replicate_and_keep(setup):
+    cache, binary, city, seeds = setup
+    unseeded = [binary, "--input_directory", str(city)]
+    # Unseeded runs are only cached with a replicate id, which is part of the key
+    assert cache.key(unseeded) is None
+    assert cache.key(unseeded, replicate=0) != cache.key(unseeded, replicate=1)
+    # Seeded runs ignore the replicate id
+    seeded = unseeded + seeds
+    assert cache.key(seeded, replicate=0) == cache.key(seeded, replicate=1) == cache.key(seeded)
+    # keep is part of the key, in any order
+    assert cache.key(seeded, keep=["a.csv", "b.csv"]) == cache.key(seeded, keep=["b.csv", "a.csv"])
+    assert cache.key(seeded, keep=["a.csv"]) != cache.key(seeded, keep=["a.csv", "b.csv"])
+    assert cache.key(seeded, keep=["a.csv"]) != cache.key(seeded)
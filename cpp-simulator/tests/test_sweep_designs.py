@@ -0,0 +1,41 @@
+# sweep_designs.py: designs and Sobol indices on functions whose indices are
+# known.
+
+import numpy as np
+
+import sweep_designs
+
+
+def ishigami(unit, a=7, b=0.1):
+    x = np.pi * (2 * unit - 1)
+    return np.sin(x[:, 0]) + a * np.sin(x[:, 1]) ** 2 + b * x[:, 2] ** 4 * np.sin(x[:, 0])
+
+
+def test_saltelli_design():
+    labels, points = sweep_designs.saltelli(8, 3)
+    assert len(labels) == len(points) == 8 * (3 + 2)
+    A, B = points[labels["block"] == "A"], points[labels["block"] == "B"]
+    AB1 = points[labels["block"] == "AB1"]
+    assert np.array_equal(AB1[:, [0, 2]], A[:, [0, 2]]) and np.array_equal(AB1[:, 1], B[:, 1])
+
+
+def test_sobol_indices_ishigami():
+    labels, points = sweep_designs.saltelli(4096, 3)
+    table = sweep_designs.sobol_indices(labels, ishigami(points), n_boot=50)
+    # Analytic values for a = 7, b = 0.1
+    assert np.allclose(table["S1"], [0.3139, 0.4424, 0.0], atol=0.05)
+    assert np.allclose(table["ST"], [0.5576, 0.4424, 0.2437], atol=0.05)
+    assert (table["S1_low"] <= table["S1"]).all() and (table["S1"] <= table["S1_high"]).all()
+    assert (table["runs"] == 4096).all()
+
+
+def test_sobol_indices_additive_drops_failed_runs():
+    labels, points = sweep_designs.saltelli(1024, 3)
+    values = points @ np.array([1.0, 2.0, 0.0])
+    # A failed run loses its whole row (A, B and every AB_i)
+    values[[3, 1024 + 10, 2 * 1024 + 20]] = np.nan
+    table = sweep_designs.sobol_indices(labels, values, n_boot=0)
+    assert np.allclose(table["S1"], [0.2, 0.8, 0.0], atol=0.03)
+    assert np.allclose(table["ST"], table["S1"], atol=0.03)
+    assert (table["runs"] == 1024 - 3).all()
+    assert "S1_low" not in table
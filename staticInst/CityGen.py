@@ -6,32 +6,45 @@ import pickle
 
 import json
 import pandas as pd
-import geopandas as gpd
 import argparse
 
-import math
-from shapely.geometry import Point, MultiPolygon, Polygon
-
 import os
 import sys
 from pathlib import Path
 
-import matplotlib.pyplot as plt
 from computeDistributions import *
+from citySampling import normalise, sampleBinsWeights, distance, workplaces_size_distribution
+from cityMetadata import compute_city_metadata, default_nbr_cell_size
+from workplaceAssignment import assign_workplaces
+from membershipIndex import MembershipIndex
+from stageProfiler import profiler
 
 from functools import wraps
 from time import time
 
 import warnings
-warnings.simplefilter('error')
+
+# geopandas/shapely are only imported when city.geojson is actually parsed,
+# and matplotlib only when validation plots are requested. Runs that use
+# presampled points without --validate never pay for either.
+
+def item_counts(city):
+    # What a stage produced, for the run report (see stageProfiler.py)
+    counts = {}
+    for name in ["houses", "individuals", "schools", "workplaces"]:
+        items = getattr(city, name, None)
+        counts[name] = len(items) if items is not None else 0
+    return counts
 
 def measure(func):
     @wraps(func)
     def _time_it(*args, **kwargs):
         start = time()
+        counter = (lambda: item_counts(args[0])) if len(args) > 0 and hasattr(args[0], "houses") else None
         try:
             print(f"{func.__name__.ljust(30)}...\t", end='', flush=True)
-            return func(*args, **kwargs)
+            with profiler.stage(func.__name__, counter):
+                return func(*args, **kwargs)
         finally:
             end = int((time() - start)*1000)
             print(f"done. ({end} ms)")
@@ -56,6 +69,8 @@ outputfiles = {
     "commonArea":"commonArea.json",
     "fractionPopulation":"fractionPopulation.json",
     "PRG_np_random_state":"PRG_np_random_state.bin",
+    "cityMetadata":"cityMetadata.json",
+    "membershipIndex":"membershipIndex.npz",
     }
 
 workplacesTypes = {
@@ -81,59 +96,6 @@ def fileExists(path):
 def folderExists(path):
     return os.path.exists(path)
 
-def normalise(raw): 
-    # Scale everything so that the array sums to 1
-    # It doesn't quite, due to floating point errors, but 
-    # np.random.choice does not complain anymore.
-    s = sum([float(i) for i in raw]); return [float(i)/s for i in raw]
-
-def sampleBinsWeights(bins,weights):
-    assert len(bins) == len(weights)
-
-    s = str(np.random.choice(bins,1,p=weights)[0])
-    if '+' in s:
-        return int(s[:-1])+1
-        #This is the last bucket, something like x+. Choosing (x+1) by default.
-    elif '-' in s:
-        (a,b) = s.split('-')
-        return np.random.randint(int(a),int(b)+1) #np.random.randint chooses from halfopen interval
-    else:
-        return int(s)
-
-def distance(lat1, lon1, lat2, lon2):
-    radius = 6371 # km
-
-    dlat = math.radians(lat2-lat1)
-    dlon = math.radians(lon2-lon1)
-    a = (math.sin(dlat/2) * math.sin(dlat/2) + math.cos(math.radians(lat1)) 
-         * math.cos(math.radians(lat2)) * math.sin(dlon/2) * math.sin(dlon/2))
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-    d = radius * c
-
-    return d
-
-def workplaces_size_distribution(a=3.26, c=0.97, m_max=2870):
-    # This is a particular version of the power law:
-    # Pr[ m > x ] is proportional to x^{-c}. 
-    # This is additionally slightly adjusted in this implementation
-    # so that the max workplace size = m_max, and the size is always 
-    # at least 1. 
-    # RP: There is also a scaling by a parameter 'a', which I don't 
-    # follow why, but leaving the implementation as earlier.
-    # RP: should add a reference for why these a,c,m_max were chosen.
-
-    mirror_cdf = np.zeros(m_max, dtype=float)   # mirror_cdf[i] = Pr[ size > i]
-    for m in range(m_max):
-        mirror_cdf[m] =(  (((1 + (m_max/a))/((1 + (m/a)))**c) - 1) / 
-                        (((1 + (m_max/a))**c)-1))
-
-    p_n = np.insert((np.diff(mirror_cdf) * (-1)), 0, 0)  
-    # np.diff computes a[i+1] - a[i]. We want a[i] - a[i+1]
-    assert len(p_n)==m_max
-    return p_n / sum(p_n)
-
-
-
 class City:
 
     def reset(self):
@@ -152,6 +114,9 @@ class City:
         self.a_commuter_distance = 4 #parameter in distribution for commuter distance - Thailand paper
         self.b_commuter_distance = 3.8  #parameter in distribution for commuter distance - Thailand paper
         self.m_max_commuter_distance = None
+        # "ward": uniformly random workplace in the OD-matrix ward (default)
+        # "kernel": workplaceAssignment.assign_workplaces
+        self.workplace_assignment = "ward"
 
         self.nwards = None
         self.totalPop = None
@@ -178,6 +143,8 @@ class City:
         self.workers = None
         self.schoolers = None
 
+        self.nbr_cell_size = default_nbr_cell_size # km, only used for cityMetadata.json
+
         #This is what we will eventually generate
         self.houses = None
         self.num_houses = None
@@ -267,40 +234,49 @@ class City:
     
     def set_geoDF(self, input_dir):
         assert fileExists(Path(input_dir, inputfiles["citygeojson"])), f"{inputfiles['citygeojson']} missing"
+
+        # city.geojson is the only input that needs the geospatial stack, so it is
+        # imported here rather than at module level. Geometry warnings are treated
+        # as errors while the wards are parsed.
+        import geopandas as gpd
+        from shapely.geometry import MultiPolygon, Polygon
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
         
-        geoDF = gpd.read_file(Path(input_dir,inputfiles["citygeojson"]))
+            geoDF = gpd.read_file(Path(input_dir,inputfiles["citygeojson"]))
 
-        necessary_cols = ['wardNo', 'wardName', 'geometry']
-        for col in necessary_cols:
-            assert col in geoDF.columns
-        geoDF = geoDF[necessary_cols]
+            necessary_cols = ['wardNo', 'wardName', 'geometry']
+            for col in necessary_cols:
+                assert col in geoDF.columns
+            geoDF = geoDF[necessary_cols]
     
-        # read this for Polygon to MultiPolygon: https://gis.stackexchange.com/questions/311320/casting-geometry-to-multi-using-geopandas
-        # allow polygon as boundary
-        geoDF["geometry"] = [MultiPolygon([feature]) if isinstance(feature, Polygon) else feature for feature in geoDF["geometry"]]
+            # read this for Polygon to MultiPolygon: https://gis.stackexchange.com/questions/311320/casting-geometry-to-multi-using-geopandas
+            # allow polygon as boundary
+            geoDF["geometry"] = [MultiPolygon([feature]) if isinstance(feature, Polygon) else feature for feature in geoDF["geometry"]]
 
-        geoDF['wardBounds'] = geoDF.apply( (lambda row:  MultiPolygon(row['geometry']).bounds), axis=1)
+            geoDF['wardBounds'] = geoDF.apply( (lambda row:  MultiPolygon(row['geometry']).bounds), axis=1)
         
-        geoDF['wardCentre'] = geoDF.apply(
-            lambda row: (
-                MultiPolygon(row['geometry']).centroid.x, 
-                MultiPolygon(row['geometry']).centroid.y
-            ),
-            axis=1
-            )
-        geoDF['wardNo'] = geoDF['wardNo'].astype(int)
-        geoDF['wardName'] = geoDF['wardName'].astype(str) # make sure it's string... not translated zipcode to number
-
-        self.wardData = self.wardData.merge(
-            geoDF, 
-            on="wardName",
-            validate="one_to_one")
+            geoDF['wardCentre'] = geoDF.apply(
+                lambda row: (
+                    MultiPolygon(row['geometry']).centroid.x, 
+                    MultiPolygon(row['geometry']).centroid.y
+                ),
+                axis=1
+                )
+            geoDF['wardNo'] = geoDF['wardNo'].astype(int)
+            geoDF['wardName'] = geoDF['wardName'].astype(str) # make sure it's string... not translated zipcode to number
+
+            self.wardData = self.wardData.merge(
+                geoDF, 
+                on="wardName",
+                validate="one_to_one")
         
-        self.check_merged_df(self.wardData, "city.geojson")
-        self.wardData = (self.wardData
-                             .drop(['wardNo_y'], axis=1)
-                             .rename(columns={'wardNo_x':'wardNo'})
-                            )
+            self.check_merged_df(self.wardData, "city.geojson")
+            self.wardData = (self.wardData
+                                 .drop(['wardNo_y'], axis=1)
+                                 .rename(columns={'wardNo_x':'wardNo'})
+                                )
 
     def set_ODMatrix(self, input_dir):
         assert self.nwards is not None
@@ -401,6 +377,7 @@ class City:
             (lat,lon) = self.presampled_points[wardIndex].iloc[i]
             return (lat,lon)
         else:
+            from shapely.geometry import MultiPolygon, Point
             (lon1,lat1,lon2,lat2) = self.wardData['wardBounds'].iloc[wardIndex]
             while True:
                 lat = np.random.uniform(lat1,lat2)
@@ -469,10 +446,11 @@ class City:
         return distance(lat,lon,latc,lonc)
         
     @measure
-    def createHouses(self):
+    def createHouses(self, wardIndices=None):
+        # wardIndices restricts generation to some wards (see cityUpdate.py)
         self.houses = []
         hid = 0
-        for wardIndex in range(self.nwards):
+        for wardIndex in (range(self.nwards) if wardIndices is None else wardIndices):
             pop = self.wardData["totalPopulation"][wardIndex]
             currpop = 0
 
@@ -673,6 +651,11 @@ class City:
         assert self.individuals is not None
         assert self.schools is not None
         
+        if self.workplace_assignment == "kernel":
+            self.assignWorkplacesByKernel()
+            return
+        assert self.workplace_assignment == "ward", f"Unknown workplace assignment {self.workplace_assignment}"
+
         self.workplaces = []
         count = 0
         for wardIndex in range(self.nwards):
@@ -701,6 +684,57 @@ class City:
                 self.workplaces.append(w)
                 count+=1
         self.num_workplaces = count
+
+    def assignWorkplacesByKernel(self):
+        # Workplaces are created per ward exactly as in assignWorkplaces, with
+        # the OD matrix deciding how many jobs each ward has. Workers are then
+        # matched to them with the commute distance kernel instead of
+        # uniformly within their workplace ward.
+        self.workplaces = []
+        capacity = []
+        count = 0
+        for wardIndex in range(self.nwards):
+            num_ward_workers = len(self.workers[wardIndex])
+            ward_capacity = 0
+            while ward_capacity < num_ward_workers:
+                wid = count + self.num_schools
+                w = {
+                    "id":wid,
+                    "wardIndex":wardIndex
+                }
+
+                (lat,lon) = self.sampleRandomLatLon(wardIndex)
+                w["lat"] = lat
+                w["lon"] = lon
+
+                s = self.sampleWorkplaceSize()
+                oType = self.sampleOfficeType(s)
+                w["officeType"]=oType
+
+                self.workplaces.append(w)
+                capacity.append(s)
+                ward_capacity += s
+                count+=1
+        self.num_workplaces = count
+
+        workers = [pid for wardIndex in range(self.nwards) for pid in self.workers[wardIndex]]
+        self.workers = [[] for _ in range(self.nwards)]
+        if len(workers) == 0:
+            return
+
+        wp_index = assign_workplaces(
+            [self.individuals[pid]["lat"] for pid in workers],
+            [self.individuals[pid]["lon"] for pid in workers],
+            [w["lat"] for w in self.workplaces],
+            [w["lon"] for w in self.workplaces],
+            capacity,
+            self.a_commuter_distance,
+            self.b_commuter_distance,
+            self.m_max_commuter_distance
+            )
+        for pid, i in zip(workers, wp_index.tolist()):
+            self.individuals[pid]["workplace"] = self.workplaces[i]["id"]
+            del self.individuals[pid]["workplaceward"]
     
     def describe(self):
         print(f"City: {self.name}")
@@ -778,6 +812,10 @@ class City:
             f.write(json.dumps(wardCentreDistances))     
         with open(os.path.join(output_dir,outputfiles['PRG_np_random_state']), "wb+") as f:
             pickle.dump(self.state_np_random,f)
+        with open(os.path.join(output_dir,outputfiles['cityMetadata']), "w+") as f:
+            f.write(json.dumps(compute_city_metadata(self.houses, self.nbr_cell_size)))
+        MembershipIndex.from_records(self.individuals, self.houses, self.num_schools,
+                                     self.num_workplaces, self.nwards).save(output_dir)
 
         
     def __init__(self, input_dir, random_seed_dir = None):
@@ -808,6 +846,7 @@ class City:
 
 @measure
 def validate_slum_ages(city, df_ind, plots_folder=None):
+    import matplotlib.pyplot as plt
     age_values, age_distribution = compute_age_distribution(city.age_slum_weights)
     df_slum = df_ind[df_ind['slum']==1]
     plt.plot(
@@ -832,6 +871,7 @@ def validate_slum_ages(city, df_ind, plots_folder=None):
     
 @measure
 def validate_non_slum_ages(city, df_ind, plots_folder=None):
+    import matplotlib.pyplot as plt
     age_values, age_distribution = compute_age_distribution(city.age_weights)
     if city.has_slums:
         df_non_slum = df_ind[df_ind['slum']==0]
@@ -859,7 +899,8 @@ def validate_non_slum_ages(city, df_ind, plots_folder=None):
 
 
 @measure
-def validate_householdsizes(city, df_ind, plots_folder=None):    
+def validate_householdsizes(city, df_ind, plots_folder=None):
+    import matplotlib.pyplot as plt
     household_sizes, household_distribution = compute_household_size_distribution(
         city.householdsize_bins, 
         city.householdsize_weights
@@ -889,6 +930,7 @@ def validate_householdsizes(city, df_ind, plots_folder=None):
 
 @measure
 def validate_schoolsizes(city, df_ind, plots_folder=None):
+    import matplotlib.pyplot as plt
     weights = city.schoolsize_weights
     df = ((df_ind
           .dropna(subset=['school'])
@@ -919,6 +961,7 @@ def validate_schoolsizes(city, df_ind, plots_folder=None):
 
 @measure
 def validate_workplacesizes(city, df_ind, plots_folder=None):
+    import matplotlib.pyplot as plt
     p_n = workplaces_size_distribution()
     plt.loglog(
         (df_ind
@@ -943,6 +986,7 @@ def validate_workplacesizes(city, df_ind, plots_folder=None):
 
 @measure
 def validate_commutedistances(city, df_ind, df_work, plots_folder=None):
+    import matplotlib.pyplot as plt
     df_merged = (df_ind
                  .dropna(subset=['workplace'])
                  .merge(
@@ -1007,6 +1051,11 @@ def main():
     my_parser.add_argument('--validate', help='script for validation plots on', action="store_true")
     my_parser.add_argument('--cohorts', help='[for cohorts] to instantiate cohorts in mumbai locals', action="store_true")
     my_parser.add_argument('-s', help='[for debug] restore random seed from folder', default=None)
+    my_parser.add_argument('--NBR_CELL_SIZE', help='neighbourhood cell size in km, for cityMetadata.json', type=float, default=default_nbr_cell_size)
+    my_parser.add_argument('--report', help='JSON run report with per-stage time, memory, items and RNG draws (default: <output folder>/cityGenReport.json)', default=None)
+    my_parser.add_argument('--trace', help='also write the stages in Chrome trace-event format to this file', default=None)
+    my_parser.add_argument('--count_rng_draws', help='count numpy.random variates per stage (slightly slower)', action="store_true")
+    my_parser.add_argument('--workplace_assignment', help='ward: random workplace in the OD-matrix ward, kernel: commute distance kernel', choices=['ward','kernel'], default='ward')
 
     args = my_parser.parse_args()
     population = int(args.n)
@@ -1021,13 +1070,29 @@ def main():
     print(f"input_folder: {input_dir}")
     print(f"output_folder: {output_dir}")
     print("")
-    city = City(input_dir, random_seed_dir = args.s)
+    if args.count_rng_draws:
+        profiler.count_rng_draws()
+    with profiler.stage("read_inputs"):
+        city = City(input_dir, random_seed_dir = args.s)
+    city.nbr_cell_size = args.NBR_CELL_SIZE
+    city.workplace_assignment = args.workplace_assignment
     city.generate(population)
 
     city.dump_files(output_dir)
     if args.validate:
         validate(city,output_dir)
 
+    report = args.report if args.report is not None else os.path.join(output_dir, 'cityGenReport.json')
+    profiler.write_report(report, extra={
+        "city": city.name,
+        "input_folder": input_dir,
+        "output_folder": output_dir,
+        "target_population": population,
+        "items": item_counts(city),
+        })
+    if args.trace is not None:
+        profiler.write_trace(args.trace)
+
 if __name__ == "__main__":
     main()
 
@@ -1038,6 +1103,7 @@ if __name__ == "__main__":
 ###### OLDER VALIDATION Scripts. Keeping it for just comparison in case I missed something
 @measure
 def validate_old(city, plots_folder=None):
+    import matplotlib.pyplot as plt
     ### I am just copying the validation scripts for now. 
     ### Not going through them carefully
     
@@ -18,7 +18,12 @@ from pathlib import Path
 
 import matplotlib.pyplot as plt
 from .computeDistributions import *
+from .cityMetadata import compute_city_metadata, default_nbr_cell_size
+from .workplaceAssignment import assign_workplaces
 
+import copy
+import hashlib
+from collections import OrderedDict
 from functools import wraps
 from time import time
 
@@ -56,6 +61,7 @@ outputfiles = {
     "commonArea":"commonArea.json",
     "fractionPopulation":"fractionPopulation.json",
     "PRG_np_random_state":"PRG_np_random_state.bin",
+    "cityMetadata":"cityMetadata.json",
     }
 
 workplacesTypes = {
@@ -133,6 +139,94 @@ def workplaces_size_distribution(a=3.26, c=0.97, m_max=2870):
     return p_n / sum(p_n)
 
 
+# The web tier calls City(...) once per request, usually with the same
+# uploaded city and only a different target population. Parsing the GeoJSON
+# and building wardData dominates the setup cost, so the parsed state is kept
+# in a small LRU cache keyed by a hash of the input contents.
+
+def inputs_digest(inputFiles):
+    h = hashlib.sha256()
+    for key in sorted(inputFiles.keys()):
+        value = inputFiles[key]
+        if isinstance(value, (bytes, bytearray)):
+            raw = bytes(value)
+        elif isinstance(value, str):
+            raw = value.encode("utf-8")
+        else:
+            raw = json.dumps(value, sort_keys=True, default=str).encode("utf-8")
+        h.update(key.encode("utf-8"))
+        h.update(hashlib.sha256(raw).digest())
+    return h.hexdigest()
+
+def prepared_state_nbytes(state):
+    # Approximate: geometries are python objects that pandas does not measure,
+    # so the size of the serialised GeoJSON they came from is used instead.
+    nbytes = state.get("_source_nbytes", 0)
+    if state.get("wardData") is not None:
+        nbytes += int(state["wardData"].memory_usage(deep=True).sum())
+    if state.get("ODMatrix") is not None:
+        nbytes += np.asarray(state["ODMatrix"]).nbytes
+    return nbytes
+
+class PreparedInputsCache:
+
+    def __init__(self, max_entries=8, max_bytes=512*1024*1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key][0]
+
+    def put(self, key, state):
+        size = prepared_state_nbytes(state)
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key)[1]
+        self.entries[key] = (state, size)
+        self.nbytes += size
+        while len(self.entries) > self.max_entries or self.nbytes > self.max_bytes:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.nbytes -= evicted_size
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "bytes": self.nbytes,
+            "hits": self.hits,
+            "misses": self.misses
+            }
+
+prepared_inputs_cache = PreparedInputsCache()
+
+def records_to_columns(records):
+    # Union of keys in first-seen order. Individuals only carry 'school',
+    # 'workplace' or 'slum' when relevant; like pd.DataFrame(records) the
+    # missing entries become NaN in a float column.
+    keys = list(OrderedDict.fromkeys(k for r in records for k in r.keys()))
+    columns = OrderedDict()
+    for key in keys:
+        values = [r.get(key) for r in records]
+        if any(v is None for v in values):
+            columns[key] = np.array([np.nan if v is None else v for v in values], dtype=float)
+        else:
+            columns[key] = np.asarray(values)
+    return columns
+
+
 
 class City:
 
@@ -152,6 +246,9 @@ class City:
         self.a_commuter_distance = 4 #parameter in distribution for commuter distance - Thailand paper
         self.b_commuter_distance = 3.8  #parameter in distribution for commuter distance - Thailand paper
         self.m_max_commuter_distance = None
+        # "ward": uniformly random workplace in the OD-matrix ward (default)
+        # "kernel": workplaceAssignment.assign_workplaces
+        self.workplace_assignment = "ward"
 
         self.nwards = None
         self.totalPop = None
@@ -178,6 +275,8 @@ class City:
         self.workers = None
         self.schoolers = None
 
+        self.nbr_cell_size = default_nbr_cell_size # km, only used for cityMetadata.json
+
         #This is what we will eventually generate
         self.houses = None
         self.num_houses = None
@@ -677,6 +776,11 @@ class City:
         assert self.individuals is not None
         assert self.schools is not None
         
+        if self.workplace_assignment == "kernel":
+            self.assignWorkplacesByKernel()
+            return
+        assert self.workplace_assignment == "ward", f"Unknown workplace assignment {self.workplace_assignment}"
+
         self.workplaces = []
         count = 0
         for wardIndex in range(self.nwards):
@@ -705,6 +809,57 @@ class City:
                 self.workplaces.append(w)
                 count+=1
         self.num_workplaces = count
+
+    def assignWorkplacesByKernel(self):
+        # Workplaces are created per ward exactly as in assignWorkplaces, with
+        # the OD matrix deciding how many jobs each ward has. Workers are then
+        # matched to them with the commute distance kernel instead of
+        # uniformly within their workplace ward.
+        self.workplaces = []
+        capacity = []
+        count = 0
+        for wardIndex in range(self.nwards):
+            num_ward_workers = len(self.workers[wardIndex])
+            ward_capacity = 0
+            while ward_capacity < num_ward_workers:
+                wid = count + self.num_schools
+                w = {
+                    "id":wid,
+                    "wardIndex":wardIndex
+                }
+
+                (lat,lon) = self.sampleRandomLatLon(wardIndex)
+                w["lat"] = lat
+                w["lon"] = lon
+
+                s = self.sampleWorkplaceSize()
+                oType = self.sampleOfficeType(s)
+                w["officeType"]=oType
+
+                self.workplaces.append(w)
+                capacity.append(s)
+                ward_capacity += s
+                count+=1
+        self.num_workplaces = count
+
+        workers = [pid for wardIndex in range(self.nwards) for pid in self.workers[wardIndex]]
+        self.workers = [[] for _ in range(self.nwards)]
+        if len(workers) == 0:
+            return
+
+        wp_index = assign_workplaces(
+            [self.individuals[pid]["lat"] for pid in workers],
+            [self.individuals[pid]["lon"] for pid in workers],
+            [w["lat"] for w in self.workplaces],
+            [w["lon"] for w in self.workplaces],
+            capacity,
+            self.a_commuter_distance,
+            self.b_commuter_distance,
+            self.m_max_commuter_distance
+            )
+        for pid, i in zip(workers, wp_index.tolist()):
+            self.individuals[pid]["workplace"] = self.workplaces[i]["id"]
+            del self.individuals[pid]["workplaceward"]
     
     def describe(self):
         print(f"City: {self.name}")
@@ -730,18 +885,12 @@ class City:
         print("")
         self.describe()
         
-    @measure
-    def dump_files(self):
+    def output_tables(self):
         assert self.houses is not None
         assert self.individuals is not None
         assert self.schools is not None
         assert self.workplaces is not None
         
-        # assert output_dir is not None
-               
-        
-        # Path(output_dir).mkdir(parents = True, exist_ok = True)
-        
         commonAreas = []
         for i in range(self.nwards):
             c = {"ID":i}
@@ -766,7 +915,52 @@ class City:
                                                             commonAreas[j]["lat"],
                                                             commonAreas[j]["lon"])
 
-        return self.individuals, self.houses, self.workplaces, self.schools, wardCentreDistances, commonAreas, fractionPopulations
+        return OrderedDict([
+            ("individuals", self.individuals),
+            ("houses", self.houses),
+            ("workplaces", self.workplaces),
+            ("schools", self.schools),
+            ("wardCentreDistance", wardCentreDistances),
+            ("commonArea", commonAreas),
+            ("fractionPopulation", fractionPopulations),
+            ])
+
+    @measure
+    def dump_files(self):
+        # assert output_dir is not None
+        # Path(output_dir).mkdir(parents = True, exist_ok = True)
+        return tuple(self.output_tables().values())
+
+    @measure
+    def dump_columns(self, fmt="numpy"):
+        # Columnar results: one dict of numpy arrays per output file, or a
+        # pyarrow.Table per file with fmt="arrow". Arrow wraps the numeric
+        # numpy buffers without copying them.
+        tables = OrderedDict(
+            (name, records_to_columns(records))
+            for name, records in self.output_tables().items()
+            )
+        if fmt == "numpy":
+            return tables
+        assert fmt == "arrow", f"Unknown columnar format {fmt}"
+        import pyarrow as pa
+        return OrderedDict((name, pa.table(dict(cols))) for name, cols in tables.items())
+
+    def city_metadata(self):
+        # Bounding box and per-house neighbourhood cells for drive_simulator
+        assert self.houses is not None
+        return compute_city_metadata(self.houses, self.nbr_cell_size)
+
+    @measure
+    def dump_payload(self):
+        # Pre-serialised JSON, keyed by output filename, so the caller can
+        # stream the bytes without another encode pass.
+        payload = OrderedDict(
+            (outputfiles[name], json.dumps(records).encode("utf-8"))
+            for name, records in self.output_tables().items()
+            )
+        payload[outputfiles["cityMetadata"]] = json.dumps(self.city_metadata()).encode("utf-8")
+        return payload
 
         # with open(os.path.join(output_dir,outputfiles['houses']), "w+") as f:
         #     f.write(json.dumps(self.houses))
@@ -786,9 +980,32 @@ class City:
         #     pickle.dump(self.state_np_random,f)
 
         
-    def __init__(self, inputFiles, random_seed_dir = None):
+    def save_prepared_state(self, key, inputFiles):
+        state = {k: v for (k, v) in vars(self).items() if k != "state_np_random"}
+        state["wardData"] = self.wardData.copy(deep=True)
+        state["_source_nbytes"] = len(inputFiles.get('city', ""))
+        prepared_inputs_cache.put(key, state)
+
+    def load_prepared_state(self, state):
+        for (k, v) in state.items():
+            if k == "_source_nbytes":
+                continue
+            setattr(self, k, copy.copy(v))
+        # rescale() and populateHouses() write into wardData
+        self.wardData = state["wardData"].copy(deep=True)
+
+    def __init__(self, inputFiles, random_seed_dir = None, use_cache = True):
         self.reset()
         print("in __init__ of city gen")
+
+        key = inputs_digest(inputFiles) if use_cache else None
+        state = prepared_inputs_cache.get(key) if use_cache else None
+        if state is not None:
+            print("(using cached inputs)")
+            self.load_prepared_state(state)
+            self.save_random_seeds()
+            return
+
         self.set_city_profile(inputFiles)
 
         # if random_seed_dir is not None:
@@ -805,6 +1022,8 @@ class City:
         self.set_geoDF(inputFiles) 
         self.reorder_wardData_Rows()
         self.set_community_centres()
+        if use_cache:
+            self.save_prepared_state(key, inputFiles)
 
 
 # In[ ]:
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Benchmark suite for the synthetic population pipeline.
+#
+# Cases (all offline, CPU only):
+#   hillsborough_fl-<n>   CityGen.py on data/base/hillsborough_fl for each
+#                         target population n (10k, 100k and 1M by default),
+#                         with --validate, seeded from data/test so that
+#                         runs are comparable. Every City stage, dump_files
+#                         and each validate_* plot is timed.
+#   test-fixture          streaming summary (validation.py) and membership
+#                         index of the generated city in data/test.
+#
+# Each case runs in a fresh interpreter, so peak RSS is per case. Results
+# are compared with benchmarks/baselines.json; a metric regresses when it
+# is more than --threshold (relative) above its baseline. Exit status is 1
+# if anything regressed or a case has no baseline; baselines are machine
+# specific, so record them first with --update_baselines.
+#
+# Usage:
+#   python benchCityGen.py                       # 10k, 100k, 1M
+#   python benchCityGen.py --sizes 10000 --threshold 0.3
+#   python benchCityGen.py --sizes 10000 100000 --update_baselines
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from collections import OrderedDict
+
+staticInst_dir = os.path.dirname(os.path.abspath(__file__))
+default_input = os.path.join("data", "base", "hillsborough_fl")
+fixture_dir = os.path.join("data", "test")
+default_baselines = os.path.join(staticInst_dir, "benchmarks", "baselines.json")
+default_sizes = [10000, 100000, 1000000]
+
+# Stages shorter than this are reported but not checked: their relative
+# noise is larger than any sensible threshold.
+min_checked_seconds = 0.05
+
+fixture_script = """
+import json, sys
+from stageProfiler import profiler
+from cityFileReader import summarise_individuals
+from membershipIndex import MembershipIndex
+city_dir, report = sys.argv[1], sys.argv[2]
+with profiler.stage("summarise_individuals"):
+    summarise_individuals(city_dir + "/individuals.json", city_dir + "/workplaces.json", 100)
+with profiler.stage("membership_index"):
+    MembershipIndex.from_city_files(city_dir)
+profiler.write_report(report)
+"""
+
+
+def stage_metrics(report):
+    # {metric: value}: seconds per stage (summed over repeated stages),
+    # plus peak RSS of the whole run in kB.
+    metrics = OrderedDict()
+    for stage in report["stages"]:
+        key = f"{stage['name']}_s"
+        metrics[key] = metrics.get(key, 0.0) + stage["wall_s"]
+    metrics["total_s"] = report["total"]["wall_s"]
+    metrics["peak_rss_kb"] = report["total"]["peak_rss_kb"]
+    return metrics
+
+
+def run_citygen(n, input_dir, workdir):
+    output_dir = os.path.join(workdir, f"city-{n}")
+    report = os.path.join(workdir, f"report-{n}.json")
+    env = dict(os.environ, MPLBACKEND="Agg")
+    proc = subprocess.run(
+        [sys.executable, "CityGen.py", "-n", str(n), "-i", input_dir, "-o", output_dir,
+         "-s", fixture_dir, "--validate", "--report", report],
+        cwd=staticInst_dir, env=env, capture_output=True, text=True)
+    assert proc.returncode == 0, f"CityGen.py -n {n} failed:\n{proc.stdout[-2000:]}\n{proc.stderr[-2000:]}"
+    with open(report, "r") as f:
+        return stage_metrics(json.load(f))
+
+
+def run_fixture(workdir):
+    report = os.path.join(workdir, "report-fixture.json")
+    proc = subprocess.run([sys.executable, "-c", fixture_script, fixture_dir, report],
+                          cwd=staticInst_dir, capture_output=True, text=True)
+    assert proc.returncode == 0, f"fixture benchmark failed:\n{proc.stderr[-2000:]}"
+    with open(report, "r") as f:
+        return stage_metrics(json.load(f))
+
+
+def compare(results, baselines, threshold):
+    # Returns the list of (case, metric, baseline, value) that regressed,
+    # and the cases with no baseline.
+    regressions = []
+    missing = []
+    for case, metrics in results.items():
+        base = baselines.get(case)
+        if base is None:
+            missing.append(case)
+            continue
+        for metric, value in metrics.items():
+            if metric not in base or value is None or base[metric] is None:
+                continue
+            if metric.endswith("_s") and max(value, base[metric]) < min_checked_seconds:
+                continue
+            if value > base[metric] * (1 + threshold):
+                regressions.append((case, metric, base[metric], value))
+    return regressions, missing
+
+
+def print_results(results, baselines):
+    for case, metrics in results.items():
+        print(f"\n{case}")
+        base = baselines.get(case, {})
+        for metric, value in metrics.items():
+            line = f"  {metric.ljust(32)} {value:12.3f}" if isinstance(value, float) else f"  {metric.ljust(32)} {value:12}"
+            if base.get(metric):
+                line += f"   ({(value / base[metric] - 1) * 100:+.1f}% vs baseline)"
+            print(line)
+
+
+def main():
+    my_parser = argparse.ArgumentParser(description='Benchmarks for CityGen')
+    my_parser.add_argument('--sizes', help='target populations', type=int, nargs='+', default=default_sizes)
+    my_parser.add_argument('-i', help='input folder (relative to staticInst)', default=default_input)
+    my_parser.add_argument('--no_fixture', help='skip the data/test fixture case', action="store_true")
+    my_parser.add_argument('--baselines', help='baselines file', default=default_baselines)
+    my_parser.add_argument('--threshold', help='allowed relative slowdown / memory growth', type=float, default=0.25)
+    my_parser.add_argument('--update_baselines', help='store these results as the new baselines', action="store_true")
+    my_parser.add_argument('--results', help='also write the results as JSON to this file', default=None)
+    args = my_parser.parse_args()
+
+    results = OrderedDict()
+    with tempfile.TemporaryDirectory(prefix="benchCityGen-") as workdir:
+        if not args.no_fixture:
+            print("test-fixture ...", flush=True)
+            results["test-fixture"] = run_fixture(workdir)
+        for n in args.sizes:
+            case = f"{os.path.basename(os.path.normpath(args.i))}-{n}"
+            print(f"{case} ...", flush=True)
+            results[case] = run_citygen(n, args.i, workdir)
+
+    baselines = {}
+    if os.path.isfile(args.baselines):
+        with open(args.baselines, "r") as f:
+            baselines = json.load(f)
+    print_results(results, baselines)
+
+    if args.results is not None:
+        with open(args.results, "w+") as f:
+            json.dump(results, f, indent=1)
+
+    if args.update_baselines:
+        baselines.update(results)
+        os.makedirs(os.path.dirname(os.path.abspath(args.baselines)), exist_ok=True)
+        with open(args.baselines, "w+") as f:
+            json.dump(baselines, f, indent=1)
+        print(f"\nBaselines written to {args.baselines}")
+        return
+
+    regressions, missing = compare(results, baselines, args.threshold)
+    if regressions:
+        print(f"\nRegressions (threshold {args.threshold:.0%}):")
+        for case, metric, base, value in regressions:
+            print(f"  {case} {metric}: {base:.3f} -> {value:.3f}")
+    if missing:
+        print(f"\nNo baseline in {args.baselines} for: {', '.join(missing)}")
+        print("Record them on this machine with --update_baselines.")
+    if regressions or missing:
+        sys.exit(1)
+    print("\nNo regressions.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Import-time guard for the city generator.
+#
+# Each module is imported in a fresh interpreter with `python -X importtime`
+# (best of --repeats), and the check fails if the cumulative import time
+# goes over its budget or if a heavy dependency that should only be loaded
+# on demand (geopandas/shapely when city.geojson is parsed, matplotlib with
+# --validate) shows up in sys.modules.
+#
+# Usage: python benchImportTime.py [--budget-ms CityGen=1500] [--repeats 5]
+
+import argparse
+import os
+import subprocess
+import sys
+
+staticInst_dir = os.path.dirname(os.path.abspath(__file__))
+
+default_budgets_ms = {
+    "citySampling": 400,
+    "CityGen": 1500,
+    }
+
+lazy_modules = ["geopandas", "shapely", "matplotlib", "fiona", "pyogrio"]
+
+check_snippet = (
+    "import sys, importlib; importlib.import_module(sys.argv[1]); "
+    "print(','.join(m for m in sys.argv[2:] if m in sys.modules))"
+    )
+
+
+def import_time_ms(module):
+    # Cumulative import time (in ms) of `module`, as reported by -X importtime.
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=staticInst_dir, capture_output=True, text=True)
+    assert proc.returncode == 0, f"import {module} failed:\n{proc.stderr}"
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = [f.strip() for f in line[len("import time:"):].split("|")]
+        if len(fields) == 3 and fields[2] == module:
+            return int(fields[1]) / 1000
+    raise RuntimeError(f"no importtime entry for {module}")
+
+
+def eagerly_loaded(module):
+    proc = subprocess.run(
+        [sys.executable, "-c", check_snippet, module] + lazy_modules,
+        cwd=staticInst_dir, capture_output=True, text=True)
+    assert proc.returncode == 0, f"import {module} failed:\n{proc.stderr}"
+    return [m for m in proc.stdout.strip().split(",") if m]
+
+
+def main():
+    my_parser = argparse.ArgumentParser(description='Import-time benchmark for CityGen')
+    my_parser.add_argument('--budget-ms', action='append', default=[], metavar='MODULE=MS',
+                           help='override the import budget of a module (repeatable)')
+    my_parser.add_argument('--repeats', type=int, default=5, help='imports per module, best time is kept')
+    args = my_parser.parse_args()
+
+    budgets = dict(default_budgets_ms)
+    for item in args.budget_ms:
+        module, ms = item.split("=")
+        budgets[module] = float(ms)
+
+    failed = False
+    for module, budget in budgets.items():
+        best = min(import_time_ms(module) for _ in range(args.repeats))
+        loaded = eagerly_loaded(module)
+        ok = best <= budget and not loaded
+        failed = failed or not ok
+        print(f"{module.ljust(20)} {best:8.1f} ms (budget {budget:.0f} ms)"
+              + (f"  eagerly imports: {', '.join(loaded)}" if loaded else "")
+              + ("" if ok else "  FAILED"))
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Incremental reader for the city files written by CityGen.py
+# (individuals.json, workplaces.json, schools.json, houses.json).
+#
+# json.load of a multi-million person individuals.json followed by
+# pd.DataFrame(data) needs several times the file size in memory. The
+# functions here parse the top-level JSON array one record at a time, keep
+# only the requested fields in typed numpy buffers, and hand them out in
+# fixed-size chunks so that aggregations can be done in a single pass.
+
+import json
+import math
+from collections import Counter
+
+import numpy as np
+
+# Fields (and dtypes) used by the validation plots. Missing values are
+# stored as NaN in float columns and as -1 in integer columns.
+individual_fields = {
+    "id": np.int64,
+    "household": np.int64,
+    "age": np.int64,
+    "lat": np.float64,
+    "lon": np.float64,
+    "workplaceType": np.int64,
+    "school": np.int64,
+    "workplace": np.int64,
+    }
+
+workplace_fields = {
+    "id": np.int64,
+    "lat": np.float64,
+    "lon": np.float64,
+    }
+
+school_fields = {
+    "ID": np.int64,
+    "lat": np.float64,
+    "lon": np.float64,
+    }
+
+_whitespace = " \t\n\r"
+
+
+def missing_value(dtype):
+    return np.nan if np.issubdtype(np.dtype(dtype), np.floating) else -1
+
+
+def iter_records(path, chunk_bytes=1 << 22):
+    # Yields the elements of the top-level JSON array in `path`, reading at
+    # most `chunk_bytes` characters at a time.
+    decoder = json.JSONDecoder()
+    with open(path, "r") as f:
+        buf = ""
+        pos = 0
+        eof = False
+        started = False
+        while True:
+            if not eof and len(buf) - pos < chunk_bytes:
+                data = f.read(chunk_bytes)
+                eof = (data == "")
+                buf = buf[pos:] + data
+                pos = 0
+
+            while pos < len(buf) and buf[pos] in _whitespace:
+                pos += 1
+            if pos == len(buf):
+                if eof:
+                    raise ValueError(f"{path}: unexpected end of file")
+                continue
+
+            if not started:
+                if buf[pos] != "[":
+                    raise ValueError(f"{path}: expected a JSON array")
+                started = True
+                pos += 1
+                continue
+
+            if buf[pos] == ",":
+                pos += 1
+                continue
+            if buf[pos] == "]":
+                return
+
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                # The record straddles the chunk boundary; read more.
+                data = f.read(chunk_bytes)
+                eof = (data == "")
+                buf = buf[pos:] + data
+                pos = 0
+                continue
+            pos = end
+            yield obj
+
+
+def iter_column_chunks(path, fields, chunk_size=100000, chunk_bytes=1 << 22):
+    # Yields dicts {field: np.ndarray} of at most `chunk_size` records each,
+    # holding only the requested `fields` (a dict of field name -> dtype).
+    names = list(fields.keys())
+    fills = {name: missing_value(fields[name]) for name in names}
+
+    def new_buffers():
+        return {name: np.empty(chunk_size, dtype=fields[name]) for name in names}
+
+    buffers = new_buffers()
+    n = 0
+    for record in iter_records(path, chunk_bytes=chunk_bytes):
+        for name in names:
+            value = record.get(name)
+            buffers[name][n] = fills[name] if value is None else value
+        n += 1
+        if n == chunk_size:
+            yield buffers
+            buffers = new_buffers()
+            n = 0
+    if n > 0:
+        yield {name: buffers[name][:n] for name in names}
+
+
+def read_columns(path, fields, chunk_size=100000):
+    chunks = list(iter_column_chunks(path, fields, chunk_size=chunk_size))
+    if len(chunks) == 0:
+        return {name: np.empty(0, dtype=fields[name]) for name in fields}
+    return {name: np.concatenate([c[name] for c in chunks]) for name in fields}
+
+
+class GroupSizeCounter:
+    # Number of members per integer group id (household, school,
+    # workplace), accumulated chunk by chunk. Group ids are dense so a
+    # growing bincount is both smaller and faster than a Counter.
+
+    def __init__(self):
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def update(self, ids):
+        ids = ids[ids >= 0]
+        if ids.size == 0:
+            return
+        chunk_counts = np.bincount(ids)
+        if chunk_counts.size > self.counts.size:
+            self.counts = np.concatenate(
+                (self.counts, np.zeros(chunk_counts.size - self.counts.size, dtype=np.int64)))
+        self.counts[:chunk_counts.size] += chunk_counts
+
+    def sizes(self):
+        return self.counts[self.counts > 0]
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    # Vectorised version of CityGen.distance, in km.
+    radius = 6371
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return radius * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def summarise_individuals(individuals_path, workplaces_path=None,
+                          max_commute_distance=None, chunk_size=100000):
+    # Single streaming pass over individuals.json computing everything the
+    # validation plots need:
+    #   age_counts       Counter age -> number of people
+    #   household_sizes  array of household sizes
+    #   school_sizes     array of school sizes
+    #   workplace_sizes  array of workplace sizes
+    #   commute_counts   (if workplaces_path) people per integer km of
+    #                    home-workplace distance, in [0, max_commute_distance)
+    fields = dict(individual_fields)
+    age_counts = Counter()
+    households = GroupSizeCounter()
+    schools = GroupSizeCounter()
+    workplaces = GroupSizeCounter()
+    num_individuals = 0
+
+    wp_lat = wp_lon = None
+    commute_counts = None
+    if workplaces_path is not None:
+        wp = read_columns(workplaces_path, workplace_fields)
+        wp_min_id = int(wp["id"].min()) if wp["id"].size else 0
+        wp_lat = np.full(int(wp["id"].max()) - wp_min_id + 1 if wp["id"].size else 0, np.nan)
+        wp_lon = wp_lat.copy()
+        wp_lat[wp["id"] - wp_min_id] = wp["lat"]
+        wp_lon[wp["id"] - wp_min_id] = wp["lon"]
+        assert max_commute_distance is not None
+        commute_counts = np.zeros(int(math.ceil(max_commute_distance)), dtype=np.int64)
+
+    for chunk in iter_column_chunks(individuals_path, fields, chunk_size=chunk_size):
+        num_individuals += chunk["id"].size
+        ages, counts = np.unique(chunk["age"], return_counts=True)
+        age_counts.update(dict(zip(ages.tolist(), counts.tolist())))
+        households.update(chunk["household"])
+        schools.update(chunk["school"])
+        workplaces.update(chunk["workplace"])
+
+        if commute_counts is not None:
+            working = (chunk["workplaceType"] == 1) & (chunk["workplace"] >= 0)
+            idx = chunk["workplace"][working] - wp_min_id
+            d = np.floor(haversine(chunk["lat"][working], chunk["lon"][working],
+                                   wp_lat[idx], wp_lon[idx])).astype(np.int64)
+            d = d[d < commute_counts.size]
+            commute_counts += np.bincount(d, minlength=commute_counts.size)
+
+    summary = {
+        "num_individuals": num_individuals,
+        "age_counts": age_counts,
+        "household_sizes": households.sizes(),
+        "school_sizes": schools.sizes(),
+        "workplace_sizes": workplaces.sizes(),
+        }
+    if commute_counts is not None:
+        summary["commute_counts"] = commute_counts
+    return summary
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# City bounding box and neighbourhood cells, written next to the other city
+# files as cityMetadata.json.
+#
+# drive_simulator needs --CITY_SW_LAT/LON, --CITY_NE_LAT/LON and
+# --NBR_CELL_SIZE when --ENABLE_NBR_CELLS is on. The launchers read them from
+# this file instead of keeping per-city constants, and the simulator takes the
+# per-house cell indices from it instead of recomputing them (as long as the
+# bounding box and cell size it was started with match the file).
+
+import json
+import math
+import os
+
+import numpy as np
+
+metadata_file = "cityMetadata.json"
+
+# Same as DEFAULTS.NBR_CELL_SIZE in cpp-simulator/defaults.h (in km)
+default_nbr_cell_size = 0.178
+
+# The bounding box is padded by this much (in degrees, ~1cm) so that the
+# houses on its north/east edges fall strictly inside the last cell.
+bbox_padding = 1e-7
+
+EARTH_RADIUS = 6371.0 # km
+
+
+def earth_distance(lat1, lon1, lat2, lon2):
+    # Vectorised port of earth_distance in cpp-simulator/models.cc, kept
+    # formula-for-formula identical so that the cell indices match.
+    degree = math.atan2(1.0, 0.0) / 90.0
+    delta_lon = degree * (np.asarray(lon1) - np.asarray(lon2))
+    delta_lat = degree * (np.asarray(lat1) - np.asarray(lat2))
+    angle = 2 * np.arcsin(np.sqrt(np.sin(delta_lat / 2) ** 2
+                                  + np.cos(degree * np.asarray(lat1))
+                                  * np.cos(degree * np.asarray(lat2))
+                                  * np.sin(delta_lon / 2) ** 2))
+    return angle * EARTH_RADIUS
+
+
+def city_bounding_box(lats, lons):
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    assert lats.size > 0, "no houses to compute the city bounding box from"
+    return {
+        "CITY_SW_LAT": float(lats.min() - bbox_padding),
+        "CITY_SW_LON": float(lons.min() - bbox_padding),
+        "CITY_NE_LAT": float(lats.max() + bbox_padding),
+        "CITY_NE_LON": float(lons.max() + bbox_padding),
+        }
+
+
+def nbr_cell_indices(lats, lons, bbox, nbr_cell_size):
+    # Same as house::set_nbr_cell and init_nbr_cells in the simulator:
+    # x runs east along the southern edge, y runs north along the western edge.
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    sw_lat, sw_lon = bbox["CITY_SW_LAT"], bbox["CITY_SW_LON"]
+
+    cell_x = np.floor(earth_distance(sw_lat, lons, sw_lat, sw_lon) / nbr_cell_size).astype(np.int64)
+    cell_y = np.floor(earth_distance(lats, sw_lon, sw_lat, sw_lon) / nbr_cell_size).astype(np.int64)
+
+    num_x = int(math.ceil(earth_distance(sw_lat, bbox["CITY_NE_LON"], sw_lat, sw_lon) / nbr_cell_size))
+    num_y = int(math.ceil(earth_distance(bbox["CITY_NE_LAT"], sw_lon, sw_lat, sw_lon) / nbr_cell_size))
+    assert cell_x.size == 0 or (cell_x.min() >= 0 and cell_x.max() < num_x)
+    assert cell_y.size == 0 or (cell_y.min() >= 0 and cell_y.max() < num_y)
+    return cell_x, cell_y, num_x, num_y
+
+
+def compute_city_metadata(houses, nbr_cell_size=default_nbr_cell_size):
+    # houses: list of dicts with "lat" and "lon", in house id order.
+    assert nbr_cell_size > 0, "NBR_CELL_SIZE must be positive"
+    lats = np.fromiter((h["lat"] for h in houses), dtype=float, count=len(houses))
+    lons = np.fromiter((h["lon"] for h in houses), dtype=float, count=len(houses))
+
+    bbox = city_bounding_box(lats, lons)
+    cell_x, cell_y, num_x, num_y = nbr_cell_indices(lats, lons, bbox, nbr_cell_size)
+
+    metadata = dict(bbox)
+    metadata["NBR_CELL_SIZE"] = float(nbr_cell_size)
+    metadata["num_houses"] = len(houses)
+    metadata["num_nbr_cells_x"] = num_x
+    metadata["num_nbr_cells_y"] = num_y
+    metadata["house_nbr_cell_x"] = cell_x.tolist()
+    metadata["house_nbr_cell_y"] = cell_y.tolist()
+    return metadata
+
+
+def read_city_metadata(city_dir):
+    # Returns the metadata dict, or None for cities generated before
+    # cityMetadata.json existed.
+    path = os.path.join(city_dir, metadata_file)
+    if not os.path.isfile(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Sampling helpers used by CityGen.py. This module only depends on numpy and
+# the standard library so that it can be imported (e.g. by job-array drivers
+# or the benchmark scripts) without pulling in pandas, the geospatial stack
+# or matplotlib.
+
+import math
+
+import numpy as np
+
+
+def normalise(raw):
+    # Scale everything so that the array sums to 1
+    # It doesn't quite, due to floating point errors, but
+    # np.random.choice does not complain anymore.
+    s = sum([float(i) for i in raw]); return [float(i)/s for i in raw]
+
+def sampleBinsWeights(bins,weights):
+    assert len(bins) == len(weights)
+
+    s = str(np.random.choice(bins,1,p=weights)[0])
+    if '+' in s:
+        return int(s[:-1])+1
+        #This is the last bucket, something like x+. Choosing (x+1) by default.
+    elif '-' in s:
+        (a,b) = s.split('-')
+        return np.random.randint(int(a),int(b)+1) #np.random.randint chooses from halfopen interval
+    else:
+        return int(s)
+
+def distance(lat1, lon1, lat2, lon2):
+    radius = 6371 # km
+
+    dlat = math.radians(lat2-lat1)
+    dlon = math.radians(lon2-lon1)
+    a = (math.sin(dlat/2) * math.sin(dlat/2) + math.cos(math.radians(lat1))
+         * math.cos(math.radians(lat2)) * math.sin(dlon/2) * math.sin(dlon/2))
+    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
+    d = radius * c
+
+    return d
+
+def workplaces_size_distribution(a=3.26, c=0.97, m_max=2870):
+    # This is a particular version of the power law:
+    # Pr[ m > x ] is proportional to x^{-c}.
+    # This is additionally slightly adjusted in this implementation
+    # so that the max workplace size = m_max, and the size is always
+    # at least 1.
+    # RP: There is also a scaling by a parameter 'a', which I don't
+    # follow why, but leaving the implementation as earlier.
+    # RP: should add a reference for why these a,c,m_max were chosen.
+
+    mirror_cdf = np.zeros(m_max, dtype=float)   # mirror_cdf[i] = Pr[ size > i]
+    for m in range(m_max):
+        mirror_cdf[m] =(  (((1 + (m_max/a))/((1 + (m/a)))**c) - 1) /
+                        (((1 + (m_max/a))**c)-1))
+
+    p_n = np.insert((np.diff(mirror_cdf) * (-1)), 0, 0)
+    # np.diff computes a[i+1] - a[i]. We want a[i] - a[i+1]
+    assert len(p_n)==m_max
+    return p_n / sum(p_n)
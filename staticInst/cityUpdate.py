@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Incremental regeneration of a city written by CityGen.py.
+#
+# Given an existing output folder and updated input files, only the changed
+# wards are regenerated: their houses, people and (ward-local) schools are
+# drawn again with the usual CityGen sampling, and their workplaces are
+# rebuilt. Outside those wards:
+#   - people, houses, schools and workplaces keep their IDs,
+#   - workers whose workplace was in a changed ward keep their workplace
+#     ward but have their workplace re-drawn among the rebuilt ones,
+#   - jobs left vacant in unchanged wards by removed workers are offered
+#     first to new workers commuting into that ward.
+#
+# IDs are positions in the output files (as drive_simulator expects), so
+# new records reuse the IDs that were freed. If a ward shrank, the records
+# with the highest IDs are moved into the remaining gaps; every such move
+# is listed in cityUpdate.json. Workplace IDs are num_schools + index in
+# workplaces.json, so they shift if the number of schools changes; the
+# index itself is stable.
+#
+# Usage:
+#   python cityUpdate.py -c data/hillsborough-1M/ -i data/base/hillsborough_fl/ \
+#       --previous_input data/base/hillsborough_fl-2020/
+
+import argparse
+import json
+import os
+import pickle
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from CityGen import City, inputfiles, outputfiles, measure, fileExists, folderExists
+from citySampling import distance
+from cityMetadata import compute_city_metadata
+from membershipIndex import MembershipIndex
+
+update_report_file = "cityUpdate.json"
+
+
+def read_outputs(city_dir):
+    tables = {}
+    for name in ["individuals", "houses", "schools", "workplaces",
+                 "commonArea", "fractionPopulation", "wardCentreDistance"]:
+        path = Path(city_dir, outputfiles[name])
+        assert fileExists(path), f"{path} missing"
+        with open(path, "r") as f:
+            tables[name] = json.load(f)
+    return tables
+
+
+def changed_wards(previous_input_dir, input_dir):
+    # wardNos whose rows differ between the two input folders in
+    # demographics.csv, employment.csv or ODMatrix.csv (origin ward).
+    changed = set()
+    for key in ["demographics", "employment", "ODMatrix"]:
+        old_path = Path(previous_input_dir, inputfiles[key])
+        new_path = Path(input_dir, inputfiles[key])
+        if not fileExists(old_path) and not fileExists(new_path):
+            continue
+        assert fileExists(old_path) and fileExists(new_path), f"{inputfiles[key]} added or removed, regenerate the city"
+        old = pd.read_csv(old_path).set_index("wardNo").sort_index()
+        new = pd.read_csv(new_path).set_index("wardNo").sort_index()
+        assert list(old.index) == list(new.index), f"{inputfiles[key]}: wards differ, regenerate the city"
+        assert list(old.columns) == list(new.columns), f"{inputfiles[key]}: columns differ"
+        differs = (old != new) & ~(old.isna() & new.isna())
+        changed.update(int(w) for w in old.index[differs.any(axis=1)])
+    return sorted(changed)
+
+
+def allocate_ids(num_old, removed, num_new):
+    # IDs are positions, so the result has to be 0..total-1 without gaps.
+    # Kept records keep their ID unless it is >= total (the city shrank),
+    # in which case they move into a freed slot. New records take the
+    # remaining freed slots, then the IDs after num_old.
+    # Returns ({old ID: new ID} for moved records, array of IDs for the new).
+    removed = np.unique(np.asarray(removed, dtype=np.int64))
+    total = num_old - removed.size + num_new
+    kept = np.setdiff1d(np.arange(num_old), removed)
+    moved = kept[kept >= total]
+    available = np.concatenate((removed[removed < total], np.arange(num_old, total)))
+    assert available.size == moved.size + num_new
+    moved_map = dict(zip(moved.tolist(), available[:moved.size].tolist()))
+    return moved_map, available[moved.size:]
+
+
+def place(records, total, id_key):
+    out = [None] * total
+    for r in records:
+        out[r[id_key]] = r
+    assert all(r is not None for r in out), "ID allocation left a gap"
+    return out
+
+
+@measure
+def update_city(city, old, wardIndices, n=None):
+    # city: City built from the updated input folder
+    # old: read_outputs() of the existing city
+    # wardIndices: 0-based indices of the wards to regenerate
+    assert city.workplace_assignment == "ward", "incremental updates only support the ward workplace assignment"
+    assert len(old["fractionPopulation"]) == city.nwards, "number of wards changed, regenerate the city"
+    changed = np.zeros(city.nwards, dtype=bool)
+    changed[list(wardIndices)] = True
+    wardIndices = np.flatnonzero(changed).tolist()
+
+    old_houses = old["houses"]
+    old_individuals = old["individuals"]
+    old_schools = old["schools"]
+    old_workplaces = old["workplaces"]
+    num_old_schools = len(old_schools)
+    for i, r in enumerate(old_houses): assert r["id"] == i
+    for i, r in enumerate(old_individuals): assert r["id"] == i
+    for i, r in enumerate(old_schools): assert r["ID"] == i
+    for i, r in enumerate(old_workplaces): assert r["id"] == num_old_schools + i
+
+    # Same scale as the original run, estimated from the unchanged wards
+    # unless the target population is given.
+    if n is None:
+        assert not changed.all(), "all wards changed, pass the target population with -n"
+        old_pop = np.zeros(city.nwards)
+        for w in old["fractionPopulation"]:
+            old_pop[w["wardNo"] - 1] = w["totalPopulation"]
+        input_pop = city.wardData["totalPopulation"].values
+        n = city.totalPop * old_pop[~changed].sum() / input_pop[~changed].sum()
+    city.rescale(n)
+
+    # Community centres of the unchanged wards stay where they were.
+    # dump_files writes a centre (lat, lon) as c["lat"]=lon, c["lon"]=lat.
+    for c in old["commonArea"]:
+        if not changed[c["wardNo"] - 1]:
+            city.community_centres[c["wardNo"] - 1] = (c["lon"], c["lat"])
+
+    removed_houses = [h["id"] for h in old_houses if changed[h["wardIndex"]]]
+    removed_people = [p["id"] for p in old_individuals if changed[p["wardIndex"]]]
+    removed_schools = [s["ID"] for s in old_schools if changed[s["wardIndex"]]]
+    removed_workplaces = [w["id"] - num_old_schools for w in old_workplaces if changed[w["wardIndex"]]]
+    rebuilt_workplace = np.zeros(len(old_workplaces), dtype=bool)
+    rebuilt_workplace[removed_workplaces] = True
+
+    # Jobs in unchanged wards freed by people who are being regenerated
+    vacancies = [[] for _ in range(city.nwards)]
+    for p in old_individuals:
+        if changed[p["wardIndex"]] and p.get("workplace") is not None:
+            idx = p["workplace"] - num_old_schools
+            if not rebuilt_workplace[idx]:
+                vacancies[old_workplaces[idx]["wardIndex"]].append(idx)
+
+    city.createHouses(wardIndices)
+    city.populateHouses()
+    city.assignSchools()
+    num_new_people = len(city.individuals)
+
+    filled = {}
+    for wardIndex in range(city.nwards):
+        if changed[wardIndex] or len(vacancies[wardIndex]) == 0:
+            continue
+        slots = np.random.permutation(vacancies[wardIndex])
+        k = min(len(slots), len(city.workers[wardIndex]))
+        for pid, idx in zip(city.workers[wardIndex][:k], slots[:k].tolist()):
+            filled[pid] = idx
+            del city.individuals[pid]["workplaceward"]
+        city.workers[wardIndex] = city.workers[wardIndex][k:]
+
+    # Workers from unchanged wards whose workplace is being rebuilt
+    redrawn = {}
+    for p in old_individuals:
+        if (not changed[p["wardIndex"]] and p.get("workplace") is not None
+                and rebuilt_workplace[p["workplace"] - num_old_schools]):
+            q = dict(p)
+            q["workplaceward"] = old_workplaces[p["workplace"] - num_old_schools]["wardIndex"]
+            del q["workplace"]
+            pid = len(city.individuals)
+            city.individuals.append(q)
+            city.workers[q["workplaceward"]].append(pid)
+            redrawn[p["id"]] = pid
+    city.assignWorkplaces()
+
+    house_moved, house_new = allocate_ids(len(old_houses), removed_houses, len(city.houses))
+    people_moved, people_new = allocate_ids(len(old_individuals), removed_people, num_new_people)
+    school_moved, school_new = allocate_ids(num_old_schools, removed_schools, len(city.schools))
+    wp_moved, wp_new = allocate_ids(len(old_workplaces), removed_workplaces, len(city.workplaces))
+    num_schools = num_old_schools - len(removed_schools) + len(city.schools)
+    num_workplaces = len(old_workplaces) - len(removed_workplaces) + len(city.workplaces)
+
+    houses = []
+    for h in old_houses:
+        if not changed[h["wardIndex"]]:
+            h = dict(h)
+            h["id"] = house_moved.get(h["id"], h["id"])
+            houses.append(h)
+    for k, h in enumerate(city.houses):
+        h = dict(h)
+        h["id"] = int(house_new[k])
+        houses.append(h)
+
+    schools = []
+    for s in old_schools:
+        if not changed[s["wardIndex"]]:
+            s = dict(s)
+            s["ID"] = school_moved.get(s["ID"], s["ID"])
+            schools.append(s)
+    for k, s in enumerate(city.schools):
+        s = dict(s)
+        s["ID"] = int(school_new[k])
+        schools.append(s)
+
+    def old_workplace_id(idx):
+        return num_schools + wp_moved.get(idx, idx)
+
+    def new_workplace_id(wid):
+        return num_schools + int(wp_new[wid - city.num_schools])
+
+    workplaces = []
+    for idx, w in enumerate(old_workplaces):
+        if not rebuilt_workplace[idx]:
+            w = dict(w)
+            w["id"] = old_workplace_id(idx)
+            workplaces.append(w)
+    for w in city.workplaces:
+        w = dict(w)
+        w["id"] = new_workplace_id(w["id"])
+        workplaces.append(w)
+
+    individuals = []
+    for p in old_individuals:
+        if changed[p["wardIndex"]]:
+            continue
+        p = dict(p)
+        p["household"] = house_moved.get(p["household"], p["household"])
+        if p.get("school") is not None:
+            p["school"] = school_moved.get(p["school"], p["school"])
+        if p["id"] in redrawn:
+            p["workplace"] = new_workplace_id(city.individuals[redrawn[p["id"]]]["workplace"])
+        elif p.get("workplace") is not None:
+            p["workplace"] = old_workplace_id(p["workplace"] - num_old_schools)
+        p["id"] = people_moved.get(p["id"], p["id"])
+        individuals.append(p)
+    for pid in range(num_new_people):
+        p = dict(city.individuals[pid])
+        p["id"] = int(people_new[pid])
+        p["household"] = int(house_new[p["household"]])
+        if p.get("school") is not None:
+            p["school"] = int(school_new[p["school"]])
+        if pid in filled:
+            p["workplace"] = old_workplace_id(filled[pid])
+        elif p.get("workplace") is not None:
+            p["workplace"] = new_workplace_id(p["workplace"])
+        individuals.append(p)
+
+    houses = place(houses, len(houses), "id")
+    individuals = place(individuals, len(individuals), "id")
+    schools = place(schools, len(schools), "ID")
+    workplaces = place([dict(w, id=w["id"] - num_schools) for w in workplaces], num_workplaces, "id")
+    for i, w in enumerate(workplaces):
+        w["id"] = num_schools + i
+
+    commonAreas = [dict(c) for c in old["commonArea"]]
+    for c in commonAreas:
+        i = c["wardNo"] - 1
+        if changed[i]:
+            (lon,lat) = city.community_centres[i]
+            c["lat"] = lat
+            c["lon"] = lon
+    commonAreas.sort(key=lambda c: c["ID"])
+
+    wardCentreDistances = [dict(d) for d in old["wardCentreDistance"]]
+    wardCentreDistances.sort(key=lambda d: d["ID"])
+    for i in wardIndices:
+        for j in range(city.nwards):
+            d = distance(commonAreas[i]["lat"], commonAreas[i]["lon"],
+                         commonAreas[j]["lat"], commonAreas[j]["lon"])
+            wardCentreDistances[i][str(j+1)] = d
+            wardCentreDistances[j][str(i+1)] = d
+
+    ward_population = np.bincount([p["wardIndex"] for p in individuals], minlength=city.nwards)
+    fractionPopulations = []
+    for i in range(city.nwards):
+        w = {"wardNo":i+1}
+        w["totalPopulation"] = int(ward_population[i])
+        w["fracPopulation"] = float(ward_population[i] / len(individuals))
+        fractionPopulations.append(w)
+
+    tables = {
+        "individuals": individuals,
+        "houses": houses,
+        "workplaces": workplaces,
+        "schools": schools,
+        "wardCentreDistance": wardCentreDistances,
+        "commonArea": commonAreas,
+        "fractionPopulation": fractionPopulations,
+        }
+    report = {
+        "changedWards": [i+1 for i in wardIndices],
+        "population": len(individuals),
+        "regenerated": {
+            "houses": len(city.houses),
+            "individuals": num_new_people,
+            "schools": len(city.schools),
+            "workplaces": len(city.workplaces),
+            "redrawnWorkers": len(redrawn),
+            "vacanciesFilled": len(filled),
+            },
+        # old ID -> new ID of records that were not regenerated but had to move
+        "movedIDs": {
+            "houses": {str(k): v for k, v in house_moved.items()},
+            "individuals": {str(k): v for k, v in people_moved.items()},
+            "schools": {str(k): v for k, v in school_moved.items()},
+            "workplaces": {str(num_old_schools + k): num_schools + v for k, v in wp_moved.items()},
+            },
+        "workplaceIdOffset": num_schools - num_old_schools,
+        }
+    return tables, report
+
+
+@measure
+def dump_update(city, tables, report, output_dir):
+    Path(output_dir).mkdir(parents = True, exist_ok = True)
+    for name, records in tables.items():
+        with open(os.path.join(output_dir,outputfiles[name]), "w+") as f:
+            f.write(json.dumps(records))
+    with open(os.path.join(output_dir,outputfiles['PRG_np_random_state']), "wb+") as f:
+        pickle.dump(city.state_np_random,f)
+    with open(os.path.join(output_dir,outputfiles['cityMetadata']), "w+") as f:
+        f.write(json.dumps(compute_city_metadata(tables["houses"], city.nbr_cell_size)))
+    MembershipIndex.from_records(tables["individuals"], tables["houses"], len(tables["schools"]),
+                                 len(tables["workplaces"]), city.nwards).save(output_dir)
+    with open(os.path.join(output_dir,update_report_file), "w+") as f:
+        f.write(json.dumps(report, indent=1))
+
+
+def main():
+    my_parser = argparse.ArgumentParser(description='Regenerate the changed wards of an existing city')
+    my_parser.add_argument('-c', help='existing city (output folder of CityGen.py)', required=True)
+    my_parser.add_argument('-i', help='updated input folder', required=True)
+    my_parser.add_argument('-o', help='output folder (default: update the city folder in place)', default=None)
+    my_parser.add_argument('-w', help='wardNos to regenerate', type=int, nargs='+', default=None)
+    my_parser.add_argument('--previous_input', help='input folder the city was generated from; wards whose rows differ are regenerated', default=None)
+    my_parser.add_argument('-n', help='target population (default: keep the scale of the unchanged wards)', type=int, default=None)
+    my_parser.add_argument('-s', help='[for debug] restore random seed from folder', default=None)
+    args = my_parser.parse_args()
+
+    assert folderExists(args.c), f"{args.c} not found"
+    if args.w is not None:
+        wards = sorted(set(args.w))
+    elif args.previous_input is not None:
+        wards = changed_wards(args.previous_input, args.i)
+    else:
+        my_parser.print_help()
+        sys.exit("Pass the wards to regenerate with -w, or --previous_input to detect them.")
+    output_dir = args.o if args.o is not None else args.c
+
+    print(f"city_folder: {args.c}")
+    print(f"input_folder: {args.i}")
+    print(f"output_folder: {output_dir}")
+    print(f"changed wards: {wards}")
+    print("")
+    if len(wards) == 0:
+        print("Nothing to regenerate.")
+        return
+
+    old = read_outputs(args.c)
+    city = City(args.i, random_seed_dir = args.s)
+    assert all(1 <= w <= city.nwards for w in wards), "wardNo out of range"
+    tables, report = update_city(city, old, [w - 1 for w in wards], n = args.n)
+    dump_update(city, tables, report, output_dir)
+    print(json.dumps(report["regenerated"]))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Who-belongs-where index for a generated city, in compressed sparse row
+# (CSR) form, written by CityGen.py as membershipIndex.npz:
+#
+#   house_members      house ID            -> individual IDs
+#   school_members     school ID           -> individual IDs
+#   workplace_members  workplace index     -> individual IDs
+#   ward_houses        wardIndex           -> house IDs
+#
+# Each relation is stored as <name>_indptr (length num_groups + 1) and
+# <name>_indices; the members of group g are indices[indptr[g]:indptr[g+1]],
+# sorted by ID. Workplace indices are positions in workplaces.json, i.e.
+# workplace ID - number of schools.
+#
+# Example: people in households with at least one infected person
+#   index = MembershipIndex.load("data/bangalore-100K")
+#   infected_in_house = index.house_members.count(infected)
+#   exposed = infected_in_house[index.house_members.owners()] > 0
+
+import os
+
+import numpy as np
+
+index_file = "membershipIndex.npz"
+
+relations = ["house_members", "school_members", "workplace_members", "ward_houses"]
+
+
+class CSRIndex:
+
+    def __init__(self, indptr, indices):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        assert self.indptr[-1] == self.indices.size
+
+    @classmethod
+    def from_groups(cls, group_ids, num_groups):
+        # group_ids[i] is the group of item i, or -1 if it has none.
+        group_ids = np.asarray(group_ids, dtype=np.int64)
+        items = np.flatnonzero(group_ids >= 0)
+        groups = group_ids[items]
+        assert groups.size == 0 or groups.max() < num_groups
+        order = np.argsort(groups, kind="stable")
+        indptr = np.zeros(num_groups + 1, dtype=np.int64)
+        np.cumsum(np.bincount(groups, minlength=num_groups), out=indptr[1:])
+        return cls(indptr, items[order])
+
+    def __len__(self):
+        return self.indptr.size - 1
+
+    def __getitem__(self, group):
+        # Members of one group, as a view (no copy)
+        return self.indices[self.indptr[group]:self.indptr[group + 1]]
+
+    def sizes(self):
+        return np.diff(self.indptr)
+
+    def owners(self):
+        # Group of every entry of indices
+        return np.repeat(np.arange(len(self)), self.sizes())
+
+    def count(self, mask):
+        # Number of members of each group for which mask[member] is true
+        # (or the sum of a numeric per-member array).
+        values = np.asarray(mask)[self.indices]
+        return np.bincount(self.owners(), weights=values, minlength=len(self)).astype(
+            np.int64 if values.dtype == bool else float)
+
+
+class MembershipIndex:
+
+    def __init__(self, arrays):
+        for name in relations:
+            setattr(self, name, CSRIndex(arrays[f"{name}_indptr"], arrays[f"{name}_indices"]))
+
+    @classmethod
+    def from_records(cls, individuals, houses, num_schools, num_workplaces, nwards):
+        # individuals/houses as written by CityGen (lists of dicts)
+        household = np.fromiter((p["household"] for p in individuals), dtype=np.int64, count=len(individuals))
+        school = np.fromiter((-1 if p.get("school") is None else p["school"] for p in individuals),
+                             dtype=np.int64, count=len(individuals))
+        workplace = np.fromiter((-1 if p.get("workplace") is None else p["workplace"] - num_schools
+                                 for p in individuals), dtype=np.int64, count=len(individuals))
+        house_ward = np.fromiter((h["wardIndex"] for h in houses), dtype=np.int64, count=len(houses))
+        return cls.from_arrays(household, school, workplace, house_ward,
+                               len(houses), num_schools, num_workplaces, nwards)
+
+    @classmethod
+    def from_arrays(cls, household, school, workplace, house_ward,
+                    num_houses, num_schools, num_workplaces, nwards):
+        arrays = {}
+        for name, ids, n in [("house_members", household, num_houses),
+                             ("school_members", school, num_schools),
+                             ("workplace_members", workplace, num_workplaces),
+                             ("ward_houses", house_ward, nwards)]:
+            csr = CSRIndex.from_groups(ids, n)
+            arrays[f"{name}_indptr"] = csr.indptr
+            arrays[f"{name}_indices"] = csr.indices
+        return cls(arrays)
+
+    @classmethod
+    def from_city_files(cls, city_dir):
+        # For cities generated before membershipIndex.npz was written
+        import json
+        from cityFileReader import iter_records, read_columns
+        ind = read_columns(os.path.join(city_dir, "individuals.json"),
+                           {"household": np.int64, "school": np.int64, "workplace": np.int64})
+        houses = read_columns(os.path.join(city_dir, "houses.json"), {"wardIndex": np.int64})
+        with open(os.path.join(city_dir, "fractionPopulation.json"), "r") as f:
+            nwards = len(json.load(f))
+        num_schools = sum(1 for _ in iter_records(os.path.join(city_dir, "schools.json")))
+        num_workplaces = sum(1 for _ in iter_records(os.path.join(city_dir, "workplaces.json")))
+        workplace = np.where(ind["workplace"] >= 0, ind["workplace"] - num_schools, -1)
+        return cls.from_arrays(ind["household"], ind["school"], workplace, houses["wardIndex"],
+                               houses["wardIndex"].size, num_schools, num_workplaces, nwards)
+
+    @classmethod
+    def load(cls, city_dir):
+        path = os.path.join(city_dir, index_file)
+        if not os.path.isfile(path):
+            return cls.from_city_files(city_dir)
+        with np.load(path) as arrays:
+            return cls({k: arrays[k] for k in arrays.files})
+
+    def arrays(self):
+        out = {}
+        for name in relations:
+            csr = getattr(self, name)
+            out[f"{name}_indptr"] = csr.indptr
+            out[f"{name}_indices"] = csr.indices
+        return out
+
+    def save(self, city_dir):
+        np.savez(os.path.join(city_dir, index_file), **self.arrays())
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Per-stage instrumentation for CityGen.py (used by its `measure` decorator).
+#
+# For every stage we record wall and CPU time, the peak RSS before/after
+# (the delta is how much the stage raised the process high-water mark),
+# how many houses/individuals/schools/workplaces it produced and at what
+# rate, and optionally how many numpy.random variates it drew. Stages nest
+# (generate contains createHouses, ...), and every record keeps its parent.
+#
+# profiler.write_report(path) writes the records as JSON;
+# profiler.write_trace(path) writes Chrome trace-event JSON that can be
+# opened in chrome://tracing or https://ui.perfetto.dev.
+
+import json
+import os
+import platform
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+# numpy.random functions used by the city generator. count_rng_draws()
+# wraps them in place; CityGen calls them as np.random.<name>, so the
+# wrappers are picked up without touching the call sites.
+rng_functions = ["choice", "randint", "uniform", "binomial", "random", "rand",
+                 "randn", "normal", "permutation", "shuffle", "poisson",
+                 "exponential", "gamma", "multinomial"]
+
+
+def peak_rss_kb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak # bytes on macOS
+
+
+def num_variates(size, default=1):
+    if size is None:
+        return default
+    return int(np.prod(size))
+
+
+class StageProfiler:
+
+    def __init__(self):
+        self.records = []
+        self.stack = []
+        self.rng_draws = 0
+        self.counting_rng = False
+        self.started = datetime.now().isoformat(timespec="seconds")
+        self.origin = time.perf_counter()
+
+    def reset(self):
+        self.__init__()
+
+    def count_rng_draws(self):
+        # Wrap the numpy.random functions so that every stage also reports
+        # the number of variates it drew. Adds a little overhead per call,
+        # so it is opt-in.
+        if self.counting_rng:
+            return
+        self.counting_rng = True
+        for name in rng_functions:
+            func = getattr(np.random, name, None)
+            if func is not None:
+                setattr(np.random, name, self._counted(name, func))
+
+    def _counted(self, name, func):
+        profiler = self
+
+        def counted(*args, **kwargs):
+            result = func(*args, **kwargs)
+            if name in ("permutation", "shuffle"):
+                n = args[0] if args else kwargs.get("x")
+                profiler.rng_draws += n if isinstance(n, (int, np.integer)) else len(n)
+            elif name == "choice":
+                profiler.rng_draws += num_variates(kwargs.get("size", args[1] if len(args) > 1 else None))
+            else:
+                profiler.rng_draws += np.size(result) if result is not None else 1
+            return result
+        counted.__wrapped__ = func
+        return counted
+
+    @contextmanager
+    def stage(self, name, counter=None):
+        # counter: optional callable returning {item kind: count}; the stage
+        # is credited with the increase.
+        items_before = counter() if counter is not None else {}
+        record = {
+            "name": name,
+            "parent": self.stack[-1]["name"] if self.stack else None,
+            "depth": len(self.stack),
+            "start_s": time.perf_counter() - self.origin,
+            }
+        rss_before = peak_rss_kb()
+        cpu_before = time.process_time()
+        draws_before = self.rng_draws
+        wall_before = time.perf_counter()
+        self.stack.append(record)
+        try:
+            yield record
+        finally:
+            wall = time.perf_counter() - wall_before
+            self.stack.pop()
+            record["wall_s"] = wall
+            record["cpu_s"] = time.process_time() - cpu_before
+            rss_after = peak_rss_kb()
+            record["peak_rss_kb"] = rss_after
+            record["peak_rss_delta_kb"] = None if rss_after is None else rss_after - rss_before
+            if self.counting_rng:
+                record["rng_draws"] = self.rng_draws - draws_before
+            if counter is not None:
+                items_after = counter()
+                items = {k: items_after[k] - items_before.get(k, 0) for k in items_after}
+                record["items"] = items
+                record["items_per_s"] = {k: (v / wall if wall > 0 else None) for k, v in items.items() if v > 0}
+            self.records.append(record)
+
+    def summary(self):
+        top = [r for r in self.records if r["depth"] == 0]
+        return {
+            "wall_s": sum(r["wall_s"] for r in top),
+            "cpu_s": sum(r["cpu_s"] for r in top),
+            "peak_rss_kb": peak_rss_kb(),
+            "rng_draws": self.rng_draws if self.counting_rng else None,
+            }
+
+    def report(self, extra=None):
+        out = {
+            "started": self.started,
+            "argv": sys.argv,
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "host": platform.node(),
+            "pid": os.getpid(),
+            "stages": sorted(self.records, key=lambda r: r["start_s"]),
+            "total": self.summary(),
+            }
+        if extra is not None:
+            out.update(extra)
+        return out
+
+    def write_report(self, path, extra=None):
+        with open(path, "w+") as f:
+            json.dump(self.report(extra), f, indent=1)
+
+    def write_trace(self, path):
+        events = []
+        for r in sorted(self.records, key=lambda r: r["start_s"]):
+            args = {k: r[k] for k in ["cpu_s", "peak_rss_kb", "peak_rss_delta_kb", "rng_draws", "items"] if k in r}
+            events.append({
+                "name": r["name"],
+                "cat": "citygen",
+                "ph": "X",
+                "ts": r["start_s"] * 1e6,
+                "dur": r["wall_s"] * 1e6,
+                "pid": os.getpid(),
+                "tid": 0,
+                "args": args,
+                })
+        with open(path, "w+") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+profiler = StageProfiler()
@@ -7,12 +7,12 @@
 __name__ = "Script for validating city files"
 
 
-import pandas as pd
 import numpy as np
 import math
 import json
 import matplotlib.pyplot as plt
 import os
+from cityFileReader import summarise_individuals
 
 def compute_age_distribution(ageDistribution):
     age_values = np.arange(0,81,1)
@@ -109,18 +109,6 @@ def travel_distance_distribution(m_min,m_max,a,b):
     return temp/np.sum(temp)
 
 
-# Create dataframes for validation
-with open('data/bangalore/individuals.json', 'r') as f:
-  data = json.load(f)
-
-
-
-df1 = pd.DataFrame(data)
-
-wp = pd.read_json('data/bangalore/workplaces.json')
-sid = pd.read_json('data/bangalore/schools.json')['ID'].values[-1]
-
-
 print('\nGenerating validation plots for the instantitaion...\n')
 
 
@@ -135,6 +123,12 @@ m_max_commuter_distance = cityprofiledata['maxWorkplaceDistance']
 a_commuter_distance = 10.751
 b_commuter_distance = 5.384
 
+# Aggregate the instantiated city in a single streaming pass over
+# individuals.json instead of loading it into a DataFrame.
+summary = summarise_individuals('data/bangalore/individuals.json',
+                                'data/bangalore/workplaces.json',
+                                max_commute_distance=m_max_commuter_distance)
+
 # Get distributions to match
 age_values, age_distribution = compute_age_distribution(cityprofiledata['age']['weights'])
 household_sizes, household_distribution = compute_household_size_distribution(cityprofiledata['householdSize']['bins'], cityprofiledata['householdSize']['weights'])
@@ -142,7 +136,8 @@ schoolsize_values, schoolsize_distribution = extrapolate_school_size_distributio
 workplacesize_distribution = workplaces_size_distribution()
 
 print("Validating age distribution in instantiation...",end='',flush=True)
-plt.plot(df1['age'].value_counts(normalize=True).sort_index(ascending=True), 'r-o',label='Instantiation')
+ages = sorted(summary['age_counts'].keys())
+plt.plot(ages, np.array([summary['age_counts'][a] for a in ages])/summary['num_individuals'], 'r-o',label='Instantiation')
 plt.plot(age_distribution, 'b-',label='Data')
 plt.xlabel('Age')
 plt.ylabel('Density')
@@ -155,7 +150,7 @@ plt.close()
 print("done.",flush=True)
 
 print("Validating household-size in instantiation...",end='',flush=True)
-house = df1['household'].value_counts().values
+house = summary['household_sizes']
 unique_elements, counts_elements = np.unique(house, return_counts=True)
 counts_elements = counts_elements / np.sum(counts_elements)
 plt.plot(counts_elements, 'r-o', label='Instantiation')
@@ -172,8 +167,9 @@ print("done.",flush=True)
 
 print("Validating school-size in instantiation...",end='',flush=True)
 schoolsizeDistribution = cityprofiledata['schoolsSize']['weights']
-full_frame = np.floor(np.array([len(np.where(df1['school'] == i)[0]) for i in np.unique(df1['school'].values)[~np.isnan(np.unique(df1['school'].values))]])/100).astype(int)
-schoolsize_output = [len(np.where(full_frame == j)[0]) for j in np.arange(0,len(schoolsizeDistribution))] / np.sum([len(np.where(full_frame == j)[0]) for j in np.arange(0,len(schoolsizeDistribution))])
+full_frame = np.floor(summary['school_sizes']/100).astype(int)
+full_frame = full_frame[full_frame < len(schoolsizeDistribution)]
+schoolsize_output = np.bincount(full_frame, minlength=len(schoolsizeDistribution)) / full_frame.size
 plt.plot(schoolsize_output,'r-o', label='Instantiation')
 plt.plot(schoolsizeDistribution,'b-', label='Data')
 xlabel = np.arange(0,len(schoolsizeDistribution))
@@ -208,8 +204,9 @@ for m in range(1, m_max):
 # workplace size
 print("Validating workplace-size in instantiation...",end='',flush=True)
 
-full_frame = np.array([len(np.where(df1['workplace'] == i)[0]) for i in np.unique(df1['workplace'].values)[~np.isnan(np.unique(df1['workplace'].values))]])
-workplacesize_output = [len(np.where(full_frame == j)[0]) for j in workplace_sizes] / np.sum([len(np.where(full_frame == j)[0]) for j in workplace_sizes])
+full_frame = summary['workplace_sizes']
+full_frame = full_frame[full_frame < m_max]
+workplacesize_output = np.bincount(full_frame, minlength=m_max) / full_frame.size
 workplace_distribution = p_n
 plt.plot(np.log10(workplace_sizes),np.log10(workplacesize_output),'r',label='Instantiation')
 plt.plot(np.log10(workplace_sizes), np.log10(workplace_distribution),label='Model')
@@ -226,8 +223,7 @@ plt.close()
 print("done.",flush=True)
 
 print("Validating workplace commute distance in instantiation...",end='',flush=True)
-full_frame = np.array([distance(df1.loc[i,'lat'],df1.loc[i,'lon'],wp.loc[wp['id']==int(df1.loc[i,'workplace']),'lat'].values[0],wp.loc[wp['id']==int(df1.loc[i,'workplace']),'lon'].values[0]) for i in np.where(df1['workplaceType']==1)[0]])
-commuter_distance_output = [len(np.where(np.array(np.floor(full_frame),dtype=int) ==i)[0]) for i in np.arange(0,m_max_commuter_distance)]/np.sum([len(np.where(np.array(np.floor(full_frame),dtype=int) ==i)[0]) for i in np.arange(0,m_max_commuter_distance)])
+commuter_distance_output = summary['commute_counts'] / np.sum(summary['commute_counts'])
 actual_dist=[]
 actual_dist = travel_distance_distribution(0,m_max_commuter_distance,a_commuter_distance,b_commuter_distance)
 d = np.arange(0,m_max_commuter_distance,1)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Distance-kernel workplace assignment for CityGen.py.
+#
+# The default assignment puts a worker in a uniformly random workplace of the
+# ward picked from the OD matrix, so commute lengths have nothing to do with
+# the travel_distance_distribution kernel (distance_kernel_a/b,
+# maxWorkplaceDistance in cityProfile.json) that validate_commutedistances
+# compares against. Here a worker at distance d from a workplace w with room
+# left picks w with probability proportional to
+#   kernel(d) * remaining capacity of w,  kernel(d) = 1 / (1 + (d/a)^b),
+# over the workplaces closer than maxWorkplaceDistance. This is sampled by
+# rejection: every round proposes to each unassigned worker a workplace drawn
+# by remaining capacity and accepts it with probability kernel(d) <= 1, so a
+# round costs O(n) for n unassigned workers and is vectorised. Rounds go on
+# while they place at least min_acceptance of the workers left; the few
+# still unassigned then (those far from most of the capacity) are sampled
+# from their candidates within maxWorkplaceDistance directly, with a KD-tree.
+
+import numpy as np
+
+EARTH_RADIUS = 6371.0 # km
+
+
+def to_km(lats, lons, lat0):
+    # Equirectangular projection around latitude lat0, in km. Accurate to
+    # well under 1% over the extent of a city.
+    lats = np.radians(np.asarray(lats, dtype=float))
+    lons = np.radians(np.asarray(lons, dtype=float))
+    return np.column_stack((EARTH_RADIUS * np.cos(np.radians(lat0)) * lons,
+                            EARTH_RADIUS * lats))
+
+
+def kernel(d, a, b):
+    # computeDistributions.travel_distance_distribution before binning
+    return 1 / (1 + (d / a) ** b)
+
+
+def accept_within_capacity(proposals, remaining):
+    # proposals[i] is the workplace proposed to worker i. Each workplace takes
+    # a random subset of its proposals, at most remaining[w] of them.
+    # Returns the boolean mask of accepted proposals.
+    order = np.random.permutation(proposals.size)
+    order = order[np.argsort(proposals[order], kind="stable")]
+    sorted_wp = proposals[order]
+    group_start = np.searchsorted(sorted_wp, sorted_wp, side="left")
+    rank = np.arange(sorted_wp.size) - group_start
+    accepted = np.zeros(proposals.size, dtype=bool)
+    accepted[order] = rank < remaining[sorted_wp]
+    return accepted
+
+
+def assign_workplaces(home_lats, home_lons, wp_lats, wp_lons, wp_capacity,
+                      a, b, m_max, min_acceptance=0.01):
+    # Returns, for every worker, the index of its workplace in wp_*. A worker
+    # with no open workplace within m_max goes to the nearest open one.
+    from scipy.spatial import cKDTree
+
+    home_lats = np.asarray(home_lats, dtype=float)
+    wp_capacity = np.asarray(wp_capacity, dtype=np.int64)
+    n = home_lats.size
+    assert wp_capacity.sum() >= n, "not enough workplace capacity for all workers"
+
+    lat0 = float(np.mean(wp_lats)) if len(wp_lats) else 0.0
+    homes = to_km(home_lats, home_lons, lat0)
+    workplaces = to_km(wp_lats, wp_lons, lat0)
+
+    result = np.full(n, -1, dtype=np.int64)
+    remaining = wp_capacity.copy()
+    unassigned = np.arange(n)
+
+    while unassigned.size > 0:
+        before = unassigned.size
+        open_wp = np.flatnonzero(remaining > 0)
+        p = remaining[open_wp] / remaining[open_wp].sum()
+        proposals = open_wp[np.random.choice(open_wp.size, size=unassigned.size, p=p)]
+        d = np.linalg.norm(workplaces[proposals] - homes[unassigned], axis=1)
+        ok = (d < m_max) & (np.random.uniform(size=unassigned.size) < kernel(d, a, b))
+
+        candidates = unassigned[ok]
+        accepted = accept_within_capacity(proposals[ok], remaining)
+        result[candidates[accepted]] = proposals[ok][accepted]
+        remaining -= np.bincount(proposals[ok][accepted], minlength=remaining.size)
+
+        assigned = np.zeros(n, dtype=bool)
+        assigned[candidates[accepted]] = True
+        unassigned = unassigned[~assigned[unassigned]]
+        if before - unassigned.size < min_acceptance * before:
+            break
+
+    if unassigned.size > 0:
+        tree = cKDTree(workplaces)
+        for i in np.random.permutation(unassigned):
+            near = np.asarray(tree.query_ball_point(homes[i], m_max), dtype=np.int64)
+            near = near[remaining[near] > 0]
+            d = np.linalg.norm(workplaces[near] - homes[i], axis=1)
+            near, d = near[d < m_max], d[d < m_max]
+            if near.size > 0:
+                w = kernel(d, a, b) * remaining[near]
+                j = near[np.random.choice(near.size, p=w / w.sum())]
+            else:
+                open_wp = np.flatnonzero(remaining > 0)
+                j = open_wp[np.argmin(np.linalg.norm(workplaces[open_wp] - homes[i], axis=1))]
+            result[i] = j
+            remaining[j] -= 1
+
+    assert (remaining >= 0).all()
+    return result